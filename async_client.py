@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+import asyncio
+from collections import deque
+from messages import *
+
+# Sent behind every request; see ChatClient.
+PING_FRAME = bytes(PingMessage().serialize())
+
+# The answer to the server's heartbeat pings.
+PONG_FRAME = bytes(PongMessage().serialize())
+
+# Chats are acknowledged at most ACK_DELAY seconds after they arrive, or as
+# soon as ACK_EVERY of them are unacknowledged, well inside the server's window.
+ACK_DELAY = 0.05
+ACK_EVERY = 64
+
+class ChatError(Exception):
+    '''An ErrorMessage the server sent in answer to a request. The exception's
+       message is the server's error message.'''
+
+class ChatClient:
+    '''One session with the chat server, as an asyncio API.
+
+           client = await ChatClient.connect("localhost", 12345)
+           await client.create_account("lavanya")
+           await client.send_chat("jordan", "hi!")
+           async for sender, body in client.chats():
+               ...
+
+       Every request is sent with a Ping behind it. The server answers requests in
+       order, so whatever it sends between a request and the Pong, other than
+       chats, is the answer to that request, and once the Pong arrives the
+       request is done. A request the server answers with an ErrorMessage raises
+       ChatError. Requests may be issued concurrently; their answers are matched
+       up in the order they were sent.
+
+       Each client holds one connection and one task reading from it, so many
+       clients can share one event loop. The reader answers the server's
+       heartbeat pings, so an idle client is not taken for a dead one.
+
+       The server numbers the chats it delivers, and the client acknowledges them
+       with one AckMessage for every ACK_EVERY chats or ACK_DELAY seconds, rather
+       than one per chat. Logging in again as the same user, on this client or on
+       one connected with resume=, acknowledges the last chat received, and the
+       server sends again the ones after it that were lost with the old
+       connection.
+
+       Better still, a client connected with resume= soon after the old
+       connection dropped picks up the old session where it was, with the resume
+       token the server issued on login: it is logged in at once, and is sent the
+       chats the old connection missed and those that arrived since, without
+       logging in again or draining the backlog.
+
+       @method connect: host, port, on_chat, resume -> ChatClient (classmethod)
+           open a session. If <on_chat> is given, it is called with (sender, body)
+           for every chat as it arrives, in order with the answers to requests,
+           instead of the chat being queued for chats(). If <resume> is an earlier
+           ChatClient, usually one whose connection dropped, the new client resumes
+           its session if the server still holds it, and is then logged in as its
+           user. Otherwise logging in as that user resumes it.
+
+       @method create_account, here: username -> None
+       @method away, delete_account: () -> None
+           log in or out, as the corresponding messages in messages.py.
+
+       @method send_chat: username, body -> None
+       @method send_channel: channel, body -> None
+       @method join_channel, leave_channel: channel -> None
+
+       @method list_users: () -> list[str]
+       @method search_users: prefix, page_size -> list[str]
+       @method search_pages: prefix, page_size -> async iterator of list[str]
+           every user, or those whose names start with <prefix>, in sorted order.
+           search_pages yields one page at a time.
+
+       @method show_undelivered: page_size -> list[(str, str)]
+       @method undelivered_pages: page_size -> async iterator of list[(str, str)]
+           take the chats waiting for the logged in user, a page at a time. Each
+           request confirms the page before it, and the server sends a page again
+           until it is confirmed, so a page lost with a dropped connection arrives
+           again on the next drain, from this client or one connected with resume=.
+
+       @method chats: () -> async iterator of (str, str)
+           the chats delivered to the logged in user as they arrive, until the
+           connection closes.
+
+       @method ping: () -> None
+       @method stats: () -> str
+           check that the server is answering, and get its metrics report. Only a
+           logged in session may ask for the report.
+
+       @attribute username: str or None
+           the user this session is logged in as.
+
+       @attribute last_sequence: int
+           the number of the last chat received, 0 before the first.
+
+       @attribute resume_token: str or None
+           the token the server issued this session on login, if it issues them.
+
+       @attribute closed: bool
+           True once the connection is gone. Requests then raise ConnectionError.
+    '''
+
+    def __init__(self, reader, writer, on_chat=None, resume=None):
+        self.writer = writer
+        self.on_chat = on_chat
+        self.username = None
+
+        # the user whose chats last_sequence counts, the last number acknowledged,
+        # and whether acknowledgments are being sent
+        self.numbered_for = resume.numbered_for if resume else None
+        self.last_sequence = resume.last_sequence if resume else 0
+        self.acked = 0
+        self.acking = False
+        self.ack_timer = None
+        self.resume_token = None
+
+        # the next cursor of the last page of undelivered chats received, which
+        # confirms it to the server
+        self.page_cursor = resume.page_cursor if resume else 0
+
+        # (future, answers) for each request waiting for its Pong, oldest first
+        self.pending = deque()
+        self.incoming = asyncio.Queue()
+        self.reader_task = asyncio.get_running_loop().create_task(self.read_loop(reader))
+
+    @classmethod
+    async def connect(cls, host="localhost", port=12345, on_chat=None, resume=None):
+        reader, writer = await asyncio.open_connection(host, port)
+        client = cls(reader, writer, on_chat, resume)
+
+        if resume and resume.username and resume.resume_token:
+            try:
+                await client.log_in(ResumeMessage(resume.username, resume.resume_token, resume.last_sequence))
+            except ChatError:
+                pass
+        return client
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @property
+    def closed(self):
+        return self.reader_task.done()
+
+    async def close(self):
+        self.writer.close()
+        await asyncio.gather(self.reader_task, return_exceptions=True)
+
+    # Send <messages> (or nothing but the Ping) and wait for the server to answer
+    # them. Returns the first response, or None if there is none.
+    async def request(self, *messages):
+        if self.closed:
+            raise ConnectionError("Connection closed.")
+
+        future = asyncio.get_running_loop().create_future()
+        answers = []
+        self.pending.append((future, answers))
+        self.writer.write(b''.join([message.serialize() for message in messages] + [PING_FRAME]))
+
+        await future
+        for answer in answers:
+            if type(answer) == ErrorMessage:
+                raise ChatError(answer.error_message)
+        return answers[0] if answers else None
+
+    async def read_loop(self, reader):
+        try:
+            while True:
+                header = await reader.readexactly(HEADER_SIZE)
+                message = deserialize_message(header + await reader.readexactly(extract_length(header)))
+                message_type = type(message)
+
+                if message_type == DeliverMessage:
+                    for chat in message.message_list:
+                        if self.on_chat:
+                            self.on_chat(*chat)
+                        else:
+                            self.incoming.put_nowait(chat)
+                    if message.first_sequence:
+                        self.received(message.first_sequence + len(message.message_list) - 1)
+
+                elif message_type == PingMessage:
+                    self.writer.write(PONG_FRAME)
+
+                elif message_type == PongMessage:
+                    if self.pending:
+                        future, answers = self.pending.popleft()
+                        if not future.done():
+                            future.set_result(answers)
+
+                elif self.pending:
+                    self.pending[0][1].append(message)
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            while self.pending:
+                future, _ = self.pending.popleft()
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection closed by server."))
+            if self.ack_timer:
+                self.ack_timer.cancel()
+            self.incoming.put_nowait(None)
+            self.writer.close()
+
+    # Note that the chats up to <sequence> have arrived, and acknowledge them
+    # now if enough are waiting, or else soon.
+    def received(self, sequence):
+        self.last_sequence = sequence
+        if not self.acking:
+            return
+
+        if sequence - self.acked >= ACK_EVERY:
+            self.send_ack()
+        elif not self.ack_timer:
+            self.ack_timer = asyncio.get_running_loop().call_later(ACK_DELAY, self.send_ack)
+
+    def send_ack(self):
+        if self.ack_timer:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+
+        if self.acking and self.acked != self.last_sequence and not self.writer.is_closing():
+            self.writer.write(AckMessage(self.last_sequence).serialize())
+            self.acked = self.last_sequence
+
+    # Log in with <message>, acknowledging at once the last chat received by the
+    # last session of the same user, which resumes it. A ResumeMessage carries
+    # that number itself.
+    async def log_in(self, message):
+        numbering = (self.last_sequence, self.acked, self.acking, self.page_cursor)
+        if message.username != self.numbered_for or type(message) == CreateAccountMessage:
+            self.last_sequence = 0
+            self.page_cursor = 0
+        self.acked = self.last_sequence
+        self.acking = True
+
+        try:
+            if type(message) == ResumeMessage:
+                session = await self.request(message)
+            else:
+                session = await self.request(message, AckMessage(self.last_sequence))
+        except ChatError:
+            # the session is as it was, logged in or not
+            self.last_sequence, self.acked, self.acking, self.page_cursor = numbering
+            raise
+        self.username = self.numbered_for = message.username
+        self.resume_token = session.token if session else None
+
+    # Stop acknowledging before logging out, acknowledging what has arrived so
+    # the server need not keep it.
+    async def log_out(self, message):
+        self.send_ack()
+        self.acking = False
+        await self.request(message)
+        self.username = None
+        self.resume_token = None
+
+    async def ping(self):
+        await self.request()
+
+    async def stats(self):
+        return (await self.request(StatsRequestMessage())).report
+
+    async def create_account(self, username):
+        await self.log_in(CreateAccountMessage(username))
+
+    async def here(self, username):
+        await self.log_in(HereMessage(username))
+
+    async def away(self):
+        await self.log_out(AwayMessage())
+
+    async def delete_account(self):
+        await self.log_out(DeleteAccountMessage())
+
+    async def send_chat(self, username, body):
+        await self.request(SendChatMessage(username, body))
+
+    async def send_channel(self, channel, body):
+        await self.request(SendChannelMessage(channel, body))
+
+    async def join_channel(self, channel):
+        await self.request(JoinChannelMessage(channel))
+
+    async def leave_channel(self, channel):
+        await self.request(LeaveChannelMessage(channel))
+
+    async def list_users(self):
+        return (await self.request(RequestUserListMessage())).user_list
+
+    async def search_pages(self, prefix="", page_size=100):
+        token = ""
+        while True:
+            response = await self.request(SearchUsersMessage(prefix, page_size, token))
+            yield response.user_list
+
+            token = response.continuation_token
+            if not token:
+                return
+
+    async def search_users(self, prefix="", page_size=100):
+        return [name async for page in self.search_pages(prefix, page_size) for name in page]
+
+    async def undelivered_pages(self, page_size=100):
+        while True:
+            response = await self.request(RequestUndeliveredPageMessage(self.page_cursor, page_size))
+            self.page_cursor = response.next_cursor
+            yield response.message_list
+
+            if response.end_of_stream:
+                return
+
+    async def show_undelivered(self, page_size=100):
+        return [chat async for page in self.undelivered_pages(page_size) for chat in page]
+
+    async def chats(self):
+        while True:
+            chat = await self.incoming.get()
+            if chat is None:
+                # leave the end marker for any other reader
+                self.incoming.put_nowait(None)
+                return
+            yield chat
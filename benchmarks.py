@@ -0,0 +1,652 @@
+#!/usr/bin/env python3
+
+'''
+    microbenchmarks for the chat server's building blocks. each benchmark is a
+    subcommand, e.g.
+
+        python3 benchmarks.py codec
+'''
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import queue
+import random
+import socket
+import threading
+import time
+import tracemalloc
+from messages import *
+from message_log import MessageLog
+from userstate import UserState
+from user_registry import SortedIndex
+from hash_ring import HashRing
+from timing_wheel import TimingWheel
+from framing import OutboundBuffer
+import server
+import serverlog
+import metrics
+
+# Helper functions
+
+# Run fn repeatedly for at least min_time seconds and return the best time for
+# a single call. The best time is the least noisy estimate on a shared machine.
+def time_call(fn, min_time=0.2):
+    best = float("inf")
+    total = 0.0
+    while total < min_time:
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        total += elapsed
+    return best
+
+# Print one row of a results table.
+def print_row(*columns):
+    print("".join(str(column).rjust(16) for column in columns))
+
+# codec benchmark
+
+# The concatenating serializers and slicing deserializers that messages.py used
+# before it wrote into preallocated buffers and decoded by offset, kept here so
+# the benchmark can show the difference.
+def legacy_serialize_deliver(message):
+    result = pack_int(message.first_sequence) + pack_int(len(message.message_list))
+    for sender, body in message.message_list:
+        result += pack_string(sender)
+        result += pack_string(body)
+    return message.pack_header() + pack_int(len(result)) + result
+
+def legacy_serialize_user_list(message):
+    result = pack_int(len(message.user_list))
+    for user in message.user_list:
+        result += pack_string(user)
+    return message.pack_header() + pack_int(len(result)) + result
+
+def legacy_deserialize_deliver(payload):
+    first_sequence, rest = unpack_int(payload)
+    num_messages, rest = unpack_int(rest)
+    messages = []
+    for i in range(num_messages):
+        sender, rest = unpack_string(rest)
+        body, rest = unpack_string(rest)
+        messages.append((sender, body))
+    return messages
+
+def legacy_deserialize_user_list(payload):
+    num_users, rest = unpack_int(payload)
+    users = []
+    for i in range(num_users):
+        user, rest = unpack_string(rest)
+        users.append(user)
+    return users
+
+# Encode and decode DeliverMessage and UserListResponseMessage frames of
+# growing size. With preallocated serialization and offset-based decoding the
+# time per entry stays flat as the frame grows; the legacy codec's time per
+# entry grows with the frame.
+def bench_codec(args):
+    cases = [
+        ("deliver", lambda n: DeliverMessage([("sender" + str(i), "body of message " + str(i)) for i in range(n)]),
+         legacy_serialize_deliver, legacy_deserialize_deliver),
+        ("user_list", lambda n: UserListResponseMessage(["user" + str(i) for i in range(n)]),
+         legacy_serialize_user_list, legacy_deserialize_user_list),
+    ]
+
+    print_row("message", "entries", "bytes", "enc ns/entry", "dec ns/entry", "legacy enc", "legacy dec")
+    for name, build, legacy_serialize, legacy_deserialize in cases:
+        for n in args.sizes:
+            message = build(n)
+            raw = message.serialize()
+            encode = time_call(lambda: message.serialize()) / n * 1e9
+            decode = time_call(lambda: deserialize_message(raw)) / n * 1e9
+
+            legacy_columns = ["-", "-"]
+            if n <= args.legacy_max:
+                payload = bytes(raw[HEADER_SIZE:])
+                legacy_columns = [
+                    "%.0f" % (time_call(lambda: legacy_serialize(message)) / n * 1e9),
+                    "%.0f" % (time_call(lambda: legacy_deserialize(payload)) / n * 1e9),
+                ]
+
+            print_row(name, n, len(raw), "%.0f" % encode, "%.0f" % decode, *legacy_columns)
+
+# message codec suite
+
+# One or more example messages of every class in message_classes, named
+# <class>/<size> where the payload size is varied. Raises if a class has no
+# example, so that new message types cannot go unmeasured.
+def codec_cases():
+    def entries(n):
+        return [("sender" + str(i), "body of message " + str(i)) for i in range(n)]
+
+    def names(n):
+        return ["user" + str(i) for i in range(n)]
+
+    cases = [
+        ("PingMessage", PingMessage()),
+        ("PongMessage", PongMessage()),
+        ("StatsRequestMessage", StatsRequestMessage()),
+        ("StatsResponseMessage", StatsResponseMessage("requests_total{type=\"SendChatMessage\"} 1200\n" * 40)),
+        ("HereMessage", HereMessage("lavanya")),
+        ("CreateAccountMessage", CreateAccountMessage("lavanya")),
+        ("AwayMessage", AwayMessage()),
+        ("RequestUserListMessage", RequestUserListMessage()),
+        ("DeleteAccountMessage", DeleteAccountMessage()),
+        ("ShowUndeliveredMessage", ShowUndeliveredMessage()),
+        ("RequestUndeliveredPageMessage", RequestUndeliveredPageMessage(200, 100)),
+        ("SearchUsersMessage", SearchUsersMessage("lav", 100, "lavanya")),
+        ("JoinChannelMessage", JoinChannelMessage("#general")),
+        ("LeaveChannelMessage", LeaveChannelMessage("#general")),
+        ("SendChannelMessage", SendChannelMessage("#general", "x" * 100)),
+        ("AckMessage", AckMessage(4096)),
+        ("ResumeMessage", ResumeMessage("lavanya", "Vv3kq0-rPmxwqJ5o8jvG7w", 4096)),
+        ("SessionMessage", SessionMessage("Vv3kq0-rPmxwqJ5o8jvG7w")),
+        ("ErrorMessage", ErrorMessage("Recipient user does not exist. Please try again.")),
+        ("ForwardRequestMessage", ForwardRequestMessage(7, 3, "lavanya", SendChatMessage("jordan", "x" * 100).serialize())),
+        ("ForwardResponseMessage", ForwardResponseMessage(7, "lavanya", DeliverMessage(entries(10)).serialize())),
+        ("PushMessage", PushMessage(3, DeliverMessage(entries(10)).serialize())),
+        ("LeaveChannelsMessage", LeaveChannelsMessage("jordan")),
+        ("NodeHelloMessage", NodeHelloMessage("localhost:13001")),
+        ("HandoffChannelMessage/100", HandoffChannelMessage("#general", names(100))),
+        ("DetachMessage", DetachMessage()),
+        ("CloseSessionMessage", CloseSessionMessage(3)),
+    ]
+    cases += [("SendChatMessage/" + str(n), SendChatMessage("jordan", "x" * n)) for n in [10, 1000, 100000]]
+    cases += [("DeliverMessage/" + str(n), DeliverMessage(entries(n), 4096)) for n in [1, 100, 10000, 100000]]
+    cases += [("UserListResponseMessage/" + str(n), UserListResponseMessage(names(n))) for n in [10, 1000, 100000]]
+    cases += [("UndeliveredPageMessage/" + str(n), UndeliveredPageMessage(n, entries(n), False)) for n in [100, 1000]]
+    cases += [("UserPageResponseMessage/" + str(n), UserPageResponseMessage(names(n), "user" + str(n))) for n in [100, 1000]]
+    cases += [("FanOutMessage/" + str(n), FanOutMessage("#general/jordan", "x" * 100, names(n))) for n in [10, 1000]]
+    cases += [("HandoffUserMessage/" + str(n), HandoffUserMessage("lavanya", entries(n))) for n in [100, 10000]]
+
+    missing = set(message_classes) - {type(message) for _, message in cases}
+    if missing:
+        raise Exception("No codec benchmark for " + ", ".join(sorted(cls.__name__ for cls in missing)))
+
+    return cases
+
+# Serialize and deserialize an example of every message type, reporting
+# operations and megabytes per second. Results can be saved as a baseline, and
+# later runs compared against it: a case that has slowed down by more than
+# -tolerance is flagged, and the run exits with status 1.
+def bench_messages(args):
+    baseline = {}
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+
+    def print_case(name, *columns, change):
+        print(name.ljust(24) + "".join(str(column).rjust(12) for column in columns) + "  " + change)
+
+    print_case("case", "bytes", "enc ops/s", "enc MB/s", "dec ops/s", "dec MB/s", change="vs baseline")
+    for name, message in codec_cases():
+        if args.match and args.match not in name:
+            continue
+
+        raw = message.serialize()
+        encode = 1 / time_call(lambda: message.serialize(), args.min_time)
+        decode = 1 / time_call(lambda: deserialize_message(raw, peer=True), args.min_time)
+        results[name] = {"bytes": len(raw), "serialize": encode, "deserialize": decode}
+
+        change = "-"
+        if name in baseline:
+            changes = [rate / baseline[name][operation] - 1
+                       for operation, rate in [("serialize", encode), ("deserialize", decode)]]
+            change = "%+.0f%% %+.0f%%" % (changes[0] * 100, changes[1] * 100)
+            if min(changes) < -args.tolerance:
+                regressions.append(name)
+                change += " SLOWER"
+
+        print_case(name.replace("Message", ""), len(raw), "%.0f" % encode,
+                   "%.1f" % (encode * len(raw) / 1e6), "%.0f" % decode, "%.1f" % (decode * len(raw) / 1e6), change=change)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({**baseline, **results}, f, indent=1, sort_keys=True)
+        print("Saved results to " + args.save)
+
+    if regressions:
+        print(str(len(regressions)) + " cases are more than " + "%.0f%%" % (args.tolerance * 100) +
+              " slower than the baseline: " + ", ".join(regressions))
+        sys.exit(1)
+
+# durable send benchmark
+
+# Each sender thread logs a message and waits for it to be committed before
+# sending the next, as a connection of the server waits before answering a
+# client whose chat was queued for later. Run at
+# several commit intervals to show how group commit trades latency for
+# throughput: one fsync covers every record that arrived during the interval.
+def bench_durable(args):
+    print_row("interval ms", "senders", "sends/sec", "fsyncs/sec", "sends/fsync", "avg wait ms")
+
+    for interval in args.intervals:
+        with tempfile.TemporaryDirectory() as directory:
+            log = MessageLog(os.path.join(directory, "messages.log"), interval / 1000)
+            log.replay()
+            log.start()
+
+            deadline = time.perf_counter() + args.seconds
+            counts = [0] * args.senders
+
+            def sender(index):
+                while time.perf_counter() < deadline:
+                    log.wait_for_commit(log.log_message("recipient", "sender" + str(index), "x" * args.body_size))
+                    counts[index] += 1
+
+            threads = [threading.Thread(target=sender, args=(i,)) for i in range(args.senders)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            log.close()
+
+            sends = sum(counts)
+            print_row(interval, args.senders, "%.0f" % (sends / elapsed), "%.0f" % (log.commits / elapsed),
+                      "%.1f" % (sends / max(log.commits, 1)), "%.2f" % (elapsed * args.senders / max(sends, 1) * 1000))
+
+# memory benchmark
+
+# UserState as it was before it was made compact: a plain object holding two
+# Queues, each with its own lock, condition variables and deque.
+class LegacyUserState:
+    def __init__(self, username):
+        self.here = False
+        self.username = username
+        self.deliver_now = queue.Queue()
+        self.deliver_later = queue.Queue()
+
+    def add_message(self, message):
+        self.deliver_later.put(message)
+
+# Measure the memory allocated while build() runs, and keep its result alive
+# until the measurement is taken.
+def measure_allocation(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+# Report the bytes each idle user costs, and the bytes each queued message
+# costs on top of its body. Bodies are shared between messages and senders are
+# drawn from a small pool, so only the queue overhead is counted.
+def bench_memory(args):
+    body = "x" * 100
+    senders = ["sender" + str(i) for i in range(100)]
+
+    print_row("class", "bytes/user", "bytes/message")
+    for name, cls in [("UserState", UserState), ("legacy", LegacyUserState)]:
+        names = ["user" + str(i) for i in range(args.users)]
+        idle, states = measure_allocation(lambda: [cls(username) for username in names])
+
+        def queue_messages():
+            for i in range(args.messages):
+                states[i % args.queued_users].add_message((senders[i % len(senders)], body))
+
+        queued, _ = measure_allocation(queue_messages)
+        print_row(name, "%.0f" % (idle / args.users), "%.1f" % (queued / args.messages))
+        del states
+
+# directory benchmark
+
+# Compare answering RequestUserListMessage, which serializes every account,
+# with serving one page of a SearchUsersMessage from the sorted index, and show
+# what keeping the index up to date costs per account created or deleted.
+def bench_directory(args):
+    print_row("users", "full list ms", "full bytes", "page us", "prefix us", "page bytes", "add us", "discard us")
+
+    for n in args.users:
+        users = dict.fromkeys("user" + str(i) for i in range(n))
+        directory = SortedIndex(users.keys())
+
+        full_list = time_call(lambda: UserListResponseMessage(list(users.keys())).serialize())
+        full_bytes = len(UserListResponseMessage(list(users.keys())).serialize())
+
+        # a page from the middle of the directory, and a page of a narrow prefix
+        middle = "user" + str(n // 2)
+        def page(prefix, after):
+            user_list, token = directory.search(prefix, args.page_size, after)
+            return UserPageResponseMessage(user_list, token).serialize()
+        page_time = time_call(lambda: page("", middle))
+        prefix_time = time_call(lambda: page("user" + str(n // 3), ""))
+        page_bytes = len(page("", middle))
+
+        # add and remove a batch of new names spread across the directory
+        names = ["user" + str(i) + "x" for i in range(0, n, max(n // 1000, 1))]
+        start = time.perf_counter()
+        for name in names:
+            directory.add(name)
+        add_time = (time.perf_counter() - start) / len(names)
+        start = time.perf_counter()
+        for name in names:
+            directory.discard(name)
+        discard_time = (time.perf_counter() - start) / len(names)
+
+        print_row(n, "%.1f" % (full_list * 1e3), full_bytes, "%.1f" % (page_time * 1e6), "%.1f" % (prefix_time * 1e6),
+                  page_bytes, "%.2f" % (add_time * 1e6), "%.2f" % (discard_time * 1e6))
+
+# fan-out benchmark
+
+# Stands in for a client connection, counting the bytes written to it.
+class NullConnection:
+    def __init__(self):
+        self.sent = 0
+
+    def sendall(self, data):
+        self.sent += len(data)
+
+# Deliver one message to every member of a channel, half of them connected.
+# The per-chat path is what sending to many people cost before channels: one
+# SendChatMessage per recipient, each decoded, queued and serialized into its
+# own DeliverMessage, and each away recipient holding its own copy of the body.
+# Fan-out decodes one SendChannelMessage, serializes one frame and queues one
+# shared message for everybody.
+def bench_fanout(args):
+    body = "x" * args.body_size
+
+    print_row("members", "chat ns/rcpt", "fanout ns/rcpt", "chat B/away", "fanout B/away")
+    for n in args.members:
+        names = ["member" + str(i) for i in range(n)]
+        online = names[:n // 2]
+        away = names[n // 2:]
+        conn = NullConnection()
+
+        def setup():
+            server.users = {name: UserState(name) for name in names + ["sender"]}
+            server.channels = {"#bench": frozenset(names)}
+            for name in online:
+                server.users[name].login()
+
+        def deliver_all():
+            for name in online:
+                server.send_new_messages(name, conn, None)
+
+        chats = [SendChatMessage(name, body).serialize() for name in names]
+        def per_chat():
+            for frame in chats:
+                message = deserialize_message(frame)
+                server.users[message.username].add_message(("sender", message.body))
+        def per_chat_queue_away():
+            for frame in chats[n // 2:]:
+                message = deserialize_message(frame)
+                server.users[message.username].add_message(("sender", message.body))
+
+        channel_frame = SendChannelMessage("#bench", body).serialize()
+        def fan_out():
+            message = deserialize_message(channel_frame)
+            server.fan_out("sender", message.channel, message.body)
+        def fan_out_queue_away():
+            server.channels["#bench"] = frozenset(away)
+            fan_out()
+
+        results = []
+        for send, queue_away in [(per_chat, per_chat_queue_away), (fan_out, fan_out_queue_away)]:
+            setup()
+            results.append(time_call(lambda: (send(), deliver_all())) / n * 1e9)
+            setup()
+            results.append(measure_allocation(queue_away)[0] / len(away))
+
+        print_row(n, "%.0f" % results[0], "%.0f" % results[2], "%.0f" % results[1], "%.0f" % results[3])
+
+# ring benchmark
+
+# The fraction of users that change owner when a node joins or leaves a
+# cluster, placed by the consistent-hash ring and by hashing modulo the number
+# of nodes. The ideal is 1/(n+1) for a join and 1/n for a leave.
+def bench_ring(args):
+    names = ["user" + str(i) for i in range(args.users)]
+
+    print_row("nodes", "change", "ring moved", "modulo moved", "ideal")
+    for n in args.nodes:
+        nodes = ["node" + str(i) + ":13000" for i in range(n + 1)]
+        rings = {count: HashRing(nodes[:count], args.replicas) for count in [n - 1, n, n + 1]}
+        owners = {count: [ring.owner(name) for name in names] for count, ring in rings.items()}
+        shards = {count: [server.shard_of(name, count) for name in names] for count in rings}
+
+        for change, count, ideal in [("join", n + 1, 1 / (n + 1)), ("leave", n - 1, 1 / n)]:
+            ring_moved = sum(a != b for a, b in zip(owners[n], owners[count])) / len(names)
+            modulo_moved = sum(a != b for a, b in zip(shards[n], shards[count])) / len(names)
+            print_row(n, change, "%.3f" % ring_moved, "%.3f" % modulo_moved, "%.3f" % ideal)
+
+# logging benchmark
+
+# Cost per record on the thread that logs it: printing a line the way the
+# server used to, against a serverlog record that is disabled by its level
+# (with and without the caller testing the level first) and one that is
+# queued for the writer thread.
+def bench_logging(args):
+    message_type = SendChatMessage
+    user = "sender"
+
+    with open(os.devnull, "w") as devnull:
+        serverlog.output = devnull
+        serverlog.configure("info", interval=0.01)
+        serverlog.output = devnull
+
+        def printed():
+            for i in range(args.records):
+                print("Received a " + str(message_type), file=devnull)
+
+        def guarded():
+            for i in range(args.records):
+                if serverlog.level <= serverlog.DEBUG:
+                    serverlog.debug("request", type=message_type.__name__, user=user)
+
+        def disabled():
+            for i in range(args.records):
+                serverlog.debug("request", type=message_type.__name__, user=user)
+
+        # the writer thread's formatting and writing is left out of the time,
+        # as it does not hold up the caller
+        def queued():
+            best = float("inf")
+            for run in range(5):
+                start = time.perf_counter()
+                for i in range(args.records):
+                    serverlog.info("request", type=message_type.__name__, user=user)
+                best = min(best, time.perf_counter() - start)
+                serverlog.flush()
+            return best
+
+        print_row("record", "ns/record")
+        for name, fn in [("print", printed), ("guarded off", guarded), ("debug off", disabled)]:
+            print_row(name, "%.0f" % (time_call(fn) / args.records * 1e9))
+        print_row("queued", "%.0f" % (queued() / args.records * 1e9))
+
+# Cost of recording one request's latency, and of rendering the stats report
+# once the histograms are full.
+def bench_metrics(args):
+    values = [random.randrange(1000, 10 ** 7) for i in range(args.records)]
+    histogram = metrics.Histogram()
+
+    def record():
+        for value in values:
+            histogram.record(value)
+
+    def record_request():
+        for value in values:
+            metrics.record_request("SendChatMessage", value)
+
+    def timed():
+        for value in values:
+            start = metrics.now()
+            metrics.record_request("SendChatMessage", metrics.now() - start)
+
+    print_row("operation", "ns/record")
+    for name, fn in [("record", record), ("record_request", record_request), ("timed request", timed)]:
+        print_row(name, "%.0f" % (time_call(fn) / args.records * 1e9))
+
+    for type_name in [cls.__name__ for cls in message_classes]:
+        metrics.record_request(type_name, 1000)
+    print_row("report", "%.0f us" % (time_call(lambda: metrics.report({})) * 1e6))
+
+# Cost per tick of keeping heartbeats for many idle connections: on a timing
+# wheel, where a tick only touches the timers that are due, against sweeping
+# every connection each tick. Every connection is checked once per heartbeat
+# either way, so the wheel's cost per tick grows with the checks that fall due,
+# and the sweep's with the number of connections.
+def bench_timers(args):
+    print_row("connections", "wheel us/tick", "sweep us/tick", "schedule ns", "cancel ns")
+
+    for n in args.connections:
+        wheel = TimingWheel(tick=1, start=0)
+
+        def check(i):
+            wheel.schedule(args.heartbeat, check, i)
+
+        timers = [wheel.schedule(random.uniform(1, args.heartbeat), check, i) for i in range(n)]
+        start = time.perf_counter()
+        for tick in range(1, args.ticks + 1):
+            for timer in wheel.advance(tick):
+                timer.fire()
+        wheel_time = (time.perf_counter() - start) / args.ticks
+
+        last_heard = [-random.uniform(0, args.heartbeat) for i in range(n)]
+        start = time.perf_counter()
+        for tick in range(1, args.ticks + 1):
+            for i, heard in enumerate(last_heard):
+                if tick - heard >= args.heartbeat:
+                    last_heard[i] = tick
+        sweep_time = (time.perf_counter() - start) / args.ticks
+
+        start = time.perf_counter()
+        timers = [wheel.schedule(random.uniform(1, 10 * args.heartbeat), check, i) for i in range(n)]
+        schedule_time = (time.perf_counter() - start) / n
+        start = time.perf_counter()
+        for timer in timers:
+            wheel.cancel(timer)
+        cancel_time = (time.perf_counter() - start) / n
+
+        print_row(n, "%.0f" % (wheel_time * 1e6), "%.0f" % (sweep_time * 1e6),
+                  "%.0f" % (schedule_time * 1e9), "%.0f" % (cancel_time * 1e9))
+
+# writes benchmark
+
+# The cost of answering a burst of pipelined requests that each deliver a
+# channel chat, written a frame at a time with sendall, against gathering the
+# frames in an OutboundBuffer and flushing them with sendmsg. A thread drains
+# the other end of a socketpair, as a client would.
+def bench_writes(args):
+    pong = bytes(PongMessage().serialize())
+    shared = bytes(DeliverMessage([("#bench/sender", "x" * args.body_size)]).serialize())
+
+    print_row("burst", "frame us/burst", "gather us/burst", "frame calls", "gather calls")
+    for burst in args.bursts:
+        sock, peer = socket.socketpair()
+
+        def read_all():
+            while peer.recv(1 << 20):
+                pass
+        drain = threading.Thread(target=read_all, daemon=True)
+        drain.start()
+
+        def per_frame():
+            for sequence in range(burst):
+                sock.sendall(DeliverMessage.renumber(shared, sequence + 1))
+                sock.sendall(pong)
+
+        out = OutboundBuffer(sock)
+        calls = []
+        def gathered():
+            for sequence in range(burst):
+                for part in DeliverMessage.renumber_parts(shared, sequence + 1):
+                    out.sendall(part)
+                out.sendall(pong)
+            calls.append(out.flush())
+
+        frame_time = time_call(per_frame)
+        gather_time = time_call(gathered)
+        sock.close()
+        drain.join()
+        peer.close()
+
+        print_row(burst, "%.1f" % (frame_time * 1e6), "%.1f" % (gather_time * 1e6),
+                  2 * burst, "%.1f" % (sum(calls) / len(calls)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    codec = subparsers.add_parser("codec", help="Serialization and deserialization cost per entry as messages grow.")
+    codec.add_argument("-sizes", help="Entry counts to decode.", type=int, nargs="+",
+                       default=[1000, 2000, 4000, 8000, 16000, 32000, 64000])
+    codec.add_argument("-legacy_max", help="Largest entry count to run through the legacy codec.",
+                       type=int, default=16000)
+    codec.set_defaults(run=bench_codec)
+
+    suite = subparsers.add_parser("messages", help="Serialize and deserialize every message type, against a baseline.")
+    suite.add_argument("-baseline", help="Results of an earlier run to compare against, if the file exists. "
+                       "Defaults to codec_baseline.json.", default="codec_baseline.json")
+    suite.add_argument("-save", help="File to save this run's results to, to use as a baseline later.")
+    suite.add_argument("-tolerance", help="Slowdown against the baseline that counts as a regression. "
+                       "Defaults to 0.2; rerun flagged cases with -match to rule out noise.", type=float, default=0.2)
+    suite.add_argument("-match", help="Only run cases whose name contains this.")
+    suite.add_argument("-min_time", help="Seconds to spend timing each operation. Defaults to 0.2.",
+                       type=float, default=0.2)
+    suite.set_defaults(run=bench_messages)
+
+    durable = subparsers.add_parser("durable", help="Durable sends per second at different group commit intervals.")
+    durable.add_argument("-intervals", help="Commit intervals to try, in milliseconds.", type=float, nargs="+",
+                         default=[0, 1, 5, 10, 20])
+    durable.add_argument("-senders", help="Concurrent sender threads.", type=int, default=32)
+    durable.add_argument("-seconds", help="How long to run each interval.", type=float, default=2)
+    durable.add_argument("-body_size", help="Message body size in bytes.", type=int, default=100)
+    durable.set_defaults(run=bench_durable)
+
+    memory = subparsers.add_parser("memory", help="Bytes per idle user and per queued message.")
+    memory.add_argument("-users", help="Idle users to create.", type=int, default=100000)
+    memory.add_argument("-messages", help="Messages to queue.", type=int, default=200000)
+    memory.add_argument("-queued_users", help="Users the messages are spread across.", type=int, default=1000)
+    memory.set_defaults(run=bench_memory)
+
+    directory = subparsers.add_parser("directory", help="Full user list against one page of a prefix search.")
+    directory.add_argument("-users", help="Account counts to try.", type=int, nargs="+", default=[100000, 1000000])
+    directory.add_argument("-page_size", help="Users per search page.", type=int, default=100)
+    directory.set_defaults(run=bench_directory)
+
+    fanout = subparsers.add_parser("fanout", help="Cost per recipient of one message to many users.")
+    fanout.add_argument("-members", help="Channel sizes to try.", type=int, nargs="+", default=[50, 500, 5000])
+    fanout.add_argument("-body_size", help="Message body size in bytes.", type=int, default=1000)
+    fanout.set_defaults(run=bench_fanout)
+
+    ring = subparsers.add_parser("ring", help="Users that change owner when a cluster node joins or leaves.")
+    ring.add_argument("-nodes", help="Cluster sizes to try.", type=int, nargs="+", default=[3, 5, 10])
+    ring.add_argument("-users", help="Users to place.", type=int, default=100000)
+    ring.add_argument("-replicas", help="Points per node on the ring.", type=int, default=100)
+    ring.set_defaults(run=bench_ring)
+
+    logging = subparsers.add_parser("logging", help="Cost of a log record to the thread that logs it.")
+    logging.add_argument("-records", help="Records per timed run.", type=int, default=10000)
+    logging.set_defaults(run=bench_logging)
+
+    stats = subparsers.add_parser("metrics", help="Cost of recording a latency, and of the stats report.")
+    stats.add_argument("-records", help="Values per timed run.", type=int, default=100000)
+    stats.set_defaults(run=bench_metrics)
+
+    wheel = subparsers.add_parser("timers", help="Cost per tick of heartbeats for many idle connections.")
+    wheel.add_argument("-connections", help="Connection counts to try.", type=int, nargs="+",
+                       default=[1000, 10000, 100000])
+    wheel.add_argument("-heartbeat", help="Ticks between checks of each connection. Defaults to 60, 15 s at the "
+                       "server's tick of 0.25 s.", type=int, default=60)
+    wheel.add_argument("-ticks", help="Ticks per timed run.", type=int, default=120)
+    wheel.set_defaults(run=bench_timers)
+
+    writes = subparsers.add_parser("writes", help="Frames sent one call each against gathered into one sendmsg.")
+    writes.add_argument("-bursts", help="Frames per burst to try.", type=int, nargs="+", default=[1, 4, 16, 64, 256])
+    writes.add_argument("-body_size", help="Chat body size in bytes.", type=int, default=100)
+    writes.set_defaults(run=bench_writes)
+
+    args = parser.parse_args()
+    args.run(args)
@@ -1,11 +1,9 @@
-import socket
+import asyncio
+import concurrent.futures
 import threading
-import messages
-import select
-import queue
-import time
 import sys
 import argparse
+from async_client import ChatClient, ChatError
 from integration_tests import *
 import messages_unit_tests
 
@@ -14,8 +12,18 @@ HOST = "localhost"
 PORT = 12345
 TESTING = False
 
+# Undelivered messages or users to ask the server for at a time
+PAGE_SIZE = 100
+
+# Seconds to wait for the server to answer before showing the next prompt anyway
+REPLY_TIMEOUT = 5
+
 # Global client state
-message_queue = queue.Queue()
+# The session is an async_client.ChatClient, which runs on an event loop in
+# its own thread, so that chats are printed as they arrive while the main
+# thread waits for input.
+loop = None
+client = None
 is_connected = False
 logged_in = False
 username = None
@@ -59,15 +67,37 @@ def collect_user_input(valid_actions):
         return -1
     return action
 
+# Returned by call when the request did not succeed
+FAILED = object()
+
+"""
+    Runs <coroutine>, a call on the client library, on the network thread and
+    waits up to REPLY_TIMEOUT seconds for the server to answer it. Prints any
+    error, and returns FAILED if there was one.
+"""
+def call(coroutine):
+    global is_connected
+    global logged_in
+    try:
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result(REPLY_TIMEOUT)
+    except ChatError as e:
+        print_wrapped("Error received: " + str(e))
+    except concurrent.futures.TimeoutError:
+        print_wrapped("No answer from the server.")
+    except ConnectionError:
+        print_wrapped("Failed to receive data. Resetting connection.")
+        is_connected = False
+        logged_in = False
+    return FAILED
+
 # Universal action functions
 
 """
-    Adds a ping message to the message queue to check connectivity
-    message gets sent by the socket thread
+    Sends a ping to check connectivity, and waits for the pong
 """
 def ping():
-    payload = messages.PingMessage()
-    message_queue.put(payload.serialize())
+    if call(client.ping()) is not FAILED:
+        print_wrapped("Pong message received!")
 
 # Logged out action functions
 
@@ -78,33 +108,29 @@ def program_quit():
     exit("Goodbye!")
 
 """
-    Asks the user for their username then adds a login request
-    to the message queue. Updates global boolean logged_in 
-    and global string username.
+    Asks the user for their username then logs them in. Updates
+    global boolean logged_in and global string username.
 """
 def login():
     global logged_in
     global username
     local_username = input_wrapped("What is your username?: ")
-    payload = messages.HereMessage(local_username)
-    message_queue.put(payload.serialize())
-    logged_in = True
-    username = local_username
+    if call(client.here(local_username)) is not FAILED:
+        logged_in = True
+        username = local_username
 
 """
     Asks the user the name of the account they want to create
-    then adds that request to the message queue. Updates the
-    global boolean logged_in and the global string username
+    then creates it. Updates the global boolean logged_in and
+    the global string username
 """
 def create_account():
     global logged_in
     global username
     local_username = input_wrapped("What do you want your username to be?: ")
-    payload = messages.CreateAccountMessage(local_username)
-    message_queue.put(payload.serialize())
-    logged_in = True
-    time.sleep(.5)
-    username = local_username
+    if call(client.create_account(local_username)) is not FAILED:
+        logged_in = True
+        username = local_username
 
 # Universal actions:
 PING           = 9
@@ -125,54 +151,84 @@ LOGGED_OUT_ACTIONS = {
 # Logged in action functions
 
 """
-    Logs the user out, adding an Away Message to the
-    message queue. Updates the global boolean logged_in
-    to False
+    Logs the user out with an Away Message. Updates the
+    global boolean logged_in to False
 """
 def logout():
     global logged_in
-    payload = messages.AwayMessage()
-    message_queue.put(payload.serialize())
+    call(client.away())
     print_wrapped("Logged out!")
     logged_in = False
 
 """
-    Prompts the user for a recipient and their message. Places that message on
-    the message queue.
+    Prompts the user for a recipient and their message, and sends it. A
+    recipient starting with # is a channel.
 """
 def chat_send():
-    receiver = input_wrapped("Who do you want to send the message to?: ").strip()
+    receiver = input_wrapped("Who do you want to send the message to? (#name for a channel): ").strip()
     print_wrapped("Write your message below and press 'enter' to send:")
     message = input_wrapped()
-    payload = messages.SendChatMessage(receiver, message)
-    message_queue.put(payload.serialize())
-    print_wrapped("Message sent!")
+    if receiver.startswith("#"):
+        result = call(client.send_channel(receiver, message))
+    else:
+        result = call(client.send_chat(receiver, message))
+    if result is not FAILED:
+        print_wrapped("Message sent!")
 
 """
-    Places a the bytes for a user list request on the message queue
+    Asks for the list of users and prints it
 """
 def list_users():
-    payload = messages.RequestUserListMessage()
-    message_queue.put(payload.serialize())
+    user_list = call(client.list_users())
+    if user_list is not FAILED:
+        print_wrapped("These are the users!:")
+        print_wrapped(user_list)
+        print_wrapped()
 
 """
-    Updates global boolean logged_in to False. Places message to 
-    delete account on the message queue
+    Deletes the account. Updates global boolean logged_in to
+    False
 """
 def delete_account():
     global logged_in
-    payload = messages.DeleteAccountMessage()
-    message_queue.put(payload.serialize())
-    print_wrapped("Account deleted!")
-    logged_in = False
+    if call(client.delete_account()) is not FAILED:
+        print_wrapped("Account deleted!")
+        logged_in = False
 
 """
-    Places a request to show undelivered messages onto the 
-    message queue.
+    Takes the undelivered messages a page at a time, printing each page
+    as it arrives.
 """
 def show_messages():
-    payload = messages.ShowUndeliveredMessage()
-    message_queue.put(payload.serialize())
+    async def show_pages():
+        async for page in client.undelivered_pages(PAGE_SIZE):
+            print_messages(page)
+
+    call(show_pages())
+
+"""
+    Prompts the user for the start of a username, and prints the matching
+    users a page at a time.
+"""
+def search_users():
+    prefix = input_wrapped("Show users whose names start with: ").strip()
+
+    async def show_pages():
+        async for page in client.search_pages(prefix, PAGE_SIZE):
+            print_wrapped(page)
+
+    call(show_pages())
+
+"""
+    Prompts the user for a channel, and joins or leaves it.
+"""
+def join_channel():
+    channel = input_wrapped("Which channel do you want to join? (e.g. #general): ").strip()
+    call(client.join_channel(channel))
+
+def leave_channel():
+    channel = input_wrapped("Which channel do you want to leave?: ").strip()
+    call(client.leave_channel(channel))
 
 # Logged in actions
 LOGOUT = 1
@@ -180,6 +236,9 @@ CHAT_SEND = 2
 LIST_USERS = 3
 DELETE_ACCOUNT = 4
 SHOW_MESSAGES = 5
+SEARCH_USERS = 6
+JOIN_CHANNEL = 7
+LEAVE_CHANNEL = 8
 
 # Maps actions to their respective functions
 LOGGED_IN_ACTIONS = {
@@ -188,6 +247,9 @@ LOGGED_IN_ACTIONS = {
     LIST_USERS: list_users,
     DELETE_ACCOUNT: delete_account,
     SHOW_MESSAGES: show_messages,
+    SEARCH_USERS: search_users,
+    JOIN_CHANNEL: join_channel,
+    LEAVE_CHANNEL: leave_channel,
     PING: ping
 }
 
@@ -197,149 +259,60 @@ def logged_in_sequence():
     global username
     print_wrapped(f"You are logged in as " + username + "!")
     print_wrapped(("What would you like to do now? Type '1' to log out, '2' to send a chat, "
-        "'3' to list all available users, '4' to delete your account, '5' to receive undelivered messages, and '9' to test connection. "))
+        "'3' to list all available users, '4' to delete your account, '5' to receive undelivered messages, '6' to search for users, '7' to join a channel, '8' to leave a channel, and '9' to test connection. "))
     action = collect_user_input(LOGGED_IN_ACTIONS)
     if action != -1:
         LOGGED_IN_ACTIONS[action]()
 
-"""
-    Updates the global boolean logged_in and is_connected.
-    Logs the user out and shuts down the connection.
-"""
-def logout(sock):
-    global logged_in
-    global is_connected
-    sock.close()
-    is_connected = False
-    logged_in = False
-
-"""
-    Reads bytes from the socket, timing out after .5 seconds.
-    Returns None if no messages show up, or if it fails.
-"""
-def read_message_bytes(sock):
-    # Look to see if any messages showed up.
-    try:
-        ready = select.select([sock], [], [], .5)
-    except:
-        return None
+# Print a list of (sender, body) messages received from the server.
+def print_messages(message_list):
+    for message in message_list:
+        sender, body = message
+        print_wrapped(f"Message from " + sender + ":")
+        print_wrapped(body)
+        print_wrapped()
 
-    # no message received
-    if not ready[0]:
-        return None
-
-    # read the first 64 bytes
-    try:
-        message = sock.recv(64)
-    except OSError as e:
-        logout(sock)
-        print_wrapped("Failed to receive data. Resetting connection.")
-        return None
-
-    # if we haven't received a message, nothing to do
-    if not message or len(message) < 12:
-        return None
-
-    # read the rest of the message
-    message_len = messages.extract_length(message)
-    while len(message) < message_len:
-        try:
-            chunk = sock.recv(64)
-        except OSError:
-            logout(sock)
-            print_wrapped("Failed to receive data. Resetting connection.")
-            return None
-        message += chunk
-
-    return message
-
-# The listener thread runs this loop, checking for and handling
-# any new communication from the server.
-def socket_loop(sock):
-    global logged_in
-    global is_connected
-
-    while True:
-        # First send any messages on the queue to the server.
-        while not message_queue.empty():
-            message = message_queue.get()
-            sock.send(message)
-
-        message_bytes = read_message_bytes(sock)
-
-        # Nothing new from the server.
-        if not message_bytes:
-            continue
-
-        try:
-            message_object = messages.deserialize_message(message_bytes)
-        except Exception as e:
-            print_wrapped("Failed to deserialize message." + str(e.message))
-            print_wrapped("Invalid message received. Closing program.")
-            logout(sock)
-            return
-
-        # Handle messages from server, depending on type.
-
-        message_type = type(message_object)
-
-        # received response to a ping
-        if message_type == messages.PongMessage:
-            print_wrapped("Pong message received!")
-
-        # received a response to a request for a list of users
-        elif message_type == messages.UserListResponseMessage:
-            print_wrapped("These are the users!:")
-            print_wrapped(message_object.user_list)
-            print_wrapped()
-
-        # received messages
-        elif message_type == messages.DeliverMessage:
-            for message in message_object.message_list:
-                sender, body = message
-                print_wrapped(f"Message from " + sender + ":")
-                print_wrapped(body)
-                print_wrapped()
-
-        # received an error
-        elif message_type == messages.ErrorMessage:
-            print_wrapped("Error received: " + str(message_object.error_message))
-            print_wrapped("You may need to restart the client to resume normal behavior.")
-
-        # Server is sending nonsense.
-        else:
-            print("Invalid message object.")
+# Print a chat delivered while the user is here. Runs on the network thread.
+def print_chat(sender, body):
+    print_messages([(sender, body)])
 
 # The user flow when logged out.
 def logged_out_sequence():
     global is_connected
+    global logged_in
+    global client
     if not is_connected:
         print_wrapped("Establishing connection with server...")
-        sock = None
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((HOST, PORT))
-        except OSError:
+            # a new connection after one dropped resumes its session, so chats
+            # that were in flight are not lost
+            connect = ChatClient.connect(HOST, PORT, on_chat=print_chat, resume=client)
+            client = asyncio.run_coroutine_threadsafe(connect, loop).result(REPLY_TIMEOUT)
+        except (OSError, concurrent.futures.TimeoutError):
             print_wrapped("Failure to connect!")
             program_quit()
         is_connected = True
-        threading.Thread(target=socket_loop, args=(sock,)).start()
         print_wrapped("Successfully connected to server!")
+        if client.username:
+            print_wrapped("Resumed your session.")
+            logged_in = True
+            return
     print_wrapped()
     print_wrapped(("Welcome to Sooper Chat! Type '1' to log in, '2' to "
             "create an account, '3' to quit, and '9' to ping (test connection)."))
-    action = collect_user_input(LOGGED_IN_ACTIONS)
+    action = collect_user_input(LOGGED_OUT_ACTIONS)
     if action != -1:
         LOGGED_OUT_ACTIONS[action]()
 
 # Main event loop
 def main():
-    global logged_in
-    global is_connected
+    global loop
 
-    while True:
-        time.sleep(1)
+    # the client library runs here, while this thread waits for input
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
 
+    while True:
         if logged_in:
             logged_in_sequence()
         else:
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+from collections import deque
+import serverlog
+
+class ConnectionPool:
+    '''A bounded pool of threads that serve client connections, and a bounded queue
+       of connections waiting for one of them.
+
+       Threads are started as they are needed, up to max_threads, and then kept for
+       the next connection. When every thread is busy, new connections wait in the
+       queue until a thread is free. When the queue holds max_queued connections
+       too, submit refuses the connection, and the caller turns it away. A burst
+       of connections therefore never starts more than max_threads threads.
+
+       Connections are long-lived, so a thread may not come free for a long time.
+       A connection that has waited max_wait seconds is taken off the queue and
+       handed to on_timeout, which should turn it away as the caller would.
+
+       @method submit: conn -> bool
+           hand a connection to the pool. Returns False if the pool is full.
+
+       @attribute active: int
+           connections being served by a thread.
+
+       @attribute queued: int
+           connections waiting for a thread.
+
+       @attribute accepted: int
+       @attribute rejected: int
+           connections the pool has taken and refused since it was created.
+           Connections that waited too long count as refused.
+
+       @attribute timed_out: int
+           connections that waited max_wait seconds without a thread.
+    '''
+
+    def __init__(self, handler, max_threads: int, max_queued: int, max_wait: float = None, on_timeout=None):
+        self.handler = handler
+        self.max_threads = max_threads
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.on_timeout = on_timeout
+
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.queue_started = threading.Condition(self.lock)
+
+        # (connection, time it stops waiting), oldest first
+        self.waiting = deque()
+        self.threads = 0
+
+        self.active = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+        if max_wait:
+            threading.Thread(target=self.expire, daemon=True).start()
+
+    @property
+    def queued(self) -> int:
+        return len(self.waiting)
+
+    def submit(self, conn) -> bool:
+        with self.lock:
+            if self.active + len(self.waiting) >= self.max_threads + self.max_queued:
+                self.rejected += 1
+                return False
+
+            if not self.waiting:
+                self.queue_started.notify()
+            self.waiting.append((conn, time.monotonic() + (self.max_wait or 0)))
+            self.accepted += 1
+
+            # start a thread unless an idle one can take the connection
+            if len(self.waiting) > self.threads - self.active and self.threads < self.max_threads:
+                self.threads += 1
+                threading.Thread(target=self.work, daemon=True).start()
+            else:
+                self.condition.notify()
+
+            return True
+
+    def work(self):
+        while True:
+            with self.lock:
+                while not self.waiting:
+                    self.condition.wait()
+                conn, _ = self.waiting.popleft()
+                self.active += 1
+
+            try:
+                self.handler(conn)
+            except Exception as e:
+                serverlog.error("connection_handler_failed", error=e)
+            finally:
+                with self.lock:
+                    self.active -= 1
+
+    # Turn away the connections that have waited max_wait seconds. Every
+    # connection waits as long, so the oldest is always the next to expire.
+    def expire(self):
+        while True:
+            expired = []
+            with self.lock:
+                while not self.waiting:
+                    self.queue_started.wait()
+
+                now = time.monotonic()
+                while self.waiting and self.waiting[0][1] <= now:
+                    expired.append(self.waiting.popleft()[0])
+                self.timed_out += len(expired)
+                self.rejected += len(expired)
+
+                if not expired:
+                    self.queue_started.wait(self.waiting[0][1] - now)
+
+            for conn in expired:
+                try:
+                    self.on_timeout(conn)
+                except Exception as e:
+                    serverlog.error("connection_timeout_failed", error=e)
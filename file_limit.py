@@ -0,0 +1,13 @@
+#!/usr/bin/env python3
+
+# Raise the open file limit as far as we are allowed to, since every idle
+# connection holds a file descriptor. The server and the load generator both
+# hold thousands of connections. Does nothing where there is no such limit.
+def raise_file_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+import os
+import socket
+from messages import HEADER_SIZE, INT_STRUCT
+
+# The most buffers one sendmsg call may be given.
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+# The largest frame a client may send, header excluded. The stream cannot be
+# resynchronized after a frame is refused, so the connection is dropped.
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+class FrameDecoder:
+    '''Splits a byte stream into complete wire protocol frames.
+
+       A TCP socket delivers a stream of bytes, not messages: one recv may return
+       half a frame, or the tail of one frame glued to the next few. Each connection
+       owns one FrameDecoder, which keeps whatever has been received but not yet
+       consumed in a persistent receive buffer.
+
+       @method recv_from: sock -> int
+           read whatever is available on sock straight into the receive buffer with
+           recv_into. Returns the number of bytes read; 0 means the peer closed the
+           connection.
+
+       @method feed: data: bytes -> None
+           append bytes that were received some other way.
+
+       @method frames: () -> generator of bytes
+           yield every complete frame in the buffer, header included, in order.
+           Partial frames stay buffered until the rest of their bytes arrive.
+
+       @notes
+           The buffer is a bytearray that is reused across reads. Consumed bytes are
+           only discarded when more room is needed, and the buffer only grows past
+           its initial size to hold a frame that is larger than it. A frame whose
+           header claims more than max_frame_size bytes raises ValueError, since the
+           stream cannot be resynchronized after that.
+    '''
+
+    def __init__(self, buffer_size: int = 65536, max_frame_size: int = MAX_FRAME_SIZE):
+        self.buffer_size = buffer_size
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray(buffer_size)
+
+        # unconsumed bytes live in buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+        # size of the frame at start, once its header has arrived
+        self.frame_size = HEADER_SIZE
+
+    def pending(self) -> int:
+        return self.end - self.start
+
+    # Make sure there is room for at least `needed` bytes after end, first by
+    # discarding consumed bytes, then by growing the buffer.
+    def reserve(self, needed: int):
+        if len(self.buffer) - self.end >= needed:
+            return
+
+        if self.start:
+            del self.buffer[:self.start]
+            self.end -= self.start
+            self.start = 0
+
+        size = max(self.buffer_size, self.end + needed)
+        if len(self.buffer) < size:
+            self.buffer.extend(bytes(size - len(self.buffer)))
+
+    def recv_from(self, sock) -> int:
+        # always leave room for the rest of the current frame, and at least a
+        # reasonable read beyond it
+        self.reserve(max(self.frame_size - self.pending(), self.buffer_size // 4))
+
+        with memoryview(self.buffer) as view:
+            count = sock.recv_into(view[self.end:])
+
+        self.end += count
+        return count
+
+    def feed(self, data: bytes):
+        self.reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def frames(self):
+        while self.pending() >= HEADER_SIZE:
+            # the payload length is the last field of the header
+            length = INT_STRUCT.unpack_from(self.buffer, self.start + 8)[0]
+            if length > self.max_frame_size:
+                raise ValueError("Frame of " + str(length) + " bytes exceeds the maximum frame size.")
+
+            self.frame_size = HEADER_SIZE + length
+            if self.pending() < self.frame_size:
+                return
+
+            with memoryview(self.buffer) as view:
+                frame = bytes(view[self.start:self.start + self.frame_size])
+
+            self.start += self.frame_size
+            self.frame_size = HEADER_SIZE
+            yield frame
+
+        # everything has been consumed, so start over at the front of the buffer,
+        # giving back any space that was grown for an oversized frame
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.buffer_size:
+                del self.buffer[self.buffer_size:]
+
+class OutboundBuffer:
+    '''Gathers the frames written to a socket and sends them with as few system
+       calls as it can.
+
+       Answering a burst of pipelined requests, and delivering the chats they
+       queue, writes many small frames. Written one at a time, each costs a send
+       call, and without TCP_NODELAY may sit behind Nagle's algorithm. Each
+       connection instead writes into one OutboundBuffer, which only holds on to
+       the buffers it is given, and flushes them all with one sendmsg call
+       (writev) once there is nothing more to write for now.
+
+       @method send, sendall: data -> None
+           queue <data>, a bytes-like object, to be sent. It must not be modified
+           until it has been flushed. send returns len(data), as socket.send would.
+
+       @method flush: () -> int
+           send everything queued, blocking as the socket does. Returns the number
+           of sendmsg calls it took; 0 if nothing was queued.
+
+       @method pending: () -> int
+           the number of bytes queued.
+
+       @notes
+           A frame may be given in several parts, such as a header and a body
+           that is shared with other connections, without joining them first. Once
+           more than flush_size bytes are queued they are flushed at once, so a
+           client pipelining many requests holds up no more than that. With
+           <cork>, the socket is corked (TCP_CORK, where there is one) while a
+           flush takes more than one call, so its tail does not go out as a small
+           segment of its own. <before_flush>, if given, is called before
+           anything is sent; the server waits there until the messages its
+           responses answer for are on disk.
+    '''
+
+    def __init__(self, sock, flush_size: int = 65536, cork: bool = False, before_flush=None):
+        self.sock = sock
+        self.flush_size = flush_size
+        self.cork = cork and hasattr(socket, "TCP_CORK")
+        self.before_flush = before_flush
+        self.buffers = []
+        self.size = 0
+
+    def pending(self) -> int:
+        return self.size
+
+    def send(self, data) -> int:
+        self.sendall(data)
+        return len(data)
+
+    def sendall(self, data):
+        if not len(data):
+            return
+        self.buffers.append(data)
+        self.size += len(data)
+
+        if self.size >= self.flush_size:
+            self.flush()
+
+    def flush(self) -> int:
+        if not self.buffers:
+            return 0
+        if self.before_flush:
+            self.before_flush()
+
+        buffers = self.buffers
+        self.buffers = []
+        self.size = 0
+
+        if not hasattr(self.sock, "sendmsg"):
+            self.sock.sendall(b''.join(buffers))
+            return 1
+
+        calls = 0
+        index = 0
+        try:
+            while index < len(buffers):
+                if calls == 1 and self.cork:
+                    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+
+                sent = self.sock.sendmsg(buffers[index:index + IOV_MAX])
+                calls += 1
+
+                # skip what was sent, leaving the rest of a buffer sent in part
+                while index < len(buffers) and sent >= len(buffers[index]):
+                    sent -= len(buffers[index])
+                    index += 1
+                if sent:
+                    buffers[index] = memoryview(buffers[index]).cast("B")[sent:]
+        finally:
+            if calls > 1 and self.cork:
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+
+        return calls
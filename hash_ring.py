@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+import bisect
+import hashlib
+
+class HashRing:
+    '''A consistent-hash ring that assigns keys (usernames and channel names) to
+       nodes.
+
+       Every node is placed on the ring at <replicas> points, and a key belongs to
+       the first node point at or after the key's own point, wrapping around.
+       Adding a node only takes over the keys that fall just before its points,
+       about 1/n of them, and removing one only moves its own keys, where hashing
+       modulo the number of nodes would move nearly every key.
+
+       @method owner: key: str -> str
+           the node that owns <key>.
+
+       @notes
+           Points come from md5, not hash(), so every node, and every run, places
+           nodes and keys at the same points.
+    '''
+
+    def __init__(self, nodes, replicas: int = 100):
+        self.nodes = sorted(set(nodes))
+
+        points = sorted((self.point(node + "#" + str(i)), node)
+                        for node in self.nodes for i in range(replicas))
+        self.points = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    @staticmethod
+    def point(key: str) -> int:
+        return int.from_bytes(hashlib.md5(str.encode(key)).digest()[:8], "big")
+
+    def owner(self, key: str) -> str:
+        i = bisect.bisect_left(self.points, self.point(key))
+        return self.owners[i % len(self.owners)]
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+
+'''
+    a load generator for the chat server. it connects thousands of simulated
+    users, each on its own connection, and has them send chats to each other,
+    list the users, go away and come back, and drain their backlogs, then reports
+    throughput, end-to-end delivery latency and errors. chats to users who are
+    away are queued for later, so the drains have backlogs to fetch.
+
+        python3 loadgen.py -users 2000 -mode open -rate 5000 -duration 30
+        python3 loadgen.py -users 2000 -mode closed -think 0.1
+
+    in closed-loop mode every user waits for the server to answer each operation
+    (and then thinks for -think seconds, on average) before starting the next,
+    so the load falls as the server slows down. in open-loop mode operations
+    start at a fixed total -rate, at random like independent clients would,
+    whether or not earlier ones have finished.
+
+    every chat carries the time it was meant to be sent, and its recipient
+    measures the latency from then. in open-loop mode a stalled server therefore
+    shows up in the latency, instead of only delaying the sends.
+'''
+
+import argparse
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from messages import *
+from metrics import Histogram
+from file_limit import raise_file_limit
+
+# Sent behind every request, as by async_client.
+PING_FRAME = bytes(PingMessage().serialize())
+
+# Operations a simulated user can perform. A user that goes away comes back
+# "here" on its own, after a while.
+CHAT = "chat"
+LIST = "list"
+DRAIN = "drain"
+AWAY = "away"
+HERE = "here"
+
+class LoadStats:
+    '''What the simulated users saw, shared by all of them.
+
+       @attribute sent: dict[str, int]
+           operations started, by operation.
+
+       @attribute delivered: int
+           chats of this run received, live or from a backlog drain.
+
+       @attribute latency: Histogram
+           nanoseconds from when each delivered chat was meant to be sent until it
+           arrived.
+
+       @attribute response: Histogram
+           nanoseconds from when each operation was meant to start until the server
+           answered it. Chats are answered by a Ping sent right behind them, and
+           only in closed-loop mode.
+
+       @attribute errors: dict[str, int]
+           ErrorMessages received, by text.
+
+       @attribute disconnects: int
+           connections the server closed.
+    '''
+
+    def __init__(self, run: str):
+        self.run = run
+        self.sent = {CHAT: 0, LIST: 0, DRAIN: 0, AWAY: 0, HERE: 0}
+        self.delivered = 0
+        self.latency = Histogram()
+        self.response = Histogram()
+        self.errors = {}
+        self.disconnects = 0
+
+    # The body of a chat meant to be sent at <intended> (perf_counter_ns),
+    # padded to <size> characters.
+    def chat_body(self, intended: int, size: int) -> str:
+        stamp = self.run + ":" + str(intended) + " "
+        return stamp + "x" * max(size - len(stamp), 0)
+
+    # Record the latency of every chat of this run in <message_list>. Chats from
+    # other runs, left in a backlog, are not counted.
+    def record_delivered(self, message_list):
+        now = time.perf_counter_ns()
+        for sender, body in message_list:
+            run, _, rest = body.partition(":")
+            if run == self.run:
+                self.delivered += 1
+                self.latency.record(now - int(rest.split(" ", 1)[0]))
+
+    def record_error(self, error_message: str):
+        self.errors[error_message] = self.errors.get(error_message, 0) + 1
+
+class LoadUser:
+    '''One simulated user, with its own connection to the server.
+
+       Every request is sent with a Ping behind it, as async_client does. The
+       server answers in order, so whatever arrives between a request and its
+       Pong, errors included, answers that request, and the Pong resolves the
+       request's future. Deliveries can arrive at any time, and go to the stats,
+       as do all errors.
+
+       @method send: message -> None
+           send a request without waiting for it to be answered.
+
+       @method request: message -> list[Message]
+           send a request, or nothing but the Ping, and wait for the answers.
+
+       @attribute away: bool
+           True from when the user chooses to go away until it is "here" again.
+    '''
+
+    def __init__(self, name: str, stats: LoadStats):
+        self.name = name
+        self.stats = stats
+        self.waiting = deque()
+        self.writer = None
+        self.away = False
+
+        # confirms the last page of undelivered chats, as in async_client
+        self.page_cursor = 0
+
+    async def connect(self, host, port):
+        reader, self.writer = await asyncio.open_connection(host, port)
+        self.reader_task = asyncio.create_task(self.read_loop(reader))
+
+    def send(self, message):
+        self.writer.write(message.serialize())
+
+    async def request(self, message=None):
+        future = asyncio.get_running_loop().create_future()
+        answers = []
+        self.waiting.append((future, answers))
+        self.writer.write((message.serialize() if message else b"") + PING_FRAME)
+
+        await future
+        return answers
+
+    async def read_loop(self, reader):
+        try:
+            while True:
+                header = await reader.readexactly(HEADER_SIZE)
+                message = deserialize_message(header + await reader.readexactly(extract_length(header)))
+                message_type = type(message)
+
+                if message_type == DeliverMessage:
+                    self.stats.record_delivered(message.message_list)
+                elif message_type == ErrorMessage:
+                    self.stats.record_error(message.error_message)
+                    if self.waiting:
+                        self.waiting[0][1].append(message)
+                elif message_type == SessionMessage:
+                    # simulated users do not resume their sessions
+                    pass
+                elif message_type == PingMessage:
+                    # a heartbeat, for a user that has been idle
+                    self.send(PongMessage())
+                elif message_type == PongMessage:
+                    if self.waiting:
+                        self.waiting.popleft()[0].set_result(None)
+                else:
+                    if message_type == UndeliveredPageMessage:
+                        self.stats.record_delivered(message.message_list)
+                        self.page_cursor = message.next_cursor
+                    if self.waiting:
+                        self.waiting[0][1].append(message)
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.stats.disconnects += 1
+        finally:
+            while self.waiting:
+                self.waiting.popleft()[0].set_exception(ConnectionError("Connection closed by server."))
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+# Pick the next operation, according to the mix given on the command line.
+def choose_operation(args):
+    r = random.random()
+    if r < args.list_ratio:
+        return LIST
+    if r < args.list_ratio + args.drain_ratio:
+        return DRAIN
+    if r < args.list_ratio + args.drain_ratio + args.away_ratio:
+        return AWAY
+    return CHAT
+
+# Pick a random user who is "here", or None if a few tries find only users who
+# are away.
+def choose_user(users):
+    for _ in range(10):
+        user = random.choice(users)
+        if not user.away:
+            return user
+    return None
+
+# Have <user> perform <operation>, meant to start at <intended>. If <wait>,
+# return once the server has answered it. A user who goes away comes back by
+# <deadline> at the latest.
+async def run_operation(user, operation, users, args, stats, intended, deadline, wait):
+    stats.sent[operation] += 1
+
+    try:
+        if operation == CHAT:
+            target = random.choice(users)
+            while target is user and len(users) > 1:
+                target = random.choice(users)
+            chat = SendChatMessage(target.name, stats.chat_body(intended, args.body_size))
+            if not wait:
+                user.send(chat)
+                return
+            await user.request(chat)
+        elif operation == LIST:
+            await user.request(RequestUserListMessage())
+        elif operation == DRAIN:
+            await user.request(RequestUndeliveredPageMessage(user.page_cursor, args.page_size))
+        else:
+            # log out, stay away for a while and log in again. chats sent to
+            # the user meanwhile wait in its backlog.
+            user.away = True
+            await user.request(AwayMessage())
+            stats.response.record(time.perf_counter_ns() - intended)
+
+            if args.away_time:
+                await asyncio.sleep(min(random.expovariate(1 / args.away_time), max(deadline - time.perf_counter(), 0)))
+            stats.sent[HERE] += 1
+            intended = time.perf_counter_ns()
+            await user.request(HereMessage(user.name))
+            user.away = False
+
+        stats.response.record(time.perf_counter_ns() - intended)
+    except ConnectionError:
+        pass
+
+# Each user performs one operation after another until <deadline>, pausing for
+# a random think time in between.
+async def closed_loop(user, users, args, stats, deadline):
+    while time.perf_counter() < deadline and not user.writer.is_closing():
+        await run_operation(user, choose_operation(args), users, args, stats, time.perf_counter_ns(), deadline, wait=True)
+        if args.think:
+            await asyncio.sleep(random.expovariate(1 / args.think))
+
+# Operations start at random times, -rate per second in all, each by a random
+# user. An operation that is due is started even if the ones before it have not
+# finished, and if the generator falls behind it starts every overdue operation
+# at once rather than lowering the rate.
+async def open_loop(users, args, stats, deadline):
+    tasks = set()
+    due = time.perf_counter()
+
+    while due < deadline:
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        while due <= time.perf_counter() and due < deadline:
+            user = choose_user(users)
+            if user:
+                # a user going away is away from now on, so that no operation
+                # started after this one is given to them
+                operation = choose_operation(args)
+                user.away = operation == AWAY
+                task = asyncio.create_task(run_operation(user, operation, users, args, stats, int(due * 1e9), deadline,
+                                                         wait=False))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            due += random.expovariate(args.rate)
+
+    if tasks:
+        await asyncio.wait(tasks, timeout=args.grace)
+    for task in tasks:
+        task.cancel()
+
+# Connect and create an account for every user, at most <args.connect_batch>
+# at a time. Returns the users that are ready.
+async def set_up(args, stats):
+    users = [LoadUser(args.prefix + str(i), stats) for i in range(args.users)]
+    limit = asyncio.Semaphore(args.connect_batch)
+
+    async def start(user):
+        async with limit:
+            try:
+                await user.connect(args.ip, args.port)
+                answers = await user.request(CreateAccountMessage(user.name))
+            except OSError as e:
+                stats.record_error("Could not connect: " + str(e))
+                return False
+
+            # e.g. the account is left over from a run with -keep
+            if any(type(answer) == ErrorMessage for answer in answers):
+                user.close()
+                return False
+            return True
+
+    ready = await asyncio.gather(*(start(user) for user in users))
+    return [user for user, ok in zip(users, ready) if ok]
+
+async def tear_down(users, args):
+    for user in users:
+        if not args.keep and not user.writer.is_closing():
+            # only a user who is "here" can delete their account
+            if user.away:
+                user.send(HereMessage(user.name))
+            user.send(DeleteAccountMessage())
+    for user in users:
+        if not user.writer.is_closing():
+            try:
+                await user.request()
+            except ConnectionError:
+                pass
+        user.close()
+
+def milliseconds(nanoseconds):
+    return "%.2f" % (nanoseconds / 1e6)
+
+def report(args, stats, users, elapsed):
+    print("mode " + args.mode + ", " + str(len(users)) + " of " + str(args.users) + " users connected, " +
+          "%.1f" % elapsed + " s")
+
+    print("".join(column.rjust(14) for column in ["operation", "started", "per second"]))
+    for operation, count in stats.sent.items():
+        print("".join(column.rjust(14) for column in [operation, str(count), "%.0f" % (count / elapsed)]))
+    print("".join(column.rjust(14) for column in ["delivered", str(stats.delivered), "%.0f" % (stats.delivered / elapsed)]))
+
+    print("".join(column.rjust(14) for column in ["latency (ms)", "p50", "p99", "p999", "max"]))
+    for name, histogram in [("delivery", stats.latency), ("response", stats.response)]:
+        if histogram.count:
+            print("".join(column.rjust(14) for column in
+                          [name] + [milliseconds(histogram.percentile(q)) for q in [0.5, 0.99, 0.999]] +
+                          [milliseconds(histogram.max)]))
+
+    operations = sum(stats.sent.values())
+    errors = sum(stats.errors.values())
+    print("errors " + str(errors) + " (" + "%.3f" % (100 * errors / max(operations, 1)) + "% of operations), " +
+          "disconnects " + str(stats.disconnects))
+    for error_message, count in sorted(stats.errors.items(), key=lambda item: -item[1])[:5]:
+        print("  " + str(count) + " x " + error_message)
+
+async def main(args):
+    raise_file_limit()
+    stats = LoadStats(os.urandom(4).hex())
+
+    users = await set_up(args, stats)
+    if not users:
+        print("No users could connect to " + args.ip + ":" + str(args.port) + ".")
+        for error_message, count in stats.errors.items():
+            print("  " + str(count) + " x " + error_message)
+        return
+
+    start = time.perf_counter()
+    deadline = start + args.duration
+
+    if args.mode == "closed":
+        await asyncio.gather(*(closed_loop(user, users, args, stats, deadline) for user in users))
+    else:
+        await open_loop(users, args, stats, deadline)
+    elapsed = time.perf_counter() - start
+
+    # let chats still in flight arrive before counting them
+    await asyncio.sleep(args.grace)
+    report(args, stats, users, elapsed)
+
+    await tear_down(users, args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-ip", help="Server IP address. Defaults to localhost.", default="localhost")
+    parser.add_argument("-port", help="Server port. Defaults to 12345.", type=int, default=12345)
+    parser.add_argument("-mode", help="Closed loop: each user waits for an answer before its next operation. Open loop: "
+                        "operations start at a fixed -rate. Defaults to closed.", choices=["closed", "open"],
+                        default="closed")
+    parser.add_argument("-users", help="Simulated users, each with its own connection. Defaults to 1000.",
+                        type=int, default=1000)
+    parser.add_argument("-rate", help="Operations per second in open-loop mode, across all users. Defaults to 1000.",
+                        type=float, default=1000)
+    parser.add_argument("-think", help="Mean seconds a user waits between operations in closed-loop mode. "
+                        "Defaults to 0.", type=float, default=0)
+    parser.add_argument("-duration", help="Seconds to generate load for. Defaults to 10.", type=float, default=10)
+    parser.add_argument("-grace", help="Seconds to wait for deliveries still in flight at the end. Defaults to 2.",
+                        type=float, default=2)
+    parser.add_argument("-body_size", help="Chat body size in characters. Defaults to 100.", type=int, default=100)
+    parser.add_argument("-list_ratio", help="Fraction of operations that list all users. Defaults to 0.01.",
+                        type=float, default=0.01)
+    parser.add_argument("-drain_ratio", help="Fraction of operations that drain a page of the user's backlog. "
+                        "Defaults to 0.05.", type=float, default=0.05)
+    parser.add_argument("-away_ratio", help="Fraction of operations where the user goes away, and later comes back "
+                        "\"here\". Defaults to 0.02.", type=float, default=0.02)
+    parser.add_argument("-away_time", help="Mean seconds a user stays away. Defaults to 1.", type=float, default=1)
+    parser.add_argument("-page_size", help="Messages per backlog page. Defaults to 100.", type=int, default=100)
+    parser.add_argument("-prefix", help="Prefix of the simulated usernames. Give each of several concurrent "
+                        "load generators its own. Defaults to load.", default="load")
+    parser.add_argument("-connect_batch", help="Connections opened at once while setting up. Defaults to 200.",
+                        type=int, default=200)
+    parser.add_argument("-keep", help="Keep the simulated accounts afterwards, instead of deleting them.",
+                        action="store_true")
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import threading
+import time
+import zlib
+from messages import pack_int, pack_string, unpack_int_at, unpack_string_at
+
+# Record kinds
+MESSAGE_RECORD = 1   # recipient, sender, body: a message was queued for later
+DRAIN_RECORD   = 2   # recipient, count: the oldest <count> queued messages were delivered
+DELETE_RECORD  = 3   # recipient: the account and all of its queued messages are gone
+
+# Every record is framed with its length and a CRC32 of its contents, so a torn
+# write at the end of the log is detected on replay instead of misparsed.
+RECORD_HEADER = struct.Struct("<II")
+
+class MessageLog:
+    '''An append-only, crash-safe log of the messages waiting in users' deliver_later
+       queues.
+
+       Every message queued for an "away" user is appended as a record, and every
+       drain and account deletion is recorded too, so replaying the log after a
+       restart rebuilds exactly the messages that were still undelivered.
+
+       Appends are group committed. Callers hand records to the log and return
+       immediately; a background flusher thread writes everything that accumulated
+       with one write and one fsync. The flusher waits commit_interval seconds after
+       the first record of a group arrives, so under load many sends share each
+       fsync. Durability therefore costs one fsync per commit interval rather than
+       one per SendChatMessage. The server answers a client only once the
+       messages its requests queued are committed (see last_logged and
+       on_commit), so a crash loses no message whose send was answered.
+
+       Compaction rewrites the log down to the messages still pending, on start
+       and again whenever the log has grown past compact_size and to twice its
+       size after the last compaction, so it does not grow without bound while
+       the server runs.
+
+       Callers are responsible for appending records in the same order as the
+       queue operations they describe; UserState does this under each user's
+       later_lock.
+
+       @method log_message: recipient, sender, body -> int
+       @method log_drain: recipient, count -> int
+       @method log_delete: recipient -> int
+           append a record and return its log sequence number (lsn).
+
+       @method last_logged: () -> int
+           the lsn of the last message this thread logged, or 0.
+
+       @method wait_for_commit: lsn -> None
+           block until the record with this lsn is on disk.
+
+       @method on_commit: lsn, callback -> None
+           call <callback>, on the flusher thread, once the record with this lsn
+           is on disk; at once if it already is.
+
+       @method replay: () -> dict[str, list[(str, str)]]
+           read the log from the start and return each recipient's pending
+           messages, oldest first. A torn or corrupt tail is discarded. Must be
+           called before start().
+
+       @method start: () -> None
+           compact the log down to the pending messages and start the flusher.
+    '''
+
+    def __init__(self, path: str, commit_interval: float = 0.01, compact_size: int = 64 * 1024 * 1024):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.compact_size = compact_size
+
+        # state shared with the flusher thread
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.pending = []
+        self.appended = 0
+        self.committed = 0
+        self.closed = False
+
+        # callbacks waiting for their records to be committed, as (lsn, callback)
+        self.waiters = []
+
+        # the lsn of the last message each thread logged
+        self.local = threading.local()
+
+        self.recovered = {}
+        self.file = None
+        self.flusher = None
+        self.compacted_size = 0
+
+        # statistics for benchmarks
+        self.commits = 0
+        self.compactions = 0
+
+    def log_message(self, recipient: str, sender: str, body: str) -> int:
+        lsn = self.append(pack_int(MESSAGE_RECORD) + pack_string(recipient) +
+                          pack_string(sender) + pack_string(body))
+        self.local.lsn = lsn
+        return lsn
+
+    def last_logged(self) -> int:
+        return getattr(self.local, "lsn", 0)
+
+    def log_drain(self, recipient: str, count: int) -> int:
+        return self.append(pack_int(DRAIN_RECORD) + pack_string(recipient) + pack_int(count))
+
+    def log_delete(self, recipient: str) -> int:
+        return self.append(pack_int(DELETE_RECORD) + pack_string(recipient))
+
+    def append(self, record: bytes) -> int:
+        framed = RECORD_HEADER.pack(len(record), zlib.crc32(record)) + record
+
+        with self.lock:
+            self.pending.append(framed)
+            self.appended += 1
+
+            # only the first record of a group needs to wake the flusher
+            if len(self.pending) == 1:
+                self.condition.notify_all()
+
+            return self.appended
+
+    def wait_for_commit(self, lsn: int):
+        if self.committed >= lsn:
+            return
+
+        with self.lock:
+            while self.committed < lsn and not self.closed:
+                self.condition.wait()
+
+    def on_commit(self, lsn: int, callback):
+        with self.lock:
+            if self.committed < lsn and not self.closed:
+                self.waiters.append((lsn, callback))
+                return
+        callback()
+
+    def replay(self) -> dict:
+        pending = {}
+
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            length, checksum = RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            record = data[start:start + length]
+
+            # anything after a torn or corrupt record was never committed
+            if len(record) < length or zlib.crc32(record) != checksum:
+                break
+
+            kind, position = unpack_int_at(record, 0)
+            recipient, position = unpack_string_at(record, position)
+
+            if kind == MESSAGE_RECORD:
+                sender, position = unpack_string_at(record, position)
+                body, position = unpack_string_at(record, position)
+                pending.setdefault(recipient, []).append((sender, body))
+            elif kind == DRAIN_RECORD:
+                count, position = unpack_int_at(record, position)
+                del pending.get(recipient, [])[:count]
+            elif kind == DELETE_RECORD:
+                pending.pop(recipient, None)
+
+            offset = start + length
+
+        self.recovered = {recipient: messages for recipient, messages in pending.items() if messages}
+        return self.recovered
+
+    # Rewrite the log with only the pending messages, so it does not grow
+    # without bound across restarts. The new log is written beside the old one
+    # and renamed over it, so a crash during compaction loses nothing.
+    def compact(self):
+        temp_path = self.path + ".compact"
+
+        with open(temp_path, "wb") as f:
+            for recipient, messages in self.recovered.items():
+                for sender, body in messages:
+                    record = pack_int(MESSAGE_RECORD) + pack_string(recipient) + \
+                             pack_string(sender) + pack_string(body)
+                    f.write(RECORD_HEADER.pack(len(record), zlib.crc32(record)) + record)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(temp_path, self.path)
+        self.recovered = {}
+
+    def start(self):
+        self.compact()
+        self.file = open(self.path, "ab")
+        self.compacted_size = os.fstat(self.file.fileno()).st_size
+        self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flusher.start()
+
+    # Compact the log again once it has grown past compact_size and to twice
+    # its size after the last compaction. This runs on the flusher thread
+    # between commits, so everything in the file is committed and nothing else
+    # writes to it; records appended meanwhile wait for the next commit.
+    def compact_if_grown(self):
+        if self.file.tell() < max(self.compact_size, 2 * self.compacted_size):
+            return
+
+        self.file.close()
+        self.replay()
+        self.compact()
+        self.file = open(self.path, "ab")
+        self.compacted_size = os.fstat(self.file.fileno()).st_size
+        self.compactions += 1
+
+    def flush_loop(self):
+        while True:
+            with self.lock:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+
+            # let the rest of the group arrive
+            if self.commit_interval:
+                time.sleep(self.commit_interval)
+
+            with self.lock:
+                batch, self.pending = self.pending, []
+                lsn = self.appended
+
+            self.file.write(b''.join(batch))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+            with self.lock:
+                self.committed = lsn
+                self.commits += 1
+                self.condition.notify_all()
+                ready = [callback for waiting, callback in self.waiters if waiting <= lsn]
+                self.waiters = [waiter for waiter in self.waiters if waiter[0] > lsn]
+
+            for callback in ready:
+                callback()
+
+            self.compact_if_grown()
+
+    # Commit everything appended so far and stop the flusher.
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.condition.notify_all()
+
+        if self.flusher:
+            self.flusher.join()
+            self.file.close()
+
+        # nothing more will be committed
+        with self.lock:
+            ready, self.waiters = self.waiters, []
+        for _, callback in ready:
+            callback()
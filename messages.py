@@ -7,6 +7,8 @@ PROTOCOL_VERSION_NUMBER      = 1
 # Diagnostic Message IDs
 PING_MESSAGE_ID              = 0
 PONG_MESSAGE_ID              = 9
+STATS_REQUEST_ID             = 19
+STATS_RESPONSE_ID            = 20
 
 # Client Message IDs
 HERE_MESSAGE_ID              = 1
@@ -16,24 +18,115 @@ SEND_CHAT_MESSAGE_ID         = 4
 REQUEST_USER_LIST_MESSAGE_ID = 5
 DELETE_ACCOUNT_MESSAGE_ID    = 6
 SHOW_UNDELIVERED_MESSAGE_ID  = 7
+REQUEST_UNDELIVERED_PAGE_ID  = 8
+SEARCH_USERS_MESSAGE_ID      = 14
+JOIN_CHANNEL_MESSAGE_ID      = 16
+LEAVE_CHANNEL_MESSAGE_ID     = 17
+SEND_CHANNEL_MESSAGE_ID      = 18
+ACK_MESSAGE_ID               = 21
+RESUME_MESSAGE_ID            = 22
 
 # Server Message IDs
 DELIVER_MESSAGE_ID           = 10
 USER_LIST_RESPONSE_ID        = 11
 ERROR_MESSAGE_ID             = 12
+UNDELIVERED_PAGE_ID          = 13
+USER_PAGE_RESPONSE_ID        = 15
+SESSION_MESSAGE_ID           = 23
+
+# Messages between server processes, never sent to or by clients. Every type
+# from FIRST_PEER_MESSAGE_ID up is one of these, and is only deserialized when
+# read from another server process.
+FIRST_PEER_MESSAGE_ID        = 100
+FORWARD_REQUEST_ID           = 100
+FORWARD_RESPONSE_ID          = 101
+PUSH_MESSAGE_ID              = 102
+FAN_OUT_MESSAGE_ID           = 103
+LEAVE_CHANNELS_MESSAGE_ID    = 104
+NODE_HELLO_MESSAGE_ID        = 105
+HANDOFF_USER_MESSAGE_ID      = 106
+HANDOFF_CHANNEL_MESSAGE_ID   = 107
+DETACH_MESSAGE_ID            = 108
+CLOSE_SESSION_MESSAGE_ID     = 109
 
 # Packing/unpacking helpers
 
+# Precompiled layouts for the fixed-size fields: a single little-endian 4 byte
+# integer, and the 12 byte header (version, message type, payload length).
+INT_STRUCT = struct.Struct("<I")
+HEADER_STRUCT = struct.Struct("<III")
+HEADER_SIZE = HEADER_STRUCT.size
+
 # Pack an int into a byte array.
 def pack_int(val):
-    return struct.Struct("<I").pack(val)
+    return INT_STRUCT.pack(val)
 
 # Pack a string with its length into a byte array.
+# The length is the length of the UTF-8 encoding, not the number of characters.
 def pack_string(val):
-    return pack_int(len(val)) + str.encode(val)
+    encoded = str.encode(val)
+    return pack_int(len(encoded)) + encoded
+
+# Number of bytes pack_string(val) produces. ASCII strings, the common case,
+# are measured without encoding them.
+def string_size(val):
+    return 4 + (len(val) if val.isascii() else len(str.encode(val)))
+
+# Write an int into a preallocated buffer at <offset>.
+# Returns the offset just past it.
+def pack_int_into(buffer, offset, val):
+    INT_STRUCT.pack_into(buffer, offset, val)
+    return offset + 4
+
+# Write a string with its length into a preallocated buffer at <offset>.
+# Returns the offset just past it.
+def pack_string_into(buffer, offset, val):
+    encoded = str.encode(val)
+    INT_STRUCT.pack_into(buffer, offset, len(encoded))
+    offset += 4
+    buffer[offset:offset + len(encoded)] = encoded
+    return offset + len(encoded)
+
+# Number of bytes pack_bytes_into(buffer, offset, val) writes.
+def bytes_size(val):
+    return 4 + len(val)
+
+# Write raw bytes with their length into a preallocated buffer at <offset>.
+# Returns the offset just past them.
+def pack_bytes_into(buffer, offset, val):
+    INT_STRUCT.pack_into(buffer, offset, len(val))
+    offset += 4
+    buffer[offset:offset + len(val)] = val
+    return offset + len(val)
+
+# Unpack a 4 byte integer at <offset> in a buffer.
+# Returns the integer and the offset just past it.
+def unpack_int_at(buf, offset):
+    return INT_STRUCT.unpack_from(buf, offset)[0], offset + 4
+
+# Unpack a string in our encoding at <offset> in a buffer.
+# Returns the string and the offset just past it.
+# buf may be bytes or a memoryview; either way nothing but the string itself
+# is copied, so decoding a message is linear in its size.
+def unpack_string_at(buf, offset):
+    length, offset = unpack_int_at(buf, offset)
+    end = offset + length
+    if end > len(buf):
+        raise ValueError("String runs past the end of the buffer.")
+    return str(buf[offset:end], "utf-8"), end
+
+# Unpack raw bytes written by pack_bytes_into at <offset> in a buffer.
+# Returns a copy of the bytes and the offset just past them.
+def unpack_bytes_at(buf, offset):
+    length, offset = unpack_int_at(buf, offset)
+    end = offset + length
+    if end > len(buf):
+        raise ValueError("Bytes run past the end of the buffer.")
+    return bytes(buf[offset:end]), end
 
 # Unpack a 4 byte integer off of the front of a byte array.
 # Returns the integer and the rest of the message.
+# Note that returning the rest copies it. Deserializers use unpack_int_at.
 def unpack_int(buf):
     num = struct.unpack("<I", buf[:4])
     return num[0], buf[4:]
@@ -49,7 +142,11 @@ def unpack_string(buf):
 
 # Extracts the length of a message, given at *least* its first 12 bytes.
 def extract_length(buf):
-    return struct.unpack("<I", buf[8:12])[0]
+    return INT_STRUCT.unpack_from(buf, 8)[0]
+
+# Extracts the type of a message, given at *least* its first 12 bytes.
+def extract_type(buf):
+    return INT_STRUCT.unpack_from(buf, 4)[0]
 
 # Base message abstract class
 # This can never be instantiated, but every message class extends this type.
@@ -64,20 +161,46 @@ class Message(ABC):
     def pack_header(self) -> bytes:
         return pack_int(PROTOCOL_VERSION_NUMBER) + pack_int(self.message_type)
 
-    # Every Message subclass must provide a way to serialize its payload,
-    # that is, everything after the first 12 bytes (header and length.
+    # Every Message subclass must provide the size of its payload, that is,
+    # everything after the first 12 bytes (header and length), and a way to
+    # write that payload into a preallocated buffer at <offset>, returning the
+    # offset just past it.
     # In many messages that just send integer flags, the payload is empty and
     # inherited from here.
-    def serialize_payload(self) -> int:
-        return b'' # no payload
+    def payload_size(self) -> int:
+        return 0 # no payload
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        return offset
 
-    # To serialize a message, we serialize its payload (which varies by message type)
-    # and then pack it with the standard header and its length.
+    # The payload on its own, mostly useful for testing.
+    def serialize_payload(self) -> bytes:
+        buffer = bytearray(self.payload_size())
+        self.serialize_payload_into(buffer, 0)
+        return bytes(buffer)
+
+    # Total size of the message on the wire.
+    def frame_size(self) -> int:
+        return HEADER_SIZE + self.payload_size()
+
+    # Write the whole message, header included, into a preallocated buffer
+    # (a bytearray or writable memoryview) at <offset>. Returns the offset just
+    # past the message. The payload is sized once and written in place, so
+    # messages carrying long lists serialize in linear time.
+    def serialize_into(self, buffer, offset : int = 0) -> int:
+        size = self.payload_size()
+        HEADER_STRUCT.pack_into(buffer, offset, PROTOCOL_VERSION_NUMBER, self.message_type, size)
+        return self.serialize_payload_into(buffer, offset + HEADER_SIZE)
+
+    # To serialize a message, we size it, allocate one buffer, and write the
+    # header, length and payload (which varies by message type) into it.
     # This is called on any message to return the bytes that should be sent
-    # over the wire.
-    def serialize(self) -> bytes:
-        payload = self.serialize_payload()
-        return self.pack_header() + pack_int(len(payload)) + payload
+    # over the wire. The result is a bytearray, which is accepted anywhere bytes
+    # are, and saves copying the frame a second time.
+    def serialize(self) -> bytearray:
+        buffer = bytearray(self.frame_size())
+        self.serialize_into(buffer, 0)
+        return buffer
 
     # For testing and validation, we want to be able to compare any two messages
     def __eq__(self, obj):
@@ -91,6 +214,35 @@ class PingMessage(Message):
 class PongMessage(Message):
     message_type = PONG_MESSAGE_ID
 
+# Asks the server for its metrics. Answered with a StatsResponseMessage.
+class StatsRequestMessage(Message):
+    message_type = STATS_REQUEST_ID
+
+# Reply to StatsRequestMessage
+# <report> holds one "name value" line per metric, as served by the server's
+# plaintext stats endpoint.
+class StatsResponseMessage(Message):
+    message_type = STATS_RESPONSE_ID
+
+    def __init__(self, report : str):
+        self.report = report
+
+    @classmethod
+    def deserialize(cls, raw : bytes) -> Message:
+        report, _ = unpack_string_at(raw, 0)
+        return cls(report)
+
+    def payload_size(self) -> int:
+        return string_size(self.report)
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        return pack_string_into(buffer, offset, self.report)
+
+    def __eq__(self, obj):
+        return type(self) == type(obj) and \
+               self.message_type == obj.message_type and \
+               self.report == obj.report
+
 # The following are essages that the client can send to the server.
 
 # Indicates that <username> wants to log in.
@@ -102,11 +254,14 @@ class HereMessage(Message):
 
     @classmethod
     def deserialize(cls, raw : bytes) -> Message:
-        username, _ = unpack_string(raw)
+        username, _ = unpack_string_at(raw, 0)
         return cls(username)
 
-    def serialize_payload(self) -> bytes:
-        return pack_string(self.username)
+    def payload_size(self) -> int:
+        return string_size(self.username)
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        return pack_string_into(buffer, offset, self.username)
 
     def __eq__(self, obj):
         return type(self) == type(obj) and \
@@ -122,11 +277,14 @@ class CreateAccountMessage(Message):
 
     @classmethod
     def deserialize(cls, raw : bytes) -> Message:
-        username, _ = unpack_string(raw)
+        username, _ = unpack_string_at(raw, 0)
         return cls(username)
 
-    def serialize_payload(self) -> bytes:
-        return pack_string(self.username)
+    def payload_size(self) -> int:
+        return string_size(self.username)
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        return pack_string_into(buffer, offset, self.username)
 
     def __eq__(self, obj):
         return type(self) == type(obj) and \
@@ -147,18 +305,78 @@ class SendChatMessage(Message):
 
     @classmethod
     def deserialize(cls, raw : bytes) -> Message:
-        username, rest = unpack_string(raw)
-        body, _ = unpack_string(rest)
+        username, offset = unpack_string_at(raw, 0)
+        body, _ = unpack_string_at(raw, offset)
         return cls(username, body)
 
-    def serialize_payload(self) -> bytes:
-        return pack_string(self.username) + pack_string(self.body)
+    def payload_size(self) -> int:
+        return string_size(self.username) + string_size(self.body)
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        offset = pack_string_into(buffer, offset, self.username)
+        return pack_string_into(buffer, offset, self.body)
 
     def __eq__(self, obj):
         return type(self) == type(obj) and \
                self.message_type == obj.message_type and \
                self.body == obj.body
 
+# Join the channel named <channel>, creating it if it does not exist.
+# Channel names start with "#".
+class JoinChannelMessage(Message):
+    message_type = JOIN_CHANNEL_MESSAGE_ID
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    @classmethod
+    def deserialize(cls, raw : bytes) -> Message:
+        channel, _ = unpack_string_at(raw, 0)
+        return cls(channel)
+
+    def payload_size(self) -> int:
+        return string_size(self.channel)
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        return pack_string_into(buffer, offset, self.channel)
+
+    def __eq__(self, obj):
+        return type(self) == type(obj) and \
+               self.message_type == obj.message_type and \
+               self.channel == obj.channel
+
+# Leave the channel named <channel>.
+class LeaveChannelMessage(JoinChannelMessage):
+    message_type = LEAVE_CHANNEL_MESSAGE_ID
+
+# Send <body> to every other member of <channel>. Members receive it as a
+# chat whose sender is "<channel>/<sender>".
+class SendChannelMessage(Message):
+    message_type = SEND_CHANNEL_MESSAGE_ID
+
+    def __init__(self, channel, body):
+        self.channel = channel
+        self.body = body
+
+    @classmethod
+    def deserialize(cls, raw : bytes) -> Message:
+        channel, offset = unpack_string_at(raw, 0)
+        body, _ = unpack_string_at(raw, offset)
+        return cls(channel, body)
+
+    def payload_size(self) -> int:
+        return string_size(self.channel) + string_size(self.body)
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        offset = pack_string_into(buffer, offset, self.channel)
+        return pack_string_into(buffer, offset, self.body)
+
+    def __eq__(self, obj):
+        return type(self) == type(obj) and \
+               self.message_type == obj.message_type and \
+               self.channel == obj.channel and \
+               self.body == obj.body
+
 # Server will reply with a UserListResponseMessage
 class RequestUserListMessage(Message):
     message_type = REQUEST_USER_LIST_MESSAGE_ID
@@ -167,44 +385,236 @@ class RequestUserListMessage(Message):
 class DeleteAccountMessage(Message):
     message_type = DELETE_ACCOUNT_MESSAGE_ID
 
+# Acknowledges every numbered chat up to and including <sequence>, so the
+# server can stop holding them for retransmission. Acknowledgments are
+# cumulative, so a client only needs to send one now and then. The first one
+# after logging in also asks the server to send again every chat after
+# <sequence> it sent before, which the client may not have received.
+# The server does not reply.
+class AckMessage(Message):
+    message_type = ACK_MESSAGE_ID
+
+    def __init__(self, sequence : int):
+        self.sequence = sequence
+
+    @classmethod
+    def deserialize(cls, raw : bytes) -> Message:
+        sequence, _ = unpack_int_at(raw, 0)
+        return cls(sequence)
+
+    def payload_size(self) -> int:
+        return 4
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        return pack_int_into(buffer, offset, self.sequence)
+
+    def __eq__(self, obj):
+        return type(self) == type(obj) and \
+               self.message_type == obj.message_type and \
+               self.sequence == obj.sequence
+
+# Reattaches to the session of <username> that <token> was issued for, after its
+# connection dropped, as long as the server still holds it. <last_sequence> is
+# the number of the last chat received, as in AckMessage, so the chats after it
+# are sent again, followed by those queued while the session was detached.
+# Server will reply with a SessionMessage, or an ErrorMessage if the session is
+# gone and the client must log in again.
+class ResumeMessage(Message):
+    message_type = RESUME_MESSAGE_ID
+
+    def __init__(self, username : str, token : str, last_sequence : int):
+        self.username = username
+        self.token = token
+        self.last_sequence = last_sequence
+
+    @classmethod
+    def deserialize(cls, raw : bytes) -> Message:
+        username, offset = unpack_string_at(raw, 0)
+        token, offset = unpack_string_at(raw, offset)
+        last_sequence, _ = unpack_int_at(raw, offset)
+        return cls(username, token, last_sequence)
+
+    def payload_size(self) -> int:
+        return string_size(self.username) + string_size(self.token) + 4
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        offset = pack_string_into(buffer, offset, self.username)
+        offset = pack_string_into(buffer, offset, self.token)
+        return pack_int_into(buffer, offset, self.last_sequence)
+
+    def __eq__(self, obj):
+        return type(self) == type(obj) and \
+               self.message_type == obj.message_type and \
+               self.username == obj.username and \
+               self.token == obj.token and \
+               self.last_sequence == obj.last_sequence
+
 # Server will reply with a DeliverMessage
 class ShowUndeliveredMessage(Message):
     message_type = SHOW_UNDELIVERED_MESSAGE_ID
 
+# Lists of (sender, body) messages are encoded as a count followed by each
+# sender and body. These helpers are shared by every message that carries one.
+def message_list_size(message_list) -> int:
+    size = 4
+
+    for sender, body in message_list:
+        size += string_size(sender) + string_size(body)
+
+    return size
+
+def pack_message_list_into(buffer, offset, message_list) -> int:
+    offset = pack_int_into(buffer, offset, len(message_list))
+
+    for sender, body in message_list:
+        offset = pack_string_into(buffer, offset, sender)
+        offset = pack_string_into(buffer, offset, body)
+
+    return offset
+
+def unpack_message_list_at(buf, offset):
+    num_messages, offset = unpack_int_at(buf, offset)
+
+    messages = []
+
+    for i in range(num_messages):
+        sender, offset = unpack_string_at(buf, offset)
+        body, offset = unpack_string_at(buf, offset)
+        messages.append((sender, body))
+
+    return messages, offset
+
 # Either a response to ShowUndeliveredMessage, or dispatched whenever
 # a message is sent to a currently logged in user.
+# Chats delivered live are numbered per user: <first_sequence> is the number of
+# the first message in the list, and the rest follow on from it. It is 0 for
+# messages that are not numbered, such as the response to ShowUndelivered.
 class DeliverMessage(Message):
     message_type = DELIVER_MESSAGE_ID
 
-    def __init__(self, message_list : list[tuple[str, str]]):
+    def __init__(self, message_list : list[tuple[str, str]], first_sequence : int = 0):
         self.message_list = message_list
+        self.first_sequence = first_sequence
 
     @classmethod
     def deserialize(cls, raw : bytes) -> Message:
-        num_messages, rest = unpack_int(raw)
+        first_sequence, offset = unpack_int_at(raw, 0)
+        messages, _ = unpack_message_list_at(raw, offset)
+        return cls(messages, first_sequence)
+
+    # <frame>, a serialized DeliverMessage, numbered from <first_sequence> instead,
+    # without decoding and encoding the messages again. renumber_parts returns the
+    # header, the new number and the messages as three buffers, the first and last
+    # views into <frame>, for a scatter-gather send that copies nothing.
+    @staticmethod
+    def renumber_parts(frame, first_sequence : int) -> list:
+        view = memoryview(frame)
+        return [view[:HEADER_SIZE], pack_int(first_sequence), view[HEADER_SIZE + 4:]]
+
+    @staticmethod
+    def renumber(frame, first_sequence : int) -> bytes:
+        return b''.join(DeliverMessage.renumber_parts(frame, first_sequence))
+
+    def payload_size(self) -> int:
+        return 4 + message_list_size(self.message_list)
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        offset = pack_int_into(buffer, offset, self.first_sequence)
+        return pack_message_list_into(buffer, offset, self.message_list)
 
-        messages = []
+    def __eq__(self, obj):
+        return type(self) == type(obj) and \
+               self.message_type == obj.message_type and \
+               self.first_sequence == obj.first_sequence and \
+               self.message_list == obj.message_list
 
-        for i in range(num_messages):
-            sender, rest = unpack_string(rest)
-            body, rest = unpack_string(rest)
-            messages.append((sender, body))
+# Sent on logging in, and in reply to ResumeMessage. <token> lets the client
+# resume this session with a ResumeMessage if its connection drops.
+class SessionMessage(Message):
+    message_type = SESSION_MESSAGE_ID
 
-        return cls(messages)
+    def __init__(self, token : str):
+        self.token = token
 
-    def serialize_payload(self) -> bytes:
-        result = pack_int(len(self.message_list))
+    @classmethod
+    def deserialize(cls, raw : bytes) -> Message:
+        token, _ = unpack_string_at(raw, 0)
+        return cls(token)
 
-        for sender, body in self.message_list:
-            result += pack_string(sender)
-            result += pack_string(body)
+    def payload_size(self) -> int:
+        return string_size(self.token)
 
-        return result
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        return pack_string_into(buffer, offset, self.token)
 
     def __eq__(self, obj):
         return type(self) == type(obj) and \
                self.message_type == obj.message_type and \
-               self.message_list == obj.message_list
+               self.token == obj.token
+
+# Asks for the next page of at most <max_messages> undelivered messages.
+# <cursor> is 0 for the first page, and afterwards the next_cursor of the
+# previous page. Server will reply with an UndeliveredPageMessage.
+# Unlike ShowUndeliveredMessage, a long backlog is never sent in one frame.
+class RequestUndeliveredPageMessage(Message):
+    message_type = REQUEST_UNDELIVERED_PAGE_ID
+
+    def __init__(self, cursor : int, max_messages : int):
+        self.cursor = cursor
+        self.max_messages = max_messages
+
+    @classmethod
+    def deserialize(cls, raw : bytes) -> Message:
+        cursor, offset = unpack_int_at(raw, 0)
+        max_messages, _ = unpack_int_at(raw, offset)
+        return cls(cursor, max_messages)
+
+    def payload_size(self) -> int:
+        return 8
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        offset = pack_int_into(buffer, offset, self.cursor)
+        return pack_int_into(buffer, offset, self.max_messages)
+
+    def __eq__(self, obj):
+        return type(self) == type(obj) and \
+               self.message_type == obj.message_type and \
+               self.cursor == obj.cursor and \
+               self.max_messages == obj.max_messages
+
+# Reply to RequestUndeliveredPageMessage
+# <next_cursor> counts the messages delivered so far in this drain, and is the
+# cursor for the next request. <end_of_stream> is set on the last page, once
+# no undelivered messages are left.
+class UndeliveredPageMessage(Message):
+    message_type = UNDELIVERED_PAGE_ID
+
+    def __init__(self, next_cursor : int, message_list : list[tuple[str, str]], end_of_stream : bool):
+        self.next_cursor = next_cursor
+        self.message_list = message_list
+        self.end_of_stream = end_of_stream
+
+    @classmethod
+    def deserialize(cls, raw : bytes) -> Message:
+        next_cursor, offset = unpack_int_at(raw, 0)
+        end_of_stream, offset = unpack_int_at(raw, offset)
+        messages, _ = unpack_message_list_at(raw, offset)
+        return cls(next_cursor, messages, bool(end_of_stream))
+
+    def payload_size(self) -> int:
+        return 8 + message_list_size(self.message_list)
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        offset = pack_int_into(buffer, offset, self.next_cursor)
+        offset = pack_int_into(buffer, offset, int(self.end_of_stream))
+        return pack_message_list_into(buffer, offset, self.message_list)
+
+    def __eq__(self, obj):
+        return type(self) == type(obj) and \
+               self.message_type == obj.message_type and \
+               self.next_cursor == obj.next_cursor and \
+               self.message_list == obj.message_list and \
+               self.end_of_stream == obj.end_of_stream
 
 # Reply to RequestUserListMessage
 # Contains a list of all users.
@@ -216,29 +626,106 @@ class UserListResponseMessage(Message):
 
     @classmethod
     def deserialize(cls, raw : bytes) -> Message:
-        num_users, rest = unpack_int(raw)
+        num_users, offset = unpack_int_at(raw, 0)
 
         users = []
 
         for i in range(num_users):
-            user, rest = unpack_string(rest)
+            user, offset = unpack_string_at(raw, offset)
             users.append(user)
 
         return cls(users)
 
-    def serialize_payload(self) -> bytes:
-        result = pack_int(len(self.user_list))
+    def payload_size(self) -> int:
+        return 4 + sum(string_size(user) for user in self.user_list)
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        offset = pack_int_into(buffer, offset, len(self.user_list))
 
         for user in self.user_list:
-            result += pack_string(user)
+            offset = pack_string_into(buffer, offset, user)
 
-        return result
+        return offset
 
     def __eq__(self, obj):
         return type(self) == type(obj) and \
                self.message_type == obj.message_type and \
                self.user_list.sort() == obj.user_list.sort()
 
+# Asks for at most <limit> usernames starting with <prefix>, in sorted order.
+# <continuation_token> is "" for the first page, and afterwards the token from
+# the previous page. Server will reply with a UserPageResponseMessage.
+class SearchUsersMessage(Message):
+    message_type = SEARCH_USERS_MESSAGE_ID
+
+    def __init__(self, prefix : str, limit : int, continuation_token : str = ""):
+        self.prefix = prefix
+        self.limit = limit
+        self.continuation_token = continuation_token
+
+    @classmethod
+    def deserialize(cls, raw : bytes) -> Message:
+        prefix, offset = unpack_string_at(raw, 0)
+        limit, offset = unpack_int_at(raw, offset)
+        continuation_token, _ = unpack_string_at(raw, offset)
+        return cls(prefix, limit, continuation_token)
+
+    def payload_size(self) -> int:
+        return string_size(self.prefix) + 4 + string_size(self.continuation_token)
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        offset = pack_string_into(buffer, offset, self.prefix)
+        offset = pack_int_into(buffer, offset, self.limit)
+        return pack_string_into(buffer, offset, self.continuation_token)
+
+    def __eq__(self, obj):
+        return type(self) == type(obj) and \
+               self.message_type == obj.message_type and \
+               self.prefix == obj.prefix and \
+               self.limit == obj.limit and \
+               self.continuation_token == obj.continuation_token
+
+# Reply to SearchUsersMessage
+# Contains one page of matching users. <continuation_token> is "" on the last
+# page, and otherwise should be sent back to get the next page.
+class UserPageResponseMessage(Message):
+    message_type = USER_PAGE_RESPONSE_ID
+
+    def __init__(self, user_list : list[str], continuation_token : str):
+        self.user_list = user_list
+        self.continuation_token = continuation_token
+
+    @classmethod
+    def deserialize(cls, raw : bytes) -> Message:
+        continuation_token, offset = unpack_string_at(raw, 0)
+        num_users, offset = unpack_int_at(raw, offset)
+
+        users = []
+
+        for i in range(num_users):
+            user, offset = unpack_string_at(raw, offset)
+            users.append(user)
+
+        return cls(users, continuation_token)
+
+    def payload_size(self) -> int:
+        return string_size(self.continuation_token) + 4 + sum(string_size(user) for user in self.user_list)
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        offset = pack_string_into(buffer, offset, self.continuation_token)
+        offset = pack_int_into(buffer, offset, len(self.user_list))
+
+        for user in self.user_list:
+            offset = pack_string_into(buffer, offset, user)
+
+        return offset
+
+    def __eq__(self, obj):
+        return type(self) == type(obj) and \
+               self.message_type == obj.message_type and \
+               self.user_list == obj.user_list and \
+               self.continuation_token == obj.continuation_token
+
 # Wraps an error message string to be sent to the client.
 class ErrorMessage(Message):
     message_type = ERROR_MESSAGE_ID
@@ -248,21 +735,318 @@ class ErrorMessage(Message):
 
     @classmethod
     def deserialize(cls, raw : bytes) -> Message:
-        error_message, _ = unpack_string(raw)
+        error_message, _ = unpack_string_at(raw, 0)
         return cls(error_message)
 
-    def serialize_payload(self) -> bytes:
-        return pack_string(self.error_message)
+    def payload_size(self) -> int:
+        return string_size(self.error_message)
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        return pack_string_into(buffer, offset, self.error_message)
 
     def __eq__(self, obj):
         return type(self) == type(obj) and \
                self.message_type == obj.message_type and \
                self.error_message == obj.error_message
 
+# Messages between server processes
+
+# Asks the server process that owns a user or channel to handle <frame>, a
+# client request, on behalf of connection <connection_id> of the sending
+# process, whose session is logged in as <user> ("" if nobody). Answered with
+# a ForwardResponseMessage carrying the same <request_id>.
+class ForwardRequestMessage(Message):
+    message_type = FORWARD_REQUEST_ID
+
+    def __init__(self, request_id : int, connection_id : int, user : str, frame : bytes):
+        self.request_id = request_id
+        self.connection_id = connection_id
+        self.user = user
+        self.frame = frame
+
+    @classmethod
+    def deserialize(cls, raw : bytes) -> Message:
+        request_id, offset = unpack_int_at(raw, 0)
+        connection_id, offset = unpack_int_at(raw, offset)
+        user, offset = unpack_string_at(raw, offset)
+        frame, _ = unpack_bytes_at(raw, offset)
+        return cls(request_id, connection_id, user, frame)
+
+    def payload_size(self) -> int:
+        return 8 + string_size(self.user) + bytes_size(self.frame)
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        offset = pack_int_into(buffer, offset, self.request_id)
+        offset = pack_int_into(buffer, offset, self.connection_id)
+        offset = pack_string_into(buffer, offset, self.user)
+        return pack_bytes_into(buffer, offset, self.frame)
+
+    def __eq__(self, obj):
+        return type(self) == type(obj) and \
+               self.message_type == obj.message_type and \
+               self.request_id == obj.request_id and \
+               self.connection_id == obj.connection_id and \
+               self.user == obj.user and \
+               self.frame == obj.frame
+
+# Reply to ForwardRequestMessage
+# <user> is who the session is logged in as after the request, and <output> is
+# everything the owner sent back for the client, to be written to it as is.
+class ForwardResponseMessage(Message):
+    message_type = FORWARD_RESPONSE_ID
+
+    def __init__(self, request_id : int, user : str, output : bytes):
+        self.request_id = request_id
+        self.user = user
+        self.output = output
+
+    @classmethod
+    def deserialize(cls, raw : bytes) -> Message:
+        request_id, offset = unpack_int_at(raw, 0)
+        user, offset = unpack_string_at(raw, offset)
+        output, _ = unpack_bytes_at(raw, offset)
+        return cls(request_id, user, output)
+
+    def payload_size(self) -> int:
+        return 4 + string_size(self.user) + bytes_size(self.output)
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        offset = pack_int_into(buffer, offset, self.request_id)
+        offset = pack_string_into(buffer, offset, self.user)
+        return pack_bytes_into(buffer, offset, self.output)
+
+    def __eq__(self, obj):
+        return type(self) == type(obj) and \
+               self.message_type == obj.message_type and \
+               self.request_id == obj.request_id and \
+               self.user == obj.user and \
+               self.output == obj.output
+
+# Sent by the process that owns a user to the process holding the user's
+# connection, with frames (usually DeliverMessages) to write to it.
+class PushMessage(Message):
+    message_type = PUSH_MESSAGE_ID
+
+    def __init__(self, connection_id : int, output : bytes):
+        self.connection_id = connection_id
+        self.output = output
+
+    @classmethod
+    def deserialize(cls, raw : bytes) -> Message:
+        connection_id, offset = unpack_int_at(raw, 0)
+        output, _ = unpack_bytes_at(raw, offset)
+        return cls(connection_id, output)
+
+    def payload_size(self) -> int:
+        return 4 + bytes_size(self.output)
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        offset = pack_int_into(buffer, offset, self.connection_id)
+        return pack_bytes_into(buffer, offset, self.output)
+
+    def __eq__(self, obj):
+        return type(self) == type(obj) and \
+               self.message_type == obj.message_type and \
+               self.connection_id == obj.connection_id and \
+               self.output == obj.output
+
+# Sent by the process that owns a channel to deliver one channel message to
+# the <members> another process owns.
+class FanOutMessage(Message):
+    message_type = FAN_OUT_MESSAGE_ID
+
+    def __init__(self, sender : str, body : str, members : list[str]):
+        self.sender = sender
+        self.body = body
+        self.members = members
+
+    @classmethod
+    def deserialize(cls, raw : bytes) -> Message:
+        sender, offset = unpack_string_at(raw, 0)
+        body, offset = unpack_string_at(raw, offset)
+        num_members, offset = unpack_int_at(raw, offset)
+
+        members = []
+
+        for i in range(num_members):
+            member, offset = unpack_string_at(raw, offset)
+            members.append(member)
+
+        return cls(sender, body, members)
+
+    def payload_size(self) -> int:
+        return string_size(self.sender) + string_size(self.body) + 4 + \
+               sum(string_size(member) for member in self.members)
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        offset = pack_string_into(buffer, offset, self.sender)
+        offset = pack_string_into(buffer, offset, self.body)
+        offset = pack_int_into(buffer, offset, len(self.members))
+
+        for member in self.members:
+            offset = pack_string_into(buffer, offset, member)
+
+        return offset
+
+    def __eq__(self, obj):
+        return type(self) == type(obj) and \
+               self.message_type == obj.message_type and \
+               self.sender == obj.sender and \
+               self.body == obj.body and \
+               self.members == obj.members
+
+# Sent to every other process when an account goes away, so that the owners of
+# its channels drop it from them.
+class LeaveChannelsMessage(Message):
+    message_type = LEAVE_CHANNELS_MESSAGE_ID
+
+    def __init__(self, username : str):
+        self.username = username
+
+    @classmethod
+    def deserialize(cls, raw : bytes) -> Message:
+        username, _ = unpack_string_at(raw, 0)
+        return cls(username)
+
+    def payload_size(self) -> int:
+        return string_size(self.username)
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        return pack_string_into(buffer, offset, self.username)
+
+    def __eq__(self, obj):
+        return type(self) == type(obj) and \
+               self.message_type == obj.message_type and \
+               self.username == obj.username
+
+# The first message on a link between cluster nodes, naming the node that
+# opened it by its peer address.
+class NodeHelloMessage(Message):
+    message_type = NODE_HELLO_MESSAGE_ID
+
+    def __init__(self, node : str):
+        self.node = node
+
+    @classmethod
+    def deserialize(cls, raw : bytes) -> Message:
+        node, _ = unpack_string_at(raw, 0)
+        return cls(node)
+
+    def payload_size(self) -> int:
+        return string_size(self.node)
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        return pack_string_into(buffer, offset, self.node)
+
+    def __eq__(self, obj):
+        return type(self) == type(obj) and \
+               self.message_type == obj.message_type and \
+               self.node == obj.node
+
+# Hands an account, and the messages waiting for it, to the cluster node that
+# now owns it.
+class HandoffUserMessage(Message):
+    message_type = HANDOFF_USER_MESSAGE_ID
+
+    def __init__(self, username : str, message_list : list[tuple[str, str]]):
+        self.username = username
+        self.message_list = message_list
+
+    @classmethod
+    def deserialize(cls, raw : bytes) -> Message:
+        username, offset = unpack_string_at(raw, 0)
+        messages, _ = unpack_message_list_at(raw, offset)
+        return cls(username, messages)
+
+    def payload_size(self) -> int:
+        return string_size(self.username) + message_list_size(self.message_list)
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        offset = pack_string_into(buffer, offset, self.username)
+        return pack_message_list_into(buffer, offset, self.message_list)
+
+    def __eq__(self, obj):
+        return type(self) == type(obj) and \
+               self.message_type == obj.message_type and \
+               self.username == obj.username and \
+               self.message_list == obj.message_list
+
+# Hands a channel and its members to the cluster node that now owns it.
+class HandoffChannelMessage(Message):
+    message_type = HANDOFF_CHANNEL_MESSAGE_ID
+
+    def __init__(self, channel : str, members : list[str]):
+        self.channel = channel
+        self.members = members
+
+    @classmethod
+    def deserialize(cls, raw : bytes) -> Message:
+        channel, offset = unpack_string_at(raw, 0)
+        num_members, offset = unpack_int_at(raw, offset)
+
+        members = []
+
+        for i in range(num_members):
+            member, offset = unpack_string_at(raw, offset)
+            members.append(member)
+
+        return cls(channel, members)
+
+    def payload_size(self) -> int:
+        return string_size(self.channel) + 4 + sum(string_size(member) for member in self.members)
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        offset = pack_string_into(buffer, offset, self.channel)
+        offset = pack_int_into(buffer, offset, len(self.members))
+
+        for member in self.members:
+            offset = pack_string_into(buffer, offset, member)
+
+        return offset
+
+    def __eq__(self, obj):
+        return type(self) == type(obj) and \
+               self.message_type == obj.message_type and \
+               self.channel == obj.channel and \
+               self.members == obj.members
+
+# Sent on behalf of a client connection that dropped while logged in as a user
+# another worker owns, so that the owner keeps the session for the client to
+# resume, instead of logging it out.
+class DetachMessage(Message):
+    message_type = DETACH_MESSAGE_ID
+
+# Sent by the process that owns a user to the process holding connection
+# <connection_id>, once a client has resumed that connection's session on
+# another connection, so that the old one is closed.
+class CloseSessionMessage(Message):
+    message_type = CLOSE_SESSION_MESSAGE_ID
+
+    def __init__(self, connection_id : int):
+        self.connection_id = connection_id
+
+    @classmethod
+    def deserialize(cls, raw : bytes) -> Message:
+        connection_id, _ = unpack_int_at(raw, 0)
+        return cls(connection_id)
+
+    def payload_size(self) -> int:
+        return 4
+
+    def serialize_payload_into(self, buffer, offset : int) -> int:
+        return pack_int_into(buffer, offset, self.connection_id)
+
+    def __eq__(self, obj):
+        return type(self) == type(obj) and \
+               self.message_type == obj.message_type and \
+               self.connection_id == obj.connection_id
+
 # All instantiatable message types
 message_classes = [
     PingMessage,
     PongMessage,
+    StatsRequestMessage,
+    StatsResponseMessage,
     HereMessage,
     CreateAccountMessage,
     AwayMessage,
@@ -270,9 +1054,29 @@ message_classes = [
     RequestUserListMessage,
     DeleteAccountMessage,
     ShowUndeliveredMessage,
+    RequestUndeliveredPageMessage,
+    SearchUsersMessage,
+    JoinChannelMessage,
+    LeaveChannelMessage,
+    SendChannelMessage,
+    AckMessage,
+    ResumeMessage,
     DeliverMessage,
     UserListResponseMessage,
-    ErrorMessage
+    ErrorMessage,
+    UndeliveredPageMessage,
+    UserPageResponseMessage,
+    SessionMessage,
+    ForwardRequestMessage,
+    ForwardResponseMessage,
+    PushMessage,
+    FanOutMessage,
+    LeaveChannelsMessage,
+    NodeHelloMessage,
+    HandoffUserMessage,
+    HandoffChannelMessage,
+    DetachMessage,
+    CloseSessionMessage
 ]
 
 # Map message types to their classes
@@ -280,27 +1084,25 @@ id_to_class_table = { c.message_type: c for c in message_classes }
 
 # Given the bytes of a full message, extract the message type and dispatch
 # the payload to the correct class's deserialize function.
-def deserialize_message(raw_bytes) -> Message:
-    # version number must be present
+# The payload is handed over as a memoryview into raw_bytes, so it is never
+# copied; deserializers read their fields from it by offset.
+# Messages between server processes are refused unless <peer> says the bytes
+# came from another server process.
+def deserialize_message(raw_bytes, peer : bool = False) -> Message:
+    view = memoryview(raw_bytes)
+
+    # version number, message id and payload size must be present
     try:
-        version_num, raw_bytes = unpack_int(raw_bytes)
+        version_num, message_id, payload_size = HEADER_STRUCT.unpack_from(view, 0)
     except:
-        raise Exception("Deserialize message failed: no version number present.")
+        raise Exception("Deserialize message failed: incomplete header.")
 
     # version number must be correct
     if version_num != PROTOCOL_VERSION_NUMBER:
         raise Exception("Deserialize message failed: different protocol version numbers")
 
-    # message id must be present
-    try:
-        message_id, raw_bytes = unpack_int(raw_bytes)
-    except:
-        raise Exception("Deserialize message failed: no message id present.")
-
-    try:
-        payload_size, payload = unpack_int(raw_bytes)
-    except:
-        raise Exception("Payload size not present")
+    if len(view) < HEADER_SIZE + payload_size:
+        raise Exception("Deserialize message failed: payload shorter than its size.")
 
     # message id must have a class
     try:
@@ -308,10 +1110,10 @@ def deserialize_message(raw_bytes) -> Message:
     except:
         raise Exception("Deserialize message failed: invalid message type.")
 
+    if message_id >= FIRST_PEER_MESSAGE_ID and not peer:
+        raise Exception("Deserialize message failed: message type is only sent between servers.")
+
     try:
-        return TargetClass.deserialize(payload)
+        return TargetClass.deserialize(view[HEADER_SIZE:HEADER_SIZE + payload_size])
     except:
         raise Exception("Message payload does not match message type.")
-
-
-
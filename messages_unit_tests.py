@@ -1,9 +1,10 @@
 from messages import *
+from framing import FrameDecoder, OutboundBuffer
 
 # We create one of each type of message and make sure that its serialization
 # deserializes to an identical representation
 def run_test(test_object):
-    success = (deserialize_message(test_object.serialize()) == test_object)
+    success = (deserialize_message(test_object.serialize(), peer=True) == test_object)
 
     if success:
         print("Test succeeded: " + str(type(test_object)))
@@ -14,16 +15,528 @@ def test_all():
     test_message_objects = [
         PingMessage(),
         PongMessage(),
+        StatsRequestMessage(),
+        StatsResponseMessage("requests_total{type=\"PingMessage\"} 3\nthreads 4\n"),
         HereMessage("test_username"),
         CreateAccountMessage("test_username"),
         AwayMessage(),
         SendChatMessage("test_username_longer", "Hi there!"),
+        SendChatMessage("ünïcødé", "multi-byte characters: 日本語 ✓"),
         RequestUserListMessage(),
         DeleteAccountMessage(),
         DeliverMessage([("recip1", "message1"), ("recip2", "hey here's a longer message for the fun of it.")]),
+        DeliverMessage([("recip1", "message1")], 4000000000),
+        AckMessage(41),
+        ResumeMessage("lavanya", "b3Jz1xK9", 41),
+        SessionMessage("b3Jz1xK9"),
         UserListResponseMessage(["user1", "user2", "lavanya", "jordan", "luke"]),
-        ErrorMessage("Everything broke! Halp!")
+        ErrorMessage("Everything broke! Halp!"),
+        RequestUndeliveredPageMessage(200, 100),
+        UndeliveredPageMessage(300, [("recip1", "message1"), ("recip2", "message2")], False),
+        UndeliveredPageMessage(302, [], True),
+        SearchUsersMessage("lav", 50, "lavanya"),
+        UserPageResponseMessage(["lavanya", "lavender"], "lavender"),
+        UserPageResponseMessage([], ""),
+        JoinChannelMessage("#general"),
+        LeaveChannelMessage("#general"),
+        SendChannelMessage("#general", "hello everyone"),
+        ForwardRequestMessage(7, 3, "lavanya", SendChatMessage("jordan", "hi").serialize()),
+        ForwardResponseMessage(7, "", ErrorMessage("Account does not exist.").serialize()),
+        PushMessage(3, DeliverMessage([("jordan", "hi")]).serialize()),
+        FanOutMessage("#general/jordan", "hello everyone", ["lavanya", "mali"]),
+        LeaveChannelsMessage("jordan"),
+        NodeHelloMessage("localhost:13001"),
+        HandoffUserMessage("lavanya", [("jordan", "hi"), ("mali", "hello")]),
+        HandoffChannelMessage("#general", ["jordan", "lavanya"]),
+        DetachMessage(),
+        CloseSessionMessage(3)
     ]
 
     for test_object in test_message_objects:
         run_test(test_object)
+
+    test_peer_messages_refused()
+    test_framing()
+    test_renumber()
+    test_outbound()
+    test_late_forward_response()
+    test_message_log()
+    test_user_registry()
+    test_timing_wheel()
+    test_heartbeat()
+    test_ack_window()
+    test_take_page()
+    test_overflow_policies()
+    test_spill_store()
+
+# Messages between server processes must not decode when read from a client.
+def test_peer_messages_refused():
+    for test_object in [DetachMessage(), NodeHelloMessage("localhost:13001"), HandoffUserMessage("lavanya", [])]:
+        try:
+            deserialize_message(test_object.serialize())
+            print("Test FAILED: refusing " + str(type(test_object)) + " from a client")
+        except Exception:
+            print("Test succeeded: refusing " + str(type(test_object)) + " from a client")
+
+# A stream of pipelined messages, fed to the frame decoder in awkward chunk
+# sizes, must come back out as the same messages in the same order.
+def test_framing():
+    test_message_objects = [
+        HereMessage("test_username"),
+        SendChatMessage("test_username", "x" * 100000),
+        PingMessage(),
+        DeliverMessage([("recip1", "message1")] * 1000),
+    ]
+    stream = b''.join(m.serialize() for m in test_message_objects)
+
+    for chunk_size in [1, 5, 12, 4096, len(stream)]:
+        decoder = FrameDecoder(buffer_size=64)
+        frames = []
+        for i in range(0, len(stream), chunk_size):
+            decoder.feed(stream[i:i + chunk_size])
+            frames.extend(decoder.frames())
+
+        decoded = [deserialize_message(frame) for frame in frames]
+        if decoded == test_message_objects and decoder.pending() == 0:
+            print("Test succeeded: framing in chunks of " + str(chunk_size))
+        else:
+            print("Test FAILED: framing in chunks of " + str(chunk_size))
+
+# A shared DeliverMessage frame renumbered for one recipient must decode as if
+# it had been serialized with that number.
+def test_renumber():
+    frame = DeliverMessage([("#general/jordan", "hello everyone")]).serialize()
+
+    if deserialize_message(DeliverMessage.renumber(frame, 7)) == DeliverMessage([("#general/jordan", "hello everyone")], 7):
+        print("Test succeeded: renumbering a DeliverMessage frame")
+    else:
+        print("Test FAILED: renumbering a DeliverMessage frame")
+
+    if b''.join(DeliverMessage.renumber_parts(frame, 7)) == DeliverMessage.renumber(frame, 7):
+        print("Test succeeded: renumbering a DeliverMessage frame in parts")
+    else:
+        print("Test FAILED: renumbering a DeliverMessage frame in parts")
+
+# Stands in for a socket whose sendmsg takes at most <limit> bytes a call, as
+# a full send buffer would.
+class ShortWriteSocket:
+    def __init__(self, limit):
+        self.limit = limit
+        self.received = bytearray()
+
+    def sendmsg(self, buffers):
+        data = b''.join(buffers)[:self.limit]
+        self.received += data
+        return len(data)
+
+# Frames written to an outbound buffer, some in parts, must reach the socket
+# whole and in order, however little each sendmsg call takes.
+def test_outbound():
+    shared = DeliverMessage([("#general/jordan", "hello everyone")]).serialize()
+    test_message_objects = [
+        PongMessage(),
+        DeliverMessage([("#general/jordan", "hello everyone")], 7),
+        UserListResponseMessage(["user" + str(i) for i in range(1000)]),
+        DeliverMessage([("#general/jordan", "hello everyone")], 8),
+    ]
+
+    for limit in [1, 7, 4096, 1 << 20]:
+        sock = ShortWriteSocket(limit)
+        buffer = OutboundBuffer(sock, flush_size=1 << 20)
+        buffer.sendall(test_message_objects[0].serialize())
+        for part in DeliverMessage.renumber_parts(shared, 7):
+            buffer.sendall(part)
+        buffer.sendall(test_message_objects[2].serialize())
+        for part in DeliverMessage.renumber_parts(shared, 8):
+            buffer.sendall(part)
+        calls = buffer.flush()
+
+        decoder = FrameDecoder()
+        decoder.feed(sock.received)
+        decoded = [deserialize_message(frame) for frame in decoder.frames()]
+        if decoded == test_message_objects and buffer.pending() == 0 and (calls == 1) == (limit >= len(sock.received)):
+            print("Test succeeded: outbound buffer with writes of " + str(limit))
+        else:
+            print("Test FAILED: outbound buffer with writes of " + str(limit))
+
+# A worker must keep reading its link to a peer when a response arrives for a
+# forwarded request that has already timed out or been cancelled.
+def test_late_forward_response():
+    import asyncio
+    import server
+
+    async def run():
+        peers = server.Peers(0, lambda key: 0, {})
+        loop = asyncio.get_running_loop()
+        cancelled = loop.create_future()
+        cancelled.cancel()
+        waiting = loop.create_future()
+        peers.pending = {1: (1, cancelled), 2: (1, waiting)}
+
+        reader = asyncio.StreamReader()
+        for request_id in [99, 1, 2]:
+            reader.feed_data(ForwardResponseMessage(request_id, "", PongMessage().serialize()).serialize())
+        reader.feed_eof()
+
+        try:
+            await peers.read_link(1, reader)
+        except Exception:
+            return False
+        return waiting.done() and waiting.result().request_id == 2 and not peers.pending
+
+    if asyncio.run(run()):
+        print("Test succeeded: late forward responses")
+    else:
+        print("Test FAILED: late forward responses")
+
+# A message log compacted while it runs must replay to the same pending
+# messages, and tell waiters once their records are committed.
+def test_message_log():
+    import os
+    import tempfile
+    from message_log import MessageLog
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "messages.log")
+        log = MessageLog(path, commit_interval=0, compact_size=4096)
+        log.replay()
+        log.start()
+
+        committed = []
+        for i in range(500):
+            log.log_message("lavanya", "jordan", "message " + str(i))
+            log.log_drain("lavanya", 1)
+        log.log_message("lavanya", "jordan", "kept")
+        log.log_message("mali", "jordan", "gone")
+        log.log_delete("mali")
+        log.on_commit(log.last_logged(), lambda: committed.append(True))
+        log.close()
+
+        if log.compactions and committed and os.path.getsize(path) < 4096 and \
+           MessageLog(path).replay() == {"lavanya": [("jordan", "kept")]}:
+            print("Test succeeded: message log compaction while running")
+        else:
+            print("Test FAILED: message log compaction while running")
+
+# Accounts and memberships written to the user registry must be there when it
+# is opened again, and a new registry must import a legacy users.txt once.
+def test_user_registry():
+    import os
+    import tempfile
+    from user_registry import UserRegistry
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "users.db")
+        legacy_path = os.path.join(directory, "users.txt")
+        with open(legacy_path, "w") as f:
+            f.write("lavanya\njordan\n\n")
+
+        registry = UserRegistry(path, legacy_path=legacy_path)
+        imported = sorted(registry.load())
+        registry.create("mali")
+        registry.create("luke")
+        registry.delete("jordan")
+        registry.join("mali", "#general")
+        registry.join("luke", "#general")
+        registry.leave("luke", "#general")
+        registry.flush()
+        created = sorted(registry.load())
+        registry.close()
+
+        if imported == ["jordan", "lavanya"]:
+            print("Test succeeded: importing a legacy users.txt")
+        else:
+            print("Test FAILED: importing a legacy users.txt")
+
+        if created == ["lavanya", "luke", "mali"]:
+            print("Test succeeded: creating and deleting registry accounts")
+        else:
+            print("Test FAILED: creating and deleting registry accounts")
+
+        # the legacy file is only imported into a new registry
+        with open(legacy_path, "w") as f:
+            f.write("jordan\n")
+        registry = UserRegistry(path, legacy_path=legacy_path)
+        reopened = sorted(registry.load())
+        memberships = list(registry.load_memberships())
+        registry.close()
+
+        if reopened == ["lavanya", "luke", "mali"] and memberships == [("#general", "mali")]:
+            print("Test succeeded: reopening the user registry")
+        else:
+            print("Test FAILED: reopening the user registry")
+
+# Every timer on a timing wheel must fire in exactly the tick it is due, not
+# before or after, whether it sits in level 0, cascades down from the levels
+# above, or lies beyond the reach of the top level. Cancelled timers must not
+# fire.
+def test_timing_wheel():
+    from timing_wheel import TimingWheel
+
+    delays = [1, 63, 64, 65, 4095, 4096, 4097, 262145, 300000]
+    for levels in [1, 2, 4]:
+        wheel = TimingWheel(tick=1, levels=levels, start=0)
+        wheel.advance(70)
+        timers = {wheel.schedule(delay, None): 70 + delay for delay in delays}
+        cancelled = [wheel.schedule(delay, None) for delay in delays]
+        for timer in cancelled:
+            wheel.cancel(timer)
+            wheel.cancel(timer)
+
+        fired = {}
+        for now in range(71, 70 + max(delays) + 2):
+            for timer in wheel.advance(now):
+                fired[timer] = now
+
+        if fired == timers and len(wheel) == 0:
+            print("Test succeeded: timing wheel with " + str(levels) + " levels")
+        else:
+            print("Test FAILED: timing wheel with " + str(levels) + " levels")
+
+    try:
+        TimingWheel(levels=0)
+        print("Test FAILED: refusing a timing wheel without levels")
+    except ValueError:
+        print("Test succeeded: refusing a timing wheel without levels")
+
+# A connection's heartbeat must ping a client silent for HEARTBEAT seconds,
+# time it out after IDLE_TIMEOUT, check again when the client will next have
+# been silent for HEARTBEAT seconds, and leave no timer behind once closed.
+def test_heartbeat():
+    import time
+    import server
+    from timing_wheel import TimingWheel
+
+    saved = server.timers, server.HEARTBEAT, server.IDLE_TIMEOUT
+    server.timers = TimingWheel(tick=1)
+    server.HEARTBEAT, server.IDLE_TIMEOUT = 15, 45
+    try:
+        notified = []
+        heartbeat = server.Heartbeat(lambda: notified.append(True))
+        checks = []
+
+        # run the check the wheel has scheduled, as if the client had last
+        # been heard <silent> seconds ago
+        def check(silent):
+            checks.append(heartbeat.timer.expires - server.timers.current)
+            server.timers.cancel(heartbeat.timer)
+            heartbeat.last_heard = time.monotonic() - silent
+            heartbeat.check()
+
+        check(5)
+        quiet = not notified and not heartbeat.ping_due
+        check(16)
+        pinged = heartbeat.ping_due and not heartbeat.timed_out and len(notified) == 1
+        check(40)
+        check(46)
+        timed_out = heartbeat.timed_out and len(notified) == 3
+
+        heartbeat.close()
+        if quiet and pinged and timed_out and checks == [15, 10, 15, 5] and len(server.timers) == 0:
+            print("Test succeeded: connection heartbeat")
+        else:
+            print("Test FAILED: connection heartbeat")
+    finally:
+        server.timers, server.HEARTBEAT, server.IDLE_TIMEOUT = saved
+
+# Chats sent to an acknowledging session must stay unacknowledged until a
+# cumulative acknowledgment covers them, stall new chats once ack_window of
+# them are out, and be sent again, from the first one not acknowledged, when a
+# session resumes. A session that never acknowledges has no window.
+def test_ack_window():
+    from userstate import UserState
+
+    saved = UserState.ack_window, UserState.message_log
+    UserState.ack_window, UserState.message_log = 4, None
+    try:
+        user = UserState("lavanya")
+        user.login()
+        chats = [("jordan", "chat " + str(i)) for i in range(1, 7)]
+        for chat in chats[:5]:
+            user.add_message(chat)
+
+        unlimited = user.window_room() is None
+        first_ack = user.acknowledge(0)
+
+        sent = user.take_deliver_now(user.window_room())
+        first = user.number_sent(sent)
+        stalled = user.window_room() == 0 and list(user.deliver_now) == [chats[4]]
+
+        acked = user.acknowledge(2)
+        room = user.window_room()
+        resumed = user.acknowledge(2, resume=True)
+        stale = user.acknowledge(1)
+
+        if unlimited and first_ack == (1, []) and first == 1 and sent == chats[:4] and stalled:
+            print("Test succeeded: stalling at the ack window")
+        else:
+            print("Test FAILED: stalling at the ack window")
+
+        if acked == (3, []) and room == 2 and stale == (3, []) and \
+           resumed == (3, chats[2:4]) and list(user.unacked) == chats[2:4]:
+            print("Test succeeded: acknowledging chats")
+        else:
+            print("Test FAILED: acknowledging chats")
+
+        # the window outlives a logout for the next session to resume, but is
+        # queued for later if that session is sent chats without resuming
+        user.logout()
+        kept = list(user.unacked) == chats[2:4] and list(user.deliver_later) == [chats[4]]
+        user.login()
+        user.add_message(chats[5])
+        sent = user.take_deliver_now(user.window_room())
+        first = user.number_sent(sent)
+        if kept and sent == [chats[5]] and first == 5 and user.unacked is None and \
+           list(user.deliver_later) == [chats[4]] + chats[2:4]:
+            print("Test succeeded: releasing an ack window that is not resumed")
+        else:
+            print("Test FAILED: releasing an ack window that is not resumed")
+    finally:
+        UserState.ack_window, UserState.message_log = saved
+
+# A page of undelivered messages must be sent again to every request until one
+# confirms it with the cursor that follows it, and then be dropped.
+def test_take_page():
+    from userstate import UserState
+
+    saved = UserState.message_log
+    UserState.message_log = None
+    try:
+        user = UserState("lavanya")
+        messages = [("jordan", "message " + str(i)) for i in range(5)]
+        for message in messages:
+            user.add_message(message)
+
+        first = user.take_page(0, 2)
+        again = user.take_page(0, 2)
+        second = user.take_page(2, 2)
+        third = user.take_page(4, 2)
+        last = user.take_page(5, 2)
+
+        if first == (2, messages[:2], False) and again == first:
+            print("Test succeeded: resending an undelivered page until confirmed")
+        else:
+            print("Test FAILED: resending an undelivered page until confirmed")
+
+        if second == (4, messages[2:4], False) and third == (5, messages[4:], True) and \
+           last == (5, [], True) and user.held_page is None:
+            print("Test succeeded: dropping a confirmed undelivered page")
+        else:
+            print("Test FAILED: dropping a confirmed undelivered page")
+
+        # a page that was never confirmed comes first in a full listing
+        for message in messages:
+            user.add_message(message)
+        user.take_page(5, 2)
+        if user.take_undelivered() == messages and user.held_page is None:
+            print("Test succeeded: listing an unconfirmed page with the rest")
+        else:
+            print("Test FAILED: listing an unconfirmed page with the rest")
+    finally:
+        UserState.message_log = saved
+
+# A full deliver_later queue must refuse new messages under REJECT, and make
+# room by dropping the oldest under DROP_OLDEST, in the log as in memory.
+# Messages moved from deliver_now were accepted already and are never refused.
+def test_overflow_policies():
+    import os
+    import tempfile
+    from message_log import MessageLog
+    from userstate import UserState, REJECT, DROP_OLDEST
+
+    saved = UserState.queue_limit, UserState.overflow_policy, UserState.message_log, UserState.spill_store
+    UserState.queue_limit, UserState.spill_store = 3, None
+    try:
+        messages = [("jordan", "message " + str(i)) for i in range(5)]
+
+        UserState.overflow_policy, UserState.message_log = REJECT, None
+        user = UserState("lavanya")
+        accepted = [user.add_message(message) for message in messages]
+        moved = user.queue_for_later(messages[4], enforce_limit=False)
+        if accepted == [True, True, True, False, False] and moved and \
+           user.take_undelivered() == messages[:3] + messages[4:]:
+            print("Test succeeded: rejecting messages for a full queue")
+        else:
+            print("Test FAILED: rejecting messages for a full queue")
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "messages.log")
+            log = MessageLog(path, commit_interval=0)
+            log.replay()
+            log.start()
+            UserState.overflow_policy, UserState.message_log = DROP_OLDEST, log
+            user = UserState("lavanya")
+            accepted = [user.add_message(message) for message in messages]
+            queued = list(user.deliver_later)
+            log.close()
+
+            if all(accepted) and queued == messages[2:] and \
+               MessageLog(path).replay() == {"lavanya": messages[2:]}:
+                print("Test succeeded: dropping the oldest messages for a full queue")
+            else:
+                print("Test FAILED: dropping the oldest messages for a full queue")
+    finally:
+        UserState.queue_limit, UserState.overflow_policy, UserState.message_log, UserState.spill_store = saved
+
+# A spill store must give back what was spilled, in order and a page at a
+# time, and remove a file once it is read. A queue that overflows under SPILL
+# must move to the spill store, drain oldest first, and after a restart be
+# rebuilt from the message log even though old spill files are cleared.
+def test_spill_store():
+    import os
+    import tempfile
+    from message_log import MessageLog
+    from spill_store import SpillStore
+    from userstate import UserState, SPILL
+
+    saved = UserState.queue_limit, UserState.overflow_policy, UserState.message_log, UserState.spill_store
+    UserState.queue_limit, UserState.overflow_policy = 3, SPILL
+    try:
+        messages = [("jordan", "message " + str(i) + " é") for i in range(8)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = SpillStore(os.path.join(directory, "spill"))
+            store.spill("lavanya", messages[:3])
+            store.spill("lavanya", messages[3:5])
+            pages = [store.take("lavanya", 2), store.take("lavanya", 2), store.take("lavanya", 2)]
+            if pages == [messages[:2], messages[2:4], messages[4:5]] and \
+               not os.path.exists(store.path("lavanya")) and store.take("lavanya") == []:
+                print("Test succeeded: spill store round trip")
+            else:
+                print("Test FAILED: spill store round trip")
+
+            path = os.path.join(directory, "messages.log")
+            log = MessageLog(path, commit_interval=0)
+            log.replay()
+            log.start()
+            UserState.message_log, UserState.spill_store = log, store
+            user = UserState("lavanya")
+            accepted = [user.add_message(message) for message in messages]
+            spilled = user.spilled
+            first, _ = user.take_undelivered_page(2)
+            log.close()
+
+            if all(accepted) and spilled == 8 and first == messages[:2] and user.later_count() == 6:
+                print("Test succeeded: spilling a full queue")
+            else:
+                print("Test FAILED: spilling a full queue")
+
+            # restart: the spill files are gone, and the log puts the queue back
+            store = SpillStore(os.path.join(directory, "spill"))
+            cleared = not os.listdir(store.directory)
+            log = MessageLog(path, commit_interval=0)
+            recovered = log.replay()
+            log.start()
+            UserState.message_log, UserState.spill_store = log, store
+            user = UserState("lavanya")
+            user.restore(recovered["lavanya"])
+            spilled = user.spilled
+            rest = user.take_undelivered()
+            log.close()
+
+            if cleared and spilled == 4 and rest == messages[2:]:
+                print("Test succeeded: reloading a spilled queue on restart")
+            else:
+                print("Test FAILED: reloading a spilled queue on restart")
+    finally:
+        UserState.queue_limit, UserState.overflow_policy, UserState.message_log, UserState.spill_store = saved
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+'''
+    counters and latency histograms for the server.
+
+    the server records how long it takes to handle each type of request, and
+    how long a chat waits between add_message and the sendall that delivers it.
+    report() renders them, and any gauges the caller adds, as plaintext, one
+    metric per line:
+
+        requests_total{type="SendChatMessage"} 1200
+        request_seconds{type="SendChatMessage",quantile="0.99"} 0.000041
+        threads 12
+
+    which is what a StatsRequestMessage and the stats endpoint send back.
+'''
+
+import time
+
+# Percentiles reported for every histogram
+QUANTILES = [0.5, 0.9, 0.99, 0.999]
+
+# Histogram buckets per power of two, as a power of two
+SUB_BITS = 4
+SUB_BUCKETS = 1 << SUB_BITS
+
+class Histogram:
+    '''A histogram of durations in nanoseconds, with buckets whose width grows
+       with the value, in the manner of HdrHistogram.
+
+       Values below 32 get a bucket each. Above that, every power of two is split
+       into 16 buckets, so a percentile is accurate to within 1/16 (about 6%) of
+       its value, whether it is a microsecond or a minute, using under a
+       thousand buckets.
+
+       @method record: nanoseconds: int -> None
+           count one value. This is a bit_length, a shift and an increment, cheap
+           enough to call on every request.
+
+       @method percentile: q: float -> int
+           the value below which a fraction <q> of recorded values fall, rounded
+           up to the top of its bucket. 0 if nothing was recorded.
+
+       @attribute count: int
+       @attribute total: int
+       @attribute max: int
+           number, sum and largest of the recorded values.
+
+       @notes
+           record takes no lock. Threads recording into the same bucket at the
+           same moment may lose a count, which a histogram of thousands of
+           values can afford, and the threads serving requests never wait on
+           each other to record them.
+    '''
+
+    def __init__(self):
+        self.counts = [0] * ((64 - SUB_BITS + 1) * SUB_BUCKETS)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, nanoseconds: int):
+        # the top SUB_BITS + 1 bits of the value pick its bucket, and the
+        # position of the top bit which power of two it falls in
+        shift = nanoseconds.bit_length() - SUB_BITS - 1
+        if shift > 0:
+            index = (shift << SUB_BITS) + (nanoseconds >> shift)
+        else:
+            index = nanoseconds
+
+        self.counts[index] += 1
+        self.count += 1
+        self.total += nanoseconds
+        if nanoseconds > self.max:
+            self.max = nanoseconds
+
+    # The largest value that falls in bucket <index>.
+    @staticmethod
+    def bucket_top(index: int) -> int:
+        if index < 2 * SUB_BUCKETS:
+            return index
+
+        shift = (index >> SUB_BITS) - 1
+        return (((index & (SUB_BUCKETS - 1)) + SUB_BUCKETS + 1) << shift) - 1
+
+    def percentile(self, q: float) -> int:
+        target = q * self.count
+        seen = 0
+
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(Histogram.bucket_top(index), self.max)
+
+        return 0
+
+# request handling time by message type name. the number of requests of each
+# type is the count of its histogram.
+requests = {}
+
+# time from add_message queueing a chat for a connected user to the sendall
+# that delivers it. recorded once per delivery, for the message that waited
+# longest.
+delivery = Histogram()
+
+# other events, by name. like the histograms, updated without a lock.
+counters = {}
+
+def count(name: str, n: int = 1):
+    counters[name] = counters.get(name, 0) + n
+
+def record_request(type_name: str, nanoseconds: int):
+    histogram = requests.get(type_name)
+    if histogram is None:
+        histogram = requests.setdefault(type_name, Histogram())
+    histogram.record(nanoseconds)
+
+# <name> with <labels>, a string of name="value" pairs, if there are any.
+def metric(name: str, labels: str = "") -> str:
+    return name + "{" + labels + "}" if labels else name
+
+def seconds(nanoseconds: int) -> str:
+    return "%.6f" % (nanoseconds / 1e9)
+
+# The sum, largest value and percentiles of a histogram, in seconds.
+def histogram_lines(name: str, labels: str, histogram: Histogram) -> list:
+    lines = [metric(name + "_sum_seconds", labels) + " " + seconds(histogram.total),
+             metric(name + "_max_seconds", labels) + " " + seconds(histogram.max)]
+    separator = "," if labels else ""
+
+    for q in QUANTILES:
+        quantile = labels + separator + 'quantile="' + str(q) + '"'
+        lines.append(metric(name + "_seconds", quantile) + " " + seconds(histogram.percentile(q)))
+
+    return lines
+
+# Render every counter and histogram, and <gauges>, a dict of names to current
+# values supplied by the caller, as plaintext.
+def report(gauges: dict) -> str:
+    lines = []
+
+    for type_name, histogram in sorted(requests.items()):
+        lines.append(metric("requests_total", 'type="' + type_name + '"') + " " + str(histogram.count))
+    for type_name, histogram in sorted(requests.items()):
+        lines.extend(histogram_lines("request", 'type="' + type_name + '"', histogram))
+
+    lines.append("deliveries_total " + str(delivery.count))
+    lines.extend(histogram_lines("delivery", "", delivery))
+
+    for name, value in sorted(counters.items()):
+        lines.append(name + "_total " + str(value))
+    for name, value in gauges.items():
+        lines.append(name + " " + str(value))
+
+    return "\n".join(lines) + "\n"
+
+# A monotonic clock in nanoseconds, for timing with the histograms above.
+now = time.perf_counter_ns
@@ -3,65 +3,568 @@
 import socket
 import threading
 import argparse
+import asyncio
+import select
+import os
+import glob
+import itertools
+import functools
+import multiprocessing
+import zlib
+import time
+import secrets
+import signal
+import hmac
+from contextlib import closing
 from userstate import *
+from waker import Waker
+from framing import FrameDecoder, OutboundBuffer, MAX_FRAME_SIZE
+from message_log import MessageLog
+from user_registry import UserRegistry, SortedIndex
+from spill_store import SpillStore
+from hash_ring import HashRing
+from connection_pool import ConnectionPool
+from timing_wheel import TimingWheel
+from file_limit import raise_file_limit
+import serverlog
+import metrics
 from messages import *
 
 HOST = 'localhost'
 PORT = 12345
 
+# per-connection limits on outbound data. the threaded engine drops a
+# connection whose writes block for longer than WRITE_TIMEOUT seconds; the
+# asyncio engine holds back deliveries while more than WRITE_LIMIT bytes are
+# waiting to be written to a connection.
+WRITE_TIMEOUT = 30
+WRITE_LIMIT = 1024 * 1024
+
+# outbound coalescing. the frames written to a connection while requests and
+# deliveries are handled are gathered and sent with one call, as soon as there
+# is nothing more to write for now or FLUSH_SIZE bytes are waiting. NODELAY
+# sets TCP_NODELAY on every connection, so a flush goes out at once rather than
+# behind Nagle's algorithm; CORK holds back the tail of a flush that takes
+# several calls (threaded engine, Linux only).
+FLUSH_SIZE = 65536
+NODELAY = True
+CORK = False
+
+# admission control. the threaded engine serves at most MAX_CONNECTIONS
+# connections at once, one per pool thread, and queues up to CONNECTION_QUEUE
+# more until a thread is free, for at most CONNECTION_WAIT seconds each. the
+# asyncio engine serves at most
+# MAX_CONNECTIONS, if set. connections beyond that are turned away with an
+# ErrorMessage. LISTEN_BACKLOG bounds the connections the kernel holds for us
+# before we accept them.
+MAX_CONNECTIONS = None
+THREAD_MAX_CONNECTIONS = 1000
+CONNECTION_QUEUE = 1000
+CONNECTION_WAIT = 10
+LISTEN_BACKLOG = 4096
+
+# seconds a session is kept after its connection drops, still "here", for the
+# client to resume with the token it was issued on login. 0 logs the user out
+# as soon as the connection drops, and issues no tokens.
+RESUME_GRACE = 30
+
+# heartbeats. a client the server has heard nothing from for HEARTBEAT seconds
+# is sent a PingMessage, and its client library answers with a PongMessage. a
+# connection silent for IDLE_TIMEOUT seconds is dropped, so a client that
+# vanished without closing its connection stops holding its user "here". 0
+# turns either off.
+HEARTBEAT = 15
+IDLE_TIMEOUT = 45
+
+# the most entries one UndeliveredPageMessage or UserPageResponseMessage may
+# carry, whatever the client asks for
+MAX_PAGE_SIZE = 1000
+
 # dictionary mapping usernames:UserStates for all users in the system
 # users are added when accounts are created and removed upon account deletion
-# note that the server has no persistent storage. this was a design decision
-# to reduce developer time. if this server needed to be more robust or reliable,
-# we would add persistent state.
+# account names persist in the user registry, and messages queued for "away"
+# users persist in the message log (see message_log.py).
 users = {}
 
+# the permanent account list (see user_registry.py). None when the server runs
+# without persistent accounts.
+registry = None
+
+# every username in sorted order, kept in step with users, for paging through
+# and searching the user directory. connection threads add, remove and search
+# names at once, so every use of it holds directory_lock.
+directory = SortedIndex()
+directory_lock = threading.Lock()
+
+# dictionary mapping channel names to the frozenset of their members' usernames.
+# a channel's set is replaced, never changed, under channels_lock, so senders
+# can fan out to a snapshot of the members without taking the lock. channels
+# exist while they have members, and memberships persist in the user registry.
+channels = {}
+channels_lock = threading.Lock()
+
+# every connection's heartbeat and every detached session's grace period is a
+# timer on this one wheel, advanced by one thread (see timing_wheel.py), so
+# idle connections cost no thread wakeups or socket timeouts of their own
+timers = TimingWheel()
+timers_lock = threading.Lock()
+
+# users whose sessions are detached, waiting to be resumed, mapped to the timer
+# that logs them out when the grace period runs out
+detached = {}
+detached_lock = threading.Lock()
+
+PING_FRAME = bytes(PingMessage().serialize())
+
+# the threaded engine's pool of connection threads (see connection_pool.py)
+connection_pool = None
+
+# open and turned away connections, for the asyncio engine
+open_connections = 0
+rejected_connections = 0
+
+# the other worker processes, when the server runs as several (see Peers).
+# None when this process serves every user itself.
+peers = None
+
 # helper functions
 
+# True if this process owns <key>, a username or channel name. A server that
+# runs as one process owns everything.
+def owns(key):
+    return peers is None or peers.owns(key)
+
 # send all new messages to a user over the connection by emptying the user's
-# deliver queue
-def send_new_messages(user, conn):
-    messages = []
+# deliver queue, as far as the user's unacked window allows. the messages are
+# numbered, and kept until acknowledged if the client acknowledges. the time
+# the oldest message waited is recorded. only the connection with the user's
+# <wakeup> is sent anything, so one whose session was taken over gets nothing.
+def send_new_messages(user, conn, wakeup):
+    state = users.get(user)
+    if state is None or state.wakeup is not wakeup:
+        return
 
-    while user and not users[user].deliver_now.empty():
-        messages.append(users[user].deliver_now.get())
+    queued_at = state.queued_at
+    messages = state.take_deliver_now(state.window_room())
+    if not messages:
+        return
 
-    if messages:
-        conn.sendall(DeliverMessage(messages).serialize())
+    send_numbered(conn, state.number_sent(messages), messages)
+    metrics.delivery.record(metrics.now() - queued_at)
 
-# Read a complete message into a buffer, and deserialize it into its appropriate
-# subclass of message.
-def read_message(conn):
-    # exception will be raised if no data is available before the timeout
-    try:
-        raw_message = conn.recv(4096)
-    except socket.timeout:
-        return None
+# write <messages> to the connection, numbered from <first_sequence>. runs of
+# ordinary messages are batched into one DeliverMessage; shared messages
+# already carry their frame, which is written in parts around its new number,
+# without serializing the message again or copying the frame. the connection
+# gathers the parts into one send.
+def send_numbered(conn, first_sequence, messages):
+    batch = []
+    batch_sequence = first_sequence
+    for sequence, message in enumerate(messages, first_sequence):
+        if type(message) is SharedMessage:
+            if batch:
+                conn.sendall(DeliverMessage(batch, batch_sequence).serialize())
+                batch = []
+            for part in DeliverMessage.renumber_parts(message.frame, sequence):
+                conn.sendall(part)
+        else:
+            if not batch:
+                batch_sequence = sequence
+            batch.append(message)
+
+    if batch:
+        conn.sendall(DeliverMessage(batch, batch_sequence).serialize())
 
-    # message length does not include headers
-    message_len = extract_length(raw_message) + 12
-    current_len = len(raw_message)
+# Add <user> to or remove them from <channel>, recording the change in the
+# registry.
+def join_channel(user, channel):
+    with channels_lock:
+        channels[channel] = channels.get(channel, frozenset()) | {user}
+        if registry:
+            registry.join(user, channel)
+
+def leave_channel(user, channel):
+    with channels_lock:
+        members = channels.get(channel, frozenset()) - {user}
+        if members:
+            channels[channel] = members
+        else:
+            channels.pop(channel, None)
+        if registry:
+            registry.leave(user, channel)
+
+# Remove <user> from every channel they are in, when their account goes away.
+# Other workers are told to do the same with the channels they own.
+def leave_all_channels(user, everywhere=True):
+    for channel, members in list(channels.items()):
+        if user in members:
+            leave_channel(user, channel)
+
+    if peers and everywhere:
+        peers.broadcast(LeaveChannelsMessage(user))
+
+# Send one message from <user> to every other member of <channel>. The message,
+# and the frame delivering it, are built once and shared by every recipient.
+# Members owned by other workers are sent the message in one FanOutMessage per
+# worker. Returns the number of members here whose queues were full.
+def fan_out(user, channel, body):
+    message = SharedMessage(channel + "/" + user, body)
+    members = []
+    remote = {}
+
+    for member in channels.get(channel, ()):
+        if member == user:
+            continue
+        if owns(member):
+            members.append(member)
+        else:
+            remote.setdefault(peers.owner(member), []).append(member)
+
+    for index, remote_members in remote.items():
+        peers.send(index, FanOutMessage(message[0], body, remote_members))
+
+    return add_to_members(message, members)
+
+# Queue a shared message for every one of <members> that still has an account.
+# Returns the number of members whose queues were full.
+def add_to_members(message, members):
+    rejected = 0
+
+    for member in members:
+        state = users.get(member)
+        if state and not state.add_message(message):
+            rejected += 1
+
+    return rejected
+
+# Give the session that just logged in as <user> a resume token.
+def issue_session(user, conn):
+    if RESUME_GRACE:
+        users[user].resume_token = secrets.token_urlsafe(16)
+        conn.sendall(SessionMessage(users[user].resume_token).serialize())
+
+# Schedule callback(*args) on the timing wheel, or cancel a timer. Safe to
+# call from any thread.
+def schedule(delay, callback, *args):
+    with timers_lock:
+        return timers.schedule(delay, callback, *args)
+
+def cancel(timer):
+    with timers_lock:
+        timers.cancel(timer)
+
+# Advance the timing wheel every tick, and fire the timers that are due.
+def run_timers():
+    while True:
+        time.sleep(timers.tick)
+        with timers_lock:
+            due = timers.advance(time.monotonic())
+
+        for timer in due:
+            try:
+                timer.fire()
+            except Exception as e:
+                serverlog.error("timer_failed", error=e)
 
-    # loop until we recieve the whole message
-    # ToDo add a timeout here too
-    while current_len < message_len:
-        data = conn.recv(4096)
-        current_len += len(data)
-        raw_message += data
+def start_timers():
+    threading.Thread(target=run_timers, daemon=True).start()
 
+class Heartbeat:
+    '''Whether a client connection is still alive, checked on the timing wheel.
+
+       Each check looks at when the client was last heard from. If that was
+       recently, the next check is scheduled for when it will have been silent
+       for HEARTBEAT seconds, so a busy connection costs one check per HEARTBEAT
+       seconds however many requests it sends.
+
+       @attribute last_heard: float
+           time.monotonic() when anything last arrived on the connection. The
+           connection sets it as requests arrive.
+
+       @attribute ping_due: bool
+           set when the client should be sent a PingMessage.
+
+       @attribute timed_out: bool
+           set when the client has been silent for IDLE_TIMEOUT seconds, and the
+           connection should be dropped.
+
+       @method close: () -> None
+           stop checking, once the connection is closed.
+
+       @notes
+           Checks run on the timer thread. They only set the flags above and call
+           <notify>, and the connection acts on them on its own thread or event
+           loop, so that only the connection ever writes to its socket.
+    '''
+
+    __slots__ = ("last_heard", "ping_due", "timed_out", "notify", "timer", "closed")
+
+    def __init__(self, notify):
+        self.last_heard = time.monotonic()
+        self.ping_due = False
+        self.timed_out = False
+        self.notify = notify
+        self.timer = None
+        self.closed = False
+
+        if HEARTBEAT or IDLE_TIMEOUT:
+            self.timer = schedule(HEARTBEAT or IDLE_TIMEOUT, self.check)
+
+    def check(self):
+        if self.closed:
+            return
+
+        silent = time.monotonic() - self.last_heard
+        if IDLE_TIMEOUT and silent >= IDLE_TIMEOUT:
+            metrics.count("idle_disconnects")
+            self.timed_out = True
+            self.notify()
+            return
+
+        if HEARTBEAT and silent >= HEARTBEAT:
+            metrics.count("heartbeats_sent")
+            self.ping_due = True
+            self.notify()
+            delay = HEARTBEAT
+        else:
+            delay = (HEARTBEAT or IDLE_TIMEOUT) - silent
+
+        if IDLE_TIMEOUT:
+            delay = min(delay, IDLE_TIMEOUT - silent)
+        self.timer = schedule(delay, self.check)
+
+    def close(self):
+        self.closed = True
+        if self.timer:
+            cancel(self.timer)
+
+# The connection with <wakeup> of the session logged in as <user> has dropped.
+# Keep the session for RESUME_GRACE seconds, in case the client comes back to
+# resume it, before logging the user out. A connection whose session was taken
+# over no longer holds it, and leaves it alone. A connection dropped for being
+# idle is detached the same way: its client may only have lost its network
+# path, and comes back to resume.
+def detach_session(user, wakeup):
+    state = users.get(user)
+    if state is None or wakeup is None or state.wakeup is not wakeup:
+        return
+
+    if not RESUME_GRACE or not state.resume_token:
+        state.logout()
+        return
+
+    state.detach()
+    with detached_lock:
+        detached[user] = schedule(RESUME_GRACE, expire_session, user)
+
+# Take <user> off the detached sessions, for a client that resumes or replaces
+# the session. Returns False if the session is not detached, or has just
+# expired.
+def take_detached(user):
+    with detached_lock:
+        timer = detached.pop(user, None)
+    if timer is None:
+        return False
+
+    cancel(timer)
+    return True
+
+# Take the session of <user> from the connection it is attached to, for a
+# client that resumes it on a new connection before the server has noticed
+# the old one is gone, as after a silent network drop. The old connection is
+# woken, finds it no longer holds the session, and closes. Returns False if
+# the session is not attached to a connection.
+def take_attached(user):
+    state = users[user]
+    wakeup = state.wakeup
+    if wakeup is None:
+        return False
+
+    state.detach()
+    metrics.count("sessions_taken_over")
+    wakeup()
+    return True
+
+# Whether the connection with <wakeup> holds the session of <user>, or has
+# nothing to hold here: no user, or one owned by another server process.
+def holds_session(user, wakeup):
+    return user not in users or users[user].wakeup is wakeup
+
+# Log out a detached session, so that a new login can take its place.
+def end_detached(user):
+    if take_detached(user):
+        users[user].logout()
+        return True
+    return False
+
+# The grace period of a detached session has run out. A timer that has fired
+# is off the wheel, which tells it apart from the timer of a later detach.
+def expire_session(user):
+    with detached_lock:
+        timer = detached.get(user)
+        if timer is None or timer.slot is not None:
+            return
+        del detached[user]
+
+    if user in users:
+        users[user].logout()
+    metrics.count("sessions_expired")
+
+# The lsn of the last message this thread queued in the message log, or 0.
+def last_logged():
+    log = UserState.message_log
+    return log.last_logged() if log else 0
+
+# Block until the messages this thread's requests queued for later are in the
+# message log on disk, so that the client is answered only once what it sent
+# would survive a crash. The threaded engine calls this before each flush.
+def wait_for_log():
+    log = UserState.message_log
+    if log:
+        log.wait_for_commit(log.last_logged())
+
+# After a request, point the wakeup of the user it logged in (if any) at this
+# connection, so add_message can wake the connection instead of it polling.
+def attach_connection(previous_user, user, wakeup):
+    if user and user != previous_user and user in users:
+        users[user].attach(wakeup)
+
+# Turn Nagle's algorithm off or on for a client connection, as NODELAY says.
+def set_nodelay(sock):
     try:
-        result = deserialize_message(raw_message)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(NODELAY))
+    except (AttributeError, OSError):
+        pass
+
+# Deserialize a request read from a client into its appropriate subclass of
+# message. Messages between server processes are only accepted on the links
+# between them, so a client that sends one is answered with an error on
+# <conn>. Returns None if the frame is refused or cannot be deserialized.
+def decode_request(frame, conn):
+    if extract_type(frame) >= FIRST_PEER_MESSAGE_ID:
+        metrics.count("peer_frames_refused")
+        serverlog.warning("peer_frame_refused", type=extract_type(frame))
+        send_error_message(conn, "That message type is only accepted between servers.")
+        return None
+
+    try:
+        return deserialize_message(frame)
     except Exception as e:
-        print("Failed to deserialize message " + str(e.message))
+        metrics.count("bad_frames")
+        serverlog.warning("bad_frame", error=e)
         return None
 
-    return result
+# Read whatever bytes are available on the connection into its frame decoder,
+# and yield every request they complete. A client may pipeline several
+# requests into one read, or split one request across many, so this often
+# yields nothing. Each frame is only decoded once the request before it has
+# been handled, so errors are answered in order. Raises if the connection has
+# been closed.
+def read_messages(conn, decoder, out):
+    if not decoder.recv_from(conn):
+        raise ConnectionError("Connection closed by client.")
+
+    for frame in decoder.frames():
+        request = decode_request(frame, out)
+        if request:
+            yield request
+
+# Turn away a connection we have no room for, telling the client why. This
+# must not block the accept loop, so the error is only sent if it fits in the
+# socket's send buffer, which it always should on a new connection.
+def reject_connection(conn):
+    try:
+        conn.setblocking(False)
+        conn.send(ErrorMessage("The server is at capacity. Please try again later.").serialize())
+    except OSError:
+        pass
+    finally:
+        conn.close()
+
+# Log how many connections are being served, waiting and turned away, every
+# <interval> seconds while the numbers change.
+def report_connections(interval):
+    last = None
+    while True:
+        time.sleep(interval)
+        if connection_pool:
+            counts = (connection_pool.active, connection_pool.queued, connection_pool.rejected)
+        else:
+            counts = (open_connections, 0, rejected_connections)
+
+        if counts != last:
+            serverlog.info("connections", active=counts[0], queued=counts[1], rejected=counts[2])
+            last = counts
+
+def start_reporting(interval):
+    if interval:
+        threading.Thread(target=report_connections, args=(interval,), daemon=True).start()
+
+# The current size of the server's queues, connections and threads. Adding up
+# the queues visits every user, so this is only worked out when asked for.
+def gauges():
+    deliver_now = deliver_later = unacked = 0
+    for state in list(users.values()):
+        deliver_now += len(state.deliver_now or ())
+        deliver_later += state.later_count()
+        unacked += len(state.unacked or ())
+
+    if connection_pool:
+        active, queued, rejected = connection_pool.active, connection_pool.queued, connection_pool.rejected
+    else:
+        active, queued, rejected = open_connections, 0, rejected_connections
+
+    return {
+        "users": len(users),
+        "channels": len(channels),
+        "deliver_now_messages": deliver_now,
+        "deliver_later_messages": deliver_later,
+        "unacked_messages": unacked,
+        "detached_sessions": len(detached),
+        "timers": len(timers),
+        "connections_active": active,
+        "connections_queued": queued,
+        "connections_rejected": rejected,
+        "threads": threading.active_count(),
+    }
+
+def stats_report():
+    return metrics.report(gauges())
+
+# Serve stats_report() as plain text to anything that connects to <port> on
+# this machine, e.g. curl http://localhost:<port>/. The request is read and
+# ignored, whatever it is.
+def serve_stats(port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(("localhost", port))
+        s.listen()
+        serverlog.info("stats_listening", port=port)
+
+        while True:
+            try:
+                conn, _ = s.accept()
+                with conn:
+                    conn.settimeout(1)
+                    try:
+                        conn.recv(4096)
+                    except socket.timeout:
+                        pass
+                    body = str.encode(stats_report())
+                    conn.sendall(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\nContent-Length: " +
+                                 str.encode(str(len(body))) + b"\r\n\r\n" + body)
+            except Exception as e:
+                serverlog.warning("stats_request_failed", error=e)
+
+def start_stats_endpoint(port):
+    if port:
+        threading.Thread(target=serve_stats, args=(port,), daemon=True).start()
 
 # package and send <err_msg> to the client on conn
 def send_error_message(conn, err_msg):
-    print("TEST")
+    metrics.count("errors_sent")
+    serverlog.debug("error_sent", error=err_msg)
     response = ErrorMessage(err_msg)
-    print("SENDING ERROR: ", err_msg)
     conn.send(response.serialize())
 
 # handle a single request from the client.
@@ -70,10 +573,12 @@ def handle_request(user, conn, message):
     # Predicate for whether a message requires you to be logged in to
     # use it.
     def message_requires_logged_in(message_type):
-        return message_type not in [CreateAccountMessage, HereMessage]
+        return message_type not in [CreateAccountMessage, HereMessage, ResumeMessage]
 
+    start = metrics.now()
     message_type = type(message)
-    print("Received a " + str(message_type))
+    if serverlog.level <= serverlog.DEBUG:
+        serverlog.debug("request", type=message_type.__name__, user=user)
 
     # Next, we process the message, conditioning on type.
 
@@ -81,33 +586,72 @@ def handle_request(user, conn, message):
     if message_type == PingMessage:
         conn.send(PongMessage().serialize())
 
+    # the answer to a heartbeat. hearing from the client is all that counts.
+    elif message_type == PongMessage:
+        pass
+
     # users need to be "here" to use most features
     elif not user and message_requires_logged_in(message_type):
         send_error_message(conn, "Please log in or create an account before making requests.")
 
+    # this server's metrics, as served by the stats endpoint. the client port
+    # is public, so only users get them here.
+    elif message_type == StatsRequestMessage:
+        conn.sendall(StatsResponseMessage(stats_report()).serialize())
+
     # similar to a login method, except that our server does not authenticate users :O
     elif message_type == HereMessage:
         if message.username not in users:
             send_error_message(conn, "Account does not exist.")
-        elif users[message.username].is_here():
+        elif users[message.username].is_here() and not end_detached(message.username):
             send_error_message(conn, "You are logged in from a different device")
         else: 
             users[message.username]
             user = message.username
             users[user].login()
+            issue_session(user, conn)
+
+    # reattach to a session whose connection dropped. the chats the client may
+    # have missed are sent again, and those queued meanwhile follow once the
+    # connection is attached. a session the server still thinks is connected
+    # is taken over from its old connection.
+    elif message_type == ResumeMessage:
+        state = users.get(message.username)
+        if state is None or not state.resume_token or \
+           not hmac.compare_digest(str.encode(state.resume_token), str.encode(message.token)) or \
+           not (user == message.username or take_detached(message.username) or take_attached(message.username)):
+            send_error_message(conn, "That session can no longer be resumed. Please log in again.")
+        else:
+            user = message.username
+            metrics.count("sessions_resumed")
+            conn.sendall(SessionMessage(state.resume_token).serialize())
+
+            first_sequence, resend = state.acknowledge(message.last_sequence, resume=True)
+            if resend:
+                metrics.count("retransmitted_messages", len(resend))
+                send_numbered(conn, first_sequence, resend)
 
     # the user is also automatically marked as "here" for the newly created account
     elif message_type == CreateAccountMessage:
-        if message.username in users and users[message.username].is_here():
+        if message.username in users and users[message.username].is_here() and not end_detached(message.username):
             send_error_message(conn, "You are logged in from a different device")
         else:
+            # recreating an account starts it over with an empty queue and
+            # no channels
+            if message.username in users:
+                users[message.username].delete()
+                leave_all_channels(message.username)
+
             user = message.username
             users.update({user: UserState(user)})
             users[user].login()
+            with directory_lock:
+                directory.add(user)
+            issue_session(user, conn)
 
-            # add to permanent acccount list
-            with (open("users.txt", "a+")) as f:
-                f.write(user + "\n")
+            # add to permanent acccount list. this only queues the write.
+            if registry:
+                registry.create(user)
 
     # again, like a logout without authentication
     elif message_type == AwayMessage:
@@ -123,117 +667,1075 @@ def handle_request(user, conn, message):
         target = message.username.strip()
 
         if target not in users:
-            print(target, users)
             send_error_message(conn, "Recipient user does not exist. Please try again.")
         else:
-            print("Received email for ", target)
-            users[target].add_message((user, message.body))
+            if not users[target].add_message((user, message.body)):
+                send_error_message(conn, "Recipient has too many undelivered messages. Please try again later.")
+
+    # channels are created by their first member, and forgotten when their
+    # last member leaves
+    elif message_type == JoinChannelMessage:
+        if not message.channel.startswith("#") or len(message.channel) < 2:
+            send_error_message(conn, "Channel names start with #.")
+        else:
+            join_channel(user, message.channel)
+
+    elif message_type == LeaveChannelMessage:
+        if user not in channels.get(message.channel, ()):
+            send_error_message(conn, "You are not in that channel.")
+        else:
+            leave_channel(user, message.channel)
+
+    # delivered to every other member, immediately or on demand depending on
+    # their "here" status, like a chat
+    elif message_type == SendChannelMessage:
+        if user not in channels.get(message.channel, ()):
+            send_error_message(conn, "You are not in that channel. Please join it first.")
+        else:
+            rejected = fan_out(user, message.channel, message.body)
+            if rejected:
+                send_error_message(conn, str(rejected) + " members of the channel have too many undelivered messages "
+                                   "and did not get yours.")
 
     # send back a list of all users
     elif message_type == RequestUserListMessage:
         response = UserListResponseMessage(list(users.keys()))
-        conn.send(response.serialize())
+        conn.sendall(response.serialize())
+
+    # send back one page of the users matching a prefix, from the sorted index
+    elif message_type == SearchUsersMessage:
+        page_size = min(message.limit or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+        with directory_lock:
+            user_list, token = directory.search(message.prefix, page_size, message.continuation_token)
+        conn.sendall(UserPageResponseMessage(user_list, token).serialize())
 
     # you can only delete yourself for security reasons
     elif message_type == DeleteAccountMessage:
         if not user:
             send_error_message(conn, "Please log in to delete your account.")
         else:
-            users.pop(user)
+            users.pop(user).delete()
+            with directory_lock:
+                directory.discard(user)
+            leave_all_channels(user)
+            if registry:
+                registry.delete(user)
             user = None
 
     # note that we deliver undelivered messages recieved both while the user was
     # "away" and "here"
     elif message_type == ShowUndeliveredMessage:
-        messages = []
-
-        while not users[user].deliver_later.empty():
-            messages.append(users[user].deliver_later.get())
+        response = DeliverMessage(users[user].take_undelivered())
+        conn.sendall(response.serialize())
 
-        while not users[user].deliver_now.empty():
-            messages.append(users[user].deliver_now.get())
+    # the paged variant of the above. every request takes one page off the
+    # user's queues, so a long backlog never has to fit in one frame or in
+    # memory at once.
+    elif message_type == RequestUndeliveredPageMessage:
+        page_size = min(message.max_messages or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+        next_cursor, messages, end_of_stream = users[user].take_page(message.cursor, page_size)
+        response = UndeliveredPageMessage(next_cursor, messages, end_of_stream)
+        conn.sendall(response.serialize())
 
-        response = DeliverMessage(messages)
-        conn.send(response.serialize())
+    # the client has the chats numbered up to message.sequence. the first
+    # acknowledgment of a session resumes it, sending again whatever the last
+    # session was sent and may not have received. either way the window may now
+    # have room for more.
+    elif message_type == AckMessage:
+        first_sequence, resend = users[user].acknowledge(message.sequence)
+        if resend:
+            metrics.count("retransmitted_messages", len(resend))
+            send_numbered(conn, first_sequence, resend)
+        send_new_messages(user, conn, users[user].wakeup)
 
     else:
-        print("Unable to handle request. Invalid message type")
+        serverlog.warning("unknown_request", type=message_type.__name__)
 
+    metrics.record_request(message_type.__name__, metrics.now() - start)
     return user
 
 # A per-user thread runs this loop to handle requests and dispatch new
-# server to client messages.
+# server to client messages. The thread sleeps in select until either the
+# client sends a request or add_message wakes it to deliver a chat.
 def connection_thread(conn):
     user = None
+    waker = Waker()
+    wakeup = waker.wake
+    decoder = FrameDecoder()
+    heartbeat = Heartbeat(wakeup)
+
+    # a client that stops reading fills up its socket's send buffer. rather
+    # than block this thread forever, give up on it after WRITE_TIMEOUT seconds.
+    # reads are unaffected, since we only read once select says we can.
+    conn.settimeout(WRITE_TIMEOUT)
+    set_nodelay(conn)
+
+    # responses and deliveries are written here, and sent in one go before the
+    # thread next waits, once the messages queued by the requests they answer
+    # are on disk
+    out = OutboundBuffer(conn, FLUSH_SIZE, CORK, wait_for_log)
+
+    with conn, closing(waker), closing(heartbeat):
+        try:
+            while True:
+                # deliver any messages in the user's queue, and send everything
+                # written since the last wait
+                send_new_messages(user, out, wakeup)
+                out.flush()
+
+                readable, _, _ = select.select([conn, waker], [], [])
+
+                # clear before the next delivery pass so that a chat queued
+                # after the pass still wakes us up
+                if waker in readable:
+                    waker.clear()
+
+                    if not holds_session(user, wakeup):
+                        raise ConnectionError("The session was resumed on another connection.")
+                    if heartbeat.timed_out:
+                        raise ConnectionError("No heartbeat from the client.")
+                    if heartbeat.ping_due:
+                        heartbeat.ping_due = False
+                        out.sendall(PING_FRAME)
+
+                if conn not in readable:
+                    continue
+                heartbeat.last_heard = time.monotonic()
+
+                # process any new requests from the client. chats a request
+                # queued for this user are delivered before the next request
+                # is answered, as the asyncio engine does, so a client can
+                # tell they have arrived by pipelining a ping behind it.
+                for request in read_messages(conn, decoder, out):
+                    try:
+                        previous_user = user
+                        user = handle_request(user, out, request)
+                        attach_connection(previous_user, user, wakeup)
+                        send_new_messages(user, out, wakeup)
+                    except OSError:
+                        raise
+                    except Exception as e:
+                        metrics.count("failed_requests")
+                        serverlog.error("request_failed", type=type(request).__name__, user=user, error=e)
+
+        except Exception as e:
+            serverlog.info("connection_dropped", user=user, reason=e)
+            detach_session(user, wakeup)
+
+# Open the user registry and resume the server state with its users and
+# channels, or with those this worker owns.
+# A new registry imports the names in the legacy users.txt, if there is one.
+def load_users(filename):
+    global registry, directory
+    registry = UserRegistry(filename, legacy_path="users.txt")
+
+    # workers share one registry, and each loads the users it owns. a cluster
+    # node loads every user in its own registry, and hands those it no longer
+    # owns to their new owners (see ClusterPeers).
+    for username in registry.load():
+        if owns(username) or not peers.shared_storage:
+            users[username] = UserState(username)
+
+    directory = SortedIndex(users.keys())
+
+    members = {}
+    for channel, username in registry.load_memberships():
+        if owns(channel) or not peers.shared_storage:
+            members.setdefault(channel, set()).add(username)
+    for channel, usernames in members.items():
+        channels[channel] = frozenset(usernames)
+
+# Set up the user queues, and load the users, channels and queued messages
+# this process serves.
+def load_state(args, log, spill_dir):
+    UserState.queue_limit = args.queue_limit
+    UserState.overflow_policy = args.overflow
+    UserState.ack_window = args.ack_window
+    UserState.spill_store = SpillStore(spill_dir)
+
+    load_users(args.users)
+
+    load_messages(log, args.commit_interval / 1000)
+
+# Replay the message log so that messages queued for "away" users before a
+# restart are waiting for them again, then start logging new ones.
+def load_messages(filename, commit_interval):
+    message_log = MessageLog(filename, commit_interval)
+
+    for recipient, messages in message_log.replay().items():
+        if recipient in users:
+            users[recipient].restore(messages)
+        else:
+            # the account is gone, so are its messages
+            message_log.recovered.pop(recipient)
+
+    message_log.start()
+    UserState.message_log = message_log
+
+
+# asyncio engine
+
+# Adapts an asyncio StreamWriter to the subset of the socket interface used by
+# handle_request and send_new_messages, so that both server engines share the
+# same request handling. Writes never block. They are gathered until the event
+# loop's next turn, or until FLUSH_SIZE bytes are waiting, and handed to the
+# transport together, so the answers to a burst of pipelined requests and the
+# chats they deliver go out in one send.
+class StreamConnection:
+    def __init__(self, writer):
+        self.writer = writer
+        self.pending = []
+        self.pending_size = 0
+        self.flush_scheduled = False
+        self.held_lsn = 0
+        self.waiting_lsn = 0
+        writer.transport.set_write_buffer_limits(high=WRITE_LIMIT)
+
+    # Hold back everything written until the message log has committed <lsn>,
+    # the last message queued by a request, so that the client is answered
+    # only once what it sent would survive a crash. The event loop does not
+    # wait meanwhile.
+    def hold_until(self, lsn):
+        self.held_lsn = max(self.held_lsn, lsn)
+
+    def wait_for_log(self):
+        if self.waiting_lsn >= self.held_lsn:
+            return
+
+        lsn = self.waiting_lsn = self.held_lsn
+        loop = asyncio.get_running_loop()
+        UserState.message_log.on_commit(lsn, lambda: loop.call_soon_threadsafe(self.committed, lsn))
+
+    def committed(self, lsn):
+        if self.held_lsn <= lsn:
+            self.held_lsn = 0
+        self.flush()
+
+    # True while the client is not keeping up with what we write to it.
+    def backlogged(self):
+        return self.writer.transport.get_write_buffer_size() + self.pending_size >= WRITE_LIMIT
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def sendall(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+
+        if self.pending_size >= FLUSH_SIZE:
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        if self.held_lsn:
+            self.wait_for_log()
+            return
+
+        if self.pending and not self.writer.transport.is_closing():
+            self.writer.writelines(self.pending)
+        self.pending = []
+        self.pending_size = 0
+
+# Read a complete frame, header included, from an asyncio StreamReader.
+# Raises if the connection is closed, or if the frame is larger than
+# <max_size>, as FrameDecoder does for the threaded engine. Links between
+# server processes pass None, since a handoff carries a user's whole backlog.
+async def read_frame_async(reader, max_size=MAX_FRAME_SIZE):
+    header = await reader.readexactly(HEADER_SIZE)
+    length = extract_length(header)
+    if max_size is not None and length > max_size:
+        metrics.count("oversized_frames")
+        raise ConnectionError("Frame of " + str(length) + " bytes exceeds the maximum frame size.")
+
+    return header + await reader.readexactly(length)
+
+# Read a complete message from the link to another server process and
+# deserialize it. Returns None if the message could not be deserialized.
+# Raises if the connection is closed.
+async def read_message_async(reader):
+    frame = await read_frame_async(reader, max_size=None)
+
+    try:
+        return deserialize_message(frame, peer=True)
+    except Exception as e:
+        metrics.count("bad_frames")
+        serverlog.warning("bad_frame", error=e)
+        return None
+
+# Each connection is served by one coroutine instead of one thread. This is the
+# asyncio counterpart of connection_thread. The coroutine only waits on the
+# socket: deliveries are pushed into the transport by a wakeup callback that
+# add_message schedules on the event loop, so idle connections never run.
+async def connection_coroutine(reader, writer):
+    global open_connections, rejected_connections
+
+    if MAX_CONNECTIONS is not None and open_connections >= MAX_CONNECTIONS:
+        rejected_connections += 1
+        writer.write(ErrorMessage("The server is at capacity. Please try again later.").serialize())
+        writer.close()
+        return
+
+    open_connections += 1
+    try:
+        await serve_connection(reader, writer)
+    finally:
+        open_connections -= 1
+
+async def serve_connection(reader, writer):
+    user = None
+    conn = StreamConnection(writer)
+    set_nodelay(writer.get_extra_info("socket"))
+    loop = asyncio.get_running_loop()
+
+    connection_id = next(connection_ids)
+    if peers:
+        peers.sessions[connection_id] = conn
+
+    draining = False
+
+    # wakeups may come from any thread, so hop onto the loop before writing.
+    # the callback reads the current user, so it follows logins and logouts.
+    # a client that is not reading gets nothing more until its transport has
+    # drained; meanwhile its messages wait in its bounded queues.
+    def deliver():
+        nonlocal draining
+        if not holds_session(user, wakeup):
+            writer.transport.abort()
+            return
+        if draining:
+            return
+
+        if conn.backlogged():
+            draining = True
+            loop.create_task(deliver_after_drain())
+        else:
+            send_new_messages(user, conn, wakeup)
 
-    # set a timeout of 0.5 seconds to avoid blocking on the socket
-    conn.settimeout(0.5)
-    with conn:
+    async def deliver_after_drain():
+        nonlocal draining
+        try:
+            await writer.drain()
+        except ConnectionError:
+            return
+        finally:
+            draining = False
+        deliver()
+
+    def wakeup():
+        loop.call_soon_threadsafe(deliver)
+
+    def check_heartbeat():
+        if heartbeat.timed_out:
+            writer.transport.abort()
+        elif heartbeat.ping_due:
+            heartbeat.ping_due = False
+            conn.sendall(PING_FRAME)
+
+    heartbeat = Heartbeat(lambda: loop.call_soon_threadsafe(check_heartbeat))
+
+    try:
         while True:
-            # deliver any messages in the user's queue
-            send_new_messages(user, conn)
+            request = decode_request(await read_frame_async(reader), conn)
+            heartbeat.last_heard = time.monotonic()
+
+            if request:
+                try:
+                    previous_user = user
+                    if peers and peers.routes(user, request):
+                        user = await peers.route(user, connection_id, request, conn)
+                    else:
+                        # hold the answer until what the request queued is on
+                        # disk. a forwarded request is held by its owner.
+                        logged = last_logged()
+                        user = handle_request(user, conn, request)
+                        if last_logged() != logged:
+                            conn.hold_until(last_logged())
+                    attach_connection(previous_user, user, wakeup)
+                except Exception as e:
+                    metrics.count("failed_requests")
+                    serverlog.error("request_failed", type=type(request).__name__, user=user, error=e)
+
+            # deliver anything queued before the wakeup was attached, and stop
+            # reading from a client that is not reading our responses
+            deliver()
+            await writer.drain()
 
-            # process any new request from the client
+    except (asyncio.IncompleteReadError, ConnectionError) as e:
+        serverlog.info("connection_dropped", user=user, reason=e)
+        if user in users:
+            detach_session(user, wakeup)
+        elif peers and user:
+            await peers.route(user, connection_id, DetachMessage(), conn)
+    finally:
+        heartbeat.close()
+        if peers:
+            peers.sessions.pop(connection_id, None)
+        conn.flush()
+        writer.close()
+
+# identifies each connection to the worker processes that push deliveries to it
+connection_ids = itertools.count(1)
+
+async def serve_asyncio(host, port, reuse_port=False):
+    raise_file_limit()
+    if peers:
+        await peers.connect()
+
+    server = await asyncio.start_server(connection_coroutine, host, port, backlog=LISTEN_BACKLOG, reuse_port=reuse_port)
+    serverlog.info("listening", host=host, port=port, engine="asyncio")
+
+    async with server:
+        await server.serve_forever()
+
+# threaded engine
+
+# hand each new connection to a pool thread to allow multiple simultaneous
+# connections. this allows the server to maintain state for each connection.
+# the pool is bounded, so a storm of connections cannot start a thread for
+# each; those it has no room for are turned away.
+def serve_threads(host, port):
+    global connection_pool
+    max_threads = THREAD_MAX_CONNECTIONS if MAX_CONNECTIONS is None else MAX_CONNECTIONS
+    connection_pool = ConnectionPool(connection_thread, max_threads, CONNECTION_QUEUE, CONNECTION_WAIT, reject_connection)
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((host, port))
+        s.listen(LISTEN_BACKLOG)
+        serverlog.info("listening", host=host, port=port, engine="thread")
+
+        while True:
             try:
-                request = read_message(conn)
+                conn, addr = s.accept()
+                if not connection_pool.submit(conn):
+                    reject_connection(conn)
+
             except Exception as e:
-                print(str(e))
-                print("Connection dropped. User logged out.")
-                if user:
-                    users[user].logout()
-                    user = None
+                serverlog.warning("accept_failed", error=e)
+
+# multi-process mode
+
+# The worker that owns <key>, a username or channel name, out of <count>. This
+# must not change between runs, since each worker's message log holds the
+# messages for the users it owns, so it uses crc32 rather than hash().
+def shard_of(key, count):
+    return zlib.crc32(str.encode(key)) % count
+
+# The user or channel whose owner must handle <message> for a session logged
+# in as <user>, or None if any worker can.
+def request_key(user, message):
+    message_type = type(message)
+
+    if message_type in [HereMessage, CreateAccountMessage, ResumeMessage]:
+        return message.username
+    elif message_type == SendChatMessage:
+        return message.username.strip()
+    elif message_type in [JoinChannelMessage, LeaveChannelMessage, SendChannelMessage]:
+        return message.channel
+    elif message_type in [PingMessage, PongMessage, StatsRequestMessage]:
+        return None
+    return user
+
+# Stands in for a client connection while a request is handled on behalf of
+# another worker, collecting what handle_request sends so it can be returned
+# in one piece.
+class CaptureConnection:
+    def __init__(self):
+        self.output = bytearray()
+
+    def send(self, data):
+        self.output += data
+        return len(data)
+
+    def sendall(self, data):
+        self.output += data
+
+class Peers:
+    '''The other worker processes of a server that runs as several, and the
+       routing of requests between them.
+
+       Every user and channel is owned by exactly one worker, chosen by the
+       <owner> function (shard_of, for workers). Only the owner holds its
+       UserState or member list, and only the owner handles requests that read or
+       change them. A client may connect to any worker: the workers share the
+       listening port, and the kernel spreads connections across them. Requests
+       about users or channels another worker owns are forwarded to it, handled
+       there by the same handle_request, and its response is written back to the
+       client.
+
+       Once a user is "here" on another worker's connection, the owner attaches
+       a wakeup that pushes their deliveries to that worker, which writes them
+       to the connection. Channel messages are fanned out by the channel's
+       owner, with one FanOutMessage per worker that owns members.
+
+       Workers talk over socketpairs, in the same framing as clients. The nodes
+       of a cluster are routed between the same way (see ClusterPeers).
+
+       @attribute index: int
+           this worker.
+
+       @attribute sessions: dict[int, StreamConnection]
+           the client connections open on this worker, by connection id, for
+           deliveries pushed from other workers.
+
+       @attribute remote_sessions: dict[(int, int), callable]
+           the wakeup attached for each connection on another worker that holds
+           the session of a user owned here, by (worker, connection id). Only
+           the connection that holds a session may detach it.
+
+       @attribute shared_storage: bool (class attribute)
+           True if every worker opens the same user registry, and so loads only
+           the users and channels it owns from it.
+
+       @method routes: user, message -> bool
+           whether <message> must be handled by another worker.
+
+       @method route: user, connection_id, message, conn -> str or None
+           have the right worker(s) handle <message>, write the response to
+           <conn>, and return the user the session is logged in as afterwards.
+           User lists and searches are asked of every worker and merged.
+
+       @notes
+           Deliveries pushed to another worker are written to the client
+           connection as they arrive, without the WRITE_LIMIT backpressure that
+           applies to deliveries from this worker.
+    '''
+
+    shared_storage = True
+
+    # seconds to wait for the response to a forwarded request
+    forward_timeout = 10
+
+    def __init__(self, index, owner, sockets):
+        self.index = index
+        self.owner = owner
+        self.sockets = sockets
+        self.links = {}
+        self.sessions = {}
+        self.remote_sessions = {}
+
+        # forwarded requests waiting for their responses, by request id
+        self.pending = {}
+        self.request_ids = itertools.count(1)
+
+    def owns(self, key):
+        return self.owner(key) == self.index
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        for index, sock in self.sockets.items():
+            reader, writer = await asyncio.open_connection(sock=sock)
+            self.links[index] = writer
+            loop.create_task(self.read_link(index, reader))
+
+    # Send a message to peer <index>. Messages to a peer that is not connected
+    # are dropped.
+    def send(self, index, message):
+        writer = self.links.get(index)
+        if writer:
+            writer.write(message.serialize())
+
+    def broadcast(self, message):
+        for index in list(self.links):
+            self.send(index, message)
+
+    def routes(self, user, message):
+        if type(message) in [RequestUserListMessage, SearchUsersMessage]:
+            return bool(user)
+
+        key = request_key(user, message)
+        return key is not None and not self.owns(key)
+
+    async def route(self, user, connection_id, message, conn):
+        if type(message) in [RequestUserListMessage, SearchUsersMessage]:
+            conn.sendall(await self.gather(user, message))
+            return user
+
+        try:
+            user, output = await self.forward(self.owner(request_key(user, message)), connection_id, user, message)
+        except ConnectionError:
+            send_error_message(conn, "The server for that user or channel is unreachable. Please try again later.")
+            return user
+
+        if output:
+            conn.sendall(output)
+        return user
+
+    # Forward a request to worker <index>, and wait for the user the session
+    # is logged in as afterwards and the response for the client.
+    async def forward(self, index, connection_id, user, message):
+        if index not in self.links:
+            raise ConnectionError("No link to " + str(index))
+
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = (index, future)
+
+        self.send(index, ForwardRequestMessage(request_id, connection_id, user or "", message.serialize()))
+        try:
+            response = await asyncio.wait_for(future, self.forward_timeout)
+        except asyncio.TimeoutError:
+            self.pending.pop(request_id, None)
+            raise ConnectionError("No response from " + str(index))
+
+        return response.user or None, response.output
+
+    # Ask every worker for its users, and merge the answers into one response.
+    async def gather(self, user, message):
+        conn = CaptureConnection()
+        handle_request(user, conn, message)
+
+        results = await asyncio.gather(*(self.forward(index, 0, user, message) for index in list(self.links)),
+                                       return_exceptions=True)
+
+        # peers that could not be reached are left out
+        outputs = [conn.output] + [result[1] for result in results if not isinstance(result, Exception)]
+        responses = [deserialize_message(output) for output in outputs]
+
+        for response in responses:
+            if type(response) == ErrorMessage:
+                return response.serialize()
+
+        if type(message) == RequestUserListMessage:
+            return UserListResponseMessage([name for response in responses for name in response.user_list]).serialize()
+
+        # each worker sent the first page of its own matches, so the first page
+        # of all of them is among them
+        page_size = min(message.limit or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+        user_list = sorted(name for response in responses for name in response.user_list)
+        more = len(user_list) > page_size or any(response.continuation_token for response in responses)
+        user_list = user_list[:page_size]
+        return UserPageResponseMessage(user_list, user_list[-1] if more else "").serialize()
+
+    async def read_link(self, index, reader):
+        try:
+            while True:
+                message = await read_message_async(reader)
+                message_type = type(message)
+
+                if message_type == ForwardRequestMessage:
+                    self.handle_forwarded(index, message)
+                elif message_type == ForwardResponseMessage:
+                    # a response that comes after its request timed out has
+                    # nobody waiting for it
+                    _, future = self.pending.pop(message.request_id, (None, None))
+                    if future and not future.done():
+                        future.set_result(message)
+                    else:
+                        metrics.count("late_forward_responses")
+                elif message_type == PushMessage:
+                    conn = self.sessions.get(message.connection_id)
+                    if conn:
+                        conn.sendall(message.output)
+                elif message_type == CloseSessionMessage:
+                    conn = self.sessions.get(message.connection_id)
+                    if conn:
+                        conn.writer.transport.abort()
+                elif message_type == FanOutMessage:
+                    add_to_members(SharedMessage(message.sender, message.body), message.members)
+                elif message_type == LeaveChannelsMessage:
+                    leave_all_channels(message.username, everywhere=False)
+                elif message_type == HandoffUserMessage:
+                    self.adopt_user(message.username, message.message_list)
+                elif message_type == HandoffChannelMessage:
+                    for member in message.members:
+                        join_channel(member, message.channel)
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            serverlog.warning("peer_link_lost", peer=index)
+            self.fail_pending(index)
+
+    # Nothing more is coming back for requests forwarded to peer <index>.
+    def fail_pending(self, index):
+        for request_id, (link, future) in list(self.pending.items()):
+            if link == index:
+                del self.pending[request_id]
+                if not future.done():
+                    future.set_exception(ConnectionError("Lost the link to " + str(index)))
+
+    # Handle a request forwarded by worker <index> for one of its connections.
+    def handle_forwarded(self, index, message):
+        conn = CaptureConnection()
+        previous_user = message.user or None
+        user = previous_user
+        logged = last_logged()
+
+        key = (index, message.connection_id)
+
+        try:
+            # the other worker only forwards what it accepted from its client,
+            # and its own DetachMessages for connections that dropped
+            request = deserialize_message(message.frame, peer=True)
+            if type(request) == DetachMessage:
+                detach_session(previous_user, self.remote_sessions.pop(key, None))
+                user = None
+            else:
+                user = handle_request(previous_user, conn, request)
+        except Exception as e:
+            serverlog.error("forwarded_request_failed", user=previous_user, error=e)
+
+        # a user who just logged in on the other worker's connection gets their
+        # deliveries pushed there, starting with anything already queued
+        if user != previous_user:
+            self.remote_sessions.pop(key, None)
+        if user != previous_user and user in users:
+            wakeup = self.remote_wakeup(index, message.connection_id, user)
+            self.remote_sessions[key] = wakeup
+            attach_connection(previous_user, user, wakeup)
+            wakeup()
+
+        # the response waits for the messages the request queued to be on disk
+        response = ForwardResponseMessage(message.request_id, user or "", conn.output)
+        if last_logged() != logged:
+            loop = asyncio.get_running_loop()
+            UserState.message_log.on_commit(last_logged(), lambda: loop.call_soon_threadsafe(self.send, index, response))
+        else:
+            self.send(index, response)
+
+    # The wakeup for the connection <connection_id> on worker <index>, logged in
+    # as <user>. Once a client resumes the session elsewhere, the next wakeup
+    # tells that worker to close the connection.
+    def remote_wakeup(self, index, connection_id, user):
+        loop = asyncio.get_running_loop()
+        key = (index, connection_id)
+
+        def push():
+            if not holds_session(user, wakeup):
+                if users[user].wakeup and self.remote_sessions.get(key) is wakeup:
+                    del self.remote_sessions[key]
+                    self.send(index, CloseSessionMessage(connection_id))
                 return
 
-            if request:
-                try:
-                    user = handle_request(user, conn, request)
-                except Exception as e:
-                    print("Failed to handle request for an unknown reason.")
-                    print(e)
+            conn = CaptureConnection()
+            send_new_messages(user, conn, wakeup)
+            if conn.output:
+                self.send(index, PushMessage(connection_id, conn.output))
 
-# Read the list of users from the user log and resume the server state
-# with those users.
-# Note that messsages, unlike user acccounts, do not persist across server
-# restarts.
-def load_users(filename):
-    with open(filename, "r") as f:
-        lines = f.readlines()
-        for line in lines:
-            username = line.strip()
-            users.update({username: UserState(username)})
+        def wakeup():
+            loop.call_soon_threadsafe(push)
+
+        return wakeup
+
+    # Take over an account handed off by its previous owner, queueing its
+    # messages again so that they are in this server's message log.
+    def adopt_user(self, username, messages):
+        if username not in users:
+            users[username] = UserState(username)
+            with directory_lock:
+                directory.add(username)
+            if registry:
+                registry.create(username)
+
+        for message in messages:
+            users[username].queue_for_later(message, enforce_limit=False)
+
+class ClusterPeers(Peers):
+    '''The other nodes of a cluster of servers that share one user namespace.
+
+       Users and channels are placed on nodes by a consistent-hash ring over the
+       nodes' peer addresses (see hash_ring.py), and requests are routed between
+       nodes exactly as between workers (see Peers). Every node is given the same
+       list of peer addresses, so there is nothing to coordinate: each node works
+       out the owner of any key by itself.
+
+       Nodes link up over TCP. Each node listens on its peer address, and dials
+       every other node, retrying until it answers and again whenever the link
+       drops. A node sends on the links it dialed, and reads on the links it
+       accepted, which start with a NodeHelloMessage naming the other end.
+
+       Every node keeps its own user registry and message log. When the list of
+       nodes changes, a node may find it holds users or channels that now belong
+       to another node; it hands them over (HandoffUserMessage and
+       HandoffChannelMessage) as soon as it is linked to the new owner. The ring
+       only moves about 1/n of the users when one of n nodes is added or removed.
+
+       @notes
+           Until a handoff arrives, the new owner does not know about the users
+           being handed to it, and requests about them fail as if the accounts did
+           not exist. A node that is down makes its users unreachable, but does not
+           stop the rest of the cluster.
+    '''
+
+    shared_storage = False
+
+    # seconds between attempts to link to a node that is not answering
+    retry_interval = 0.5
+
+    def __init__(self, address, addresses):
+        self.ring = HashRing(addresses)
+        super().__init__(address, self.ring.owner, {})
+
+    async def connect(self):
+        host, port = self.index.rsplit(":", 1)
+        self.server = await asyncio.start_server(self.accept_link, host, int(port))
+
+        loop = asyncio.get_running_loop()
+        for address in self.ring.nodes:
+            if address != self.index:
+                loop.create_task(self.dial(address))
+
+    async def accept_link(self, reader, writer):
+        try:
+            # only the nodes of the cluster may link up
+            hello = await read_message_async(reader)
+            if type(hello) == NodeHelloMessage and hello.node in self.ring.nodes and hello.node != self.index:
+                await self.read_link(hello.node, reader)
+            else:
+                serverlog.warning("peer_link_refused", peer=writer.get_extra_info("peername"))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def dial(self, address):
+        host, port = address.rsplit(":", 1)
+
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(host, int(port))
+            except OSError:
+                await asyncio.sleep(self.retry_interval)
+                continue
+
+            serverlog.info("peer_linked", peer=address)
+            writer.write(NodeHelloMessage(self.index).serialize())
+            self.links[address] = writer
+            self.hand_off(address)
+
+            # nothing is sent back on this link, so reading only returns once
+            # it is gone
+            try:
+                await reader.read()
+            except ConnectionError:
+                pass
+
+            serverlog.warning("peer_link_lost", peer=address)
+            del self.links[address]
+            writer.close()
+            self.fail_pending(address)
+            await asyncio.sleep(self.retry_interval)
+
+    # Hand the users and channels that node <address> now owns over to it.
+    def hand_off(self, address):
+        for username in [username for username in users if self.owner(username) == address]:
+            self.send(address, HandoffUserMessage(username, users[username].take_undelivered()))
+            users.pop(username).delete()
+            with directory_lock:
+                directory.discard(username)
+            if registry:
+                registry.delete(username)
+
+        for channel in [channel for channel in channels if self.owner(channel) == address]:
+            members = channels[channel]
+            self.send(address, HandoffChannelMessage(channel, sorted(members)))
+            for member in members:
+                leave_channel(member, channel)
+
+# Spread the messages queued in the message log across one log per worker, by
+# the owner of each recipient, so that each worker replays exactly the messages
+# for the users it owns. Logs left by a run with a different number of workers
+# are merged in and removed. With one worker, everything is merged back into
+# <path>. A crash part way through may deliver some messages twice, but never
+# loses them.
+def partition_message_logs(path, workers):
+    shard_paths = [p for p in glob.glob(glob.escape(path) + ".*") if p.rsplit(".", 1)[1].isdigit()]
+    if workers == 1 and not shard_paths:
+        return
+
+    targets = [path] if workers == 1 else [path + "." + str(index) for index in range(workers)]
+    pending = [{} for _ in targets]
+
+    for source in [path] + shard_paths:
+        for recipient, messages in MessageLog(source).replay().items():
+            pending[shard_of(recipient, workers)].setdefault(recipient, []).extend(messages)
+
+    for target, recovered in zip(targets, pending):
+        message_log = MessageLog(target)
+        message_log.recovered = recovered
+        message_log.compact()
+
+    for source in [path] + shard_paths:
+        if source not in targets and os.path.exists(source):
+            os.remove(source)
+
+# Run the server as <args.workers> processes that share the listening port,
+# each owning a share of the users (see Peers). Every worker runs the asyncio
+# engine.
+def serve_workers(host, port, args):
+    # import any legacy user list and partition the message log once, before
+    # the workers open them
+    UserRegistry(args.users, legacy_path="users.txt").close()
+    partition_message_logs(args.log, args.workers)
+
+    # one socketpair between every two workers
+    sockets = {(i, j): socket.socketpair() for i in range(args.workers) for j in range(i + 1, args.workers)}
+
+    # every worker watches the read end of this pipe. once the workers have
+    # closed their copies, the parent holds the only write end, so the pipe
+    # reads as closed as soon as the parent is gone, however it went.
+    lifeline = os.pipe()
+
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=run_worker, args=(host, port, args, index, sockets, lifeline))
+               for index in range(args.workers)]
+
+    for worker in workers:
+        worker.start()
+    os.close(lifeline[0])
+
+    # stopping the parent stops the workers, which would otherwise go on
+    # serving the port between them
+    def stop_workers(signum, frame):
+        serverlog.info("stopping_workers", signal=signal.Signals(signum).name)
+        for worker in workers:
+            worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+
+    for worker in workers:
+        worker.join()
+
+# Stop this worker when the parent process is gone, which closes the pipe
+# <lifeline> reads from.
+def watch_parent(lifeline):
+    while os.read(lifeline, 1):
+        pass
+    serverlog.warning("parent_gone")
+    os.kill(os.getpid(), signal.SIGTERM)
+
+def run_worker(host, port, args, index, sockets, lifeline):
+    global peers
+
+    os.close(lifeline[1])
+    threading.Thread(target=watch_parent, args=(lifeline[0],), daemon=True).start()
+
+    links = {}
+    for (i, j), (first, second) in sockets.items():
+        if i == index:
+            links[j] = first
+            second.close()
+        elif j == index:
+            links[i] = second
+            first.close()
+        else:
+            first.close()
+            second.close()
+
+    peers = Peers(index, functools.partial(shard_of, count=args.workers), links)
+    load_state(args, args.log + "." + str(index), os.path.join(args.spill_dir, str(index)))
+    start_reporting(args.stats_interval)
+    start_timers()
+    start_stats_endpoint(args.stats_port and args.stats_port + index)
+
+    serverlog.info("worker_started", worker=index, workers=args.workers, users=len(users))
+    asyncio.run(serve_asyncio(host, port, reuse_port=True))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-ip", help="Server IP address. Defaults to locahost.", default='localhost')
     parser.add_argument("-port", help="Server port. Defaults to 12345.", default=12345)
+    parser.add_argument("-mode", help="Server engine: one thread per connection, or one asyncio event loop. Defaults to thread.",
+                        choices=["thread", "asyncio"], default="thread")
+    parser.add_argument("-log", help="Message log that keeps queued messages across restarts. Defaults to messages.log.",
+                        default="messages.log")
+    parser.add_argument("-commit_interval", help="Milliseconds to gather message log records before each fsync. Defaults to 10.",
+                        type=float, default=10)
+    parser.add_argument("-queue_limit", help="Messages each of a user's queues holds in memory. Defaults to 1000.",
+                        type=int, default=1000)
+    parser.add_argument("-overflow", help="What happens to messages for a user whose queue is full: reject them with an error "
+                        "to the sender, drop the user's oldest message, or spill the queue to disk. Defaults to spill.",
+                        choices=[REJECT, DROP_OLDEST, SPILL], default=SPILL)
+    parser.add_argument("-ack_window", help="Chats sent to a client that acknowledges them and not yet acknowledged, "
+                        "kept to be sent again if its connection drops. Defaults to 256.", type=int, default=256)
+    parser.add_argument("-resume_grace", help="Seconds a session is kept after its connection drops, for the client to "
+                        "resume. Defaults to 30; 0 logs the user out at once.", type=float, default=RESUME_GRACE)
+    parser.add_argument("-heartbeat", help="Seconds of silence from a client before the server pings it. Defaults to 15; "
+                        "0 turns pings off.", type=float, default=HEARTBEAT)
+    parser.add_argument("-idle_timeout", help="Seconds of silence from a client before its connection is dropped. "
+                        "Defaults to 45; 0 keeps silent connections open.", type=float, default=IDLE_TIMEOUT)
+    parser.add_argument("-spill_dir", help="Directory for queues spilled out of memory. Defaults to spill.",
+                        default="spill")
+    parser.add_argument("-write_limit", help="Bytes of deliveries the asyncio engine buffers for a slow client. Defaults to 1 MiB.",
+                        type=int, default=WRITE_LIMIT)
+    parser.add_argument("-write_timeout", help="Seconds the threaded engine waits on a client that is not reading. Defaults to 30.",
+                        type=float, default=WRITE_TIMEOUT)
+    parser.add_argument("-flush_size", help="Bytes written to a connection that are sent at once, rather than gathered "
+                        "into one send with what follows. Defaults to 64 KiB.", type=int, default=FLUSH_SIZE)
+    parser.add_argument("-nodelay", help="Set TCP_NODELAY on client connections, so each send goes out at once. "
+                        "Defaults to on.", choices=["on", "off"], default="on")
+    parser.add_argument("-cork", help="Cork a connection (TCP_CORK) while a send takes several calls. Threaded engine "
+                        "on Linux only.", action='store_true')
+    parser.add_argument("-users", help="User registry database. Defaults to users.db.", default="users.db")
+    parser.add_argument("-max_connections", help="Connections served at once; more are turned away with an error. "
+                        "Defaults to 1000 threads for the threaded engine, and no limit for asyncio.", type=int)
+    parser.add_argument("-connection_queue", help="Connections the threaded engine holds while every thread is busy. "
+                        "Defaults to 1000.", type=int, default=CONNECTION_QUEUE)
+    parser.add_argument("-connection_wait", help="Seconds a connection may wait for a thread before it is turned away. "
+                        "Defaults to 10; 0 lets it wait until a thread is free.", type=float, default=CONNECTION_WAIT)
+    parser.add_argument("-backlog", help="Listen backlog. Defaults to 4096.", type=int, default=LISTEN_BACKLOG)
+    parser.add_argument("-log_level", help="Least severe log records to write. Defaults to info; debug logs every request.",
+                        choices=list(serverlog.LEVELS), default="info")
+    parser.add_argument("-log_file", help="File to append log records to. Defaults to standard error.")
+    parser.add_argument("-log_format", help="Log records as key=value text or as JSON. Defaults to text.",
+                        choices=["text", "json"], default="text")
+    parser.add_argument("-log_sample", help="Write only one in every N records of an event, given as event=N, "
+                        "e.g. request=100.", nargs="+", default=[])
+    parser.add_argument("-stats_interval", help="Seconds between reports of active, queued and rejected connections. "
+                        "Defaults to 10; 0 turns them off.", type=float, default=10)
+    parser.add_argument("-stats_port", help="Local port serving the server's metrics as plain text. Workers serve "
+                        "their own on consecutive ports. Off by default.", type=int)
+    parser.add_argument("-workers", help="Worker processes sharing the port, each owning a share of the users. "
+                        "Workers run the asyncio engine. Defaults to 1.", type=int, default=1)
+    parser.add_argument("-cluster", help="Peer addresses (host:port) of every node of a cluster sharing one user namespace, "
+                        "this one included. Nodes run the asyncio engine.", nargs="+")
+    parser.add_argument("-node", help="This node's peer address, one of those given to -cluster.")
     args = parser.parse_args()
 
-    HOST = str(args.ip)
-    PORT = int(args.port)
+    if args.cluster and (args.node not in args.cluster or args.workers > 1):
+        parser.error("-node must be one of the -cluster addresses, and cluster nodes run a single worker.")
 
-    # resume with users if file exists
     try:
-        load_users("users.txt")
-    except:
-        pass
+        sample = {event: int(rate) for event, rate in (item.split("=") for item in args.log_sample)}
+    except ValueError:
+        parser.error("-log_sample takes event=N pairs.")
+    serverlog.configure(args.log_level, args.log_file, args.log_format, sample)
 
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind((HOST, PORT))
-        s.listen()
-        print("Server listening on", HOST, ":", PORT)
-
-        while True:
-            try:
-                conn, addr = s.accept()
+    HOST = str(args.ip)
+    PORT = int(args.port)
 
-                # spawn a new thread to handle each new connection to allow multiple simultaneous connections
-                # this allows the server to maintain state for each connection
-                threading.Thread(target=connection_thread, args=(conn,)).start()
+    WRITE_LIMIT = args.write_limit
+    WRITE_TIMEOUT = args.write_timeout
+    FLUSH_SIZE = args.flush_size
+    NODELAY = args.nodelay == "on"
+    CORK = args.cork
 
-            except Exception as e:
-                print("Connection error encountered with message: " + str(e.message))
-                print("Resumung.")
+    MAX_CONNECTIONS = args.max_connections
+    CONNECTION_QUEUE = args.connection_queue
+    CONNECTION_WAIT = args.connection_wait
+    LISTEN_BACKLOG = args.backlog
+    RESUME_GRACE = args.resume_grace
+    HEARTBEAT = args.heartbeat
+    IDLE_TIMEOUT = args.idle_timeout
 
+    if args.workers > 1:
+        serve_workers(HOST, PORT, args)
+    else:
+        if args.cluster:
+            peers = ClusterPeers(args.node, args.cluster)
 
+        # pick up messages left in the logs of a multi-process run
+        partition_message_logs(args.log, 1)
+        load_state(args, args.log, args.spill_dir)
+        start_reporting(args.stats_interval)
+        start_timers()
+        start_stats_endpoint(args.stats_port)
 
+        if args.mode == "asyncio" or peers:
+            asyncio.run(serve_asyncio(HOST, PORT))
+        else:
+            serve_threads(HOST, PORT)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+'''
+    structured logging for the server, written by a background thread.
+
+    each record is an event name and a few key=value fields, e.g.
+
+        serverlog.info("listening", host=host, port=port)
+
+    which is written as
+
+        time=2026-10-18T12:00:00.123 level=info event=listening host=localhost port=12345
+
+    or as one JSON object per line. logging a record only appends it to a queue;
+    a writer thread formats and writes everything queued every flush_interval
+    seconds, so the threads serving clients never wait on the log file.
+
+    records below the configured level are dropped before anything is built.
+    hot paths test serverlog.level themselves, so that a disabled record costs one
+    comparison:
+
+        if serverlog.level <= serverlog.DEBUG:
+            serverlog.debug("request", type=message_type.__name__)
+
+    busy events can be sampled, so that only one in every N of them is written.
+'''
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+# Levels
+DEBUG   = 10
+INFO    = 20
+WARNING = 30
+ERROR   = 40
+
+LEVEL_NAMES = {DEBUG: "debug", INFO: "info", WARNING: "warning", ERROR: "error"}
+LEVELS = {name: value for value, name in LEVEL_NAMES.items()}
+
+# records below this level are dropped
+level = INFO
+
+# Records waiting for the writer thread, as (time, level, event, fields).
+# deque.append and popleft are atomic, so loggers and the writer share it
+# without a lock. Records logged while it is full are dropped and counted.
+pending = deque()
+max_pending = 100000
+dropped = 0
+
+# event name -> N, to write only one in every N records of that event
+sample_rates = {}
+sample_counts = {}
+
+output = sys.stderr
+output_format = "text"
+flush_interval = 0.05
+writer = None
+
+# Set up logging and start the writer thread.
+# <sample> maps event names to N, to keep one in every N of their records.
+def configure(log_level="info", path=None, log_format="text", sample=None, interval=0.05):
+    global level, output, output_format, flush_interval, writer
+
+    level = LEVELS[log_level]
+    output_format = log_format
+    flush_interval = interval
+    sample_rates.update(sample or {})
+
+    if path:
+        output = open(path, "a")
+
+    if writer is None:
+        writer = threading.Thread(target=write_loop, daemon=True)
+        writer.start()
+        atexit.register(flush)
+
+def debug(event, **fields):
+    if level <= DEBUG:
+        log(DEBUG, event, fields)
+
+def info(event, **fields):
+    if level <= INFO:
+        log(INFO, event, fields)
+
+def warning(event, **fields):
+    if level <= WARNING:
+        log(WARNING, event, fields)
+
+def error(event, **fields):
+    if level <= ERROR:
+        log(ERROR, event, fields)
+
+# Queue a record for the writer thread.
+def log(record_level, event, fields):
+    global dropped
+
+    rate = sample_rates.get(event)
+    if rate:
+        count = sample_counts.get(event, 0)
+        sample_counts[event] = count + 1
+        if count % rate:
+            return
+
+    if len(pending) >= max_pending:
+        dropped += 1
+        return
+
+    pending.append((time.time(), record_level, event, fields))
+
+def format_record(record):
+    timestamp, record_level, event, fields = record
+    when = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(timestamp)) + ".%03d" % (timestamp % 1 * 1000)
+
+    if output_format == "json":
+        return json.dumps({"time": when, "level": LEVEL_NAMES[record_level], "event": event, **fields}, default=str)
+
+    parts = ["time=" + when, "level=" + LEVEL_NAMES[record_level], "event=" + event]
+    for key, value in fields.items():
+        value = str(value)
+        if not value or " " in value or "=" in value or '"' in value:
+            value = json.dumps(value)
+        parts.append(key + "=" + value)
+    return " ".join(parts)
+
+# Write out everything queued so far.
+def flush():
+    global dropped
+
+    lines = []
+    while pending:
+        lines.append(format_record(pending.popleft()))
+
+    if dropped:
+        lines.append(format_record((time.time(), WARNING, "log_records_dropped", {"count": dropped})))
+        dropped = 0
+
+    if lines:
+        output.write("\n".join(lines) + "\n")
+        output.flush()
+
+def write_loop():
+    while True:
+        time.sleep(flush_interval)
+        try:
+            flush()
+        except Exception as e:
+            sys.stderr.write("Failed to write log records: " + str(e) + "\n")
+
+# A forked worker process starts without the writer thread, so it starts its
+# own, leaving the records its parent queued to the parent.
+def restart_writer():
+    global writer
+
+    pending.clear()
+    if writer is not None:
+        writer = threading.Thread(target=write_loop, daemon=True)
+        writer.start()
+
+os.register_at_fork(after_in_child=restart_writer)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+from messages import pack_string, unpack_string_at, INT_STRUCT
+
+class SpillStore:
+    '''Keeps the oldest part of very long deliver_later queues on disk instead of in
+       memory.
+
+       Each user that has spilled gets one file in the spill directory, named after a
+       hash of their username. Messages are appended in their wire encoding (sender
+       and body as length-prefixed strings), oldest first, and read back from the
+       front, all at once or a page at a time, when the user drains their queue.
+
+       @method spill: username, messages: iterable of (str, str) -> None
+           append messages to the user's spill file.
+
+       @method take: username, count: int or None -> list[(str, str)]
+           read back the oldest <count> messages the user has spilled, or all of them
+           if count is None. The file is removed once everything in it has been read.
+
+       @method discard: username -> None
+           remove the user's spill file without reading it.
+
+       @notes
+           Spill files are a cache, not a record: the message log is what makes
+           queued messages durable, and replaying it rebuilds every queue (spilling
+           again as needed). Leftover spill files are therefore cleared when a
+           SpillStore is opened.
+
+           Calls for different users may run at once, since each has its own file.
+           Calls for the same user must not; UserState makes them under the user's
+           later_lock.
+    '''
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        # where reading resumes in the files of users that have taken part of
+        # what they spilled
+        self.read_offsets = {}
+
+        for name in os.listdir(directory):
+            if name.endswith(".spill"):
+                os.remove(os.path.join(directory, name))
+
+    def path(self, username: str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(str.encode(username)).hexdigest() + ".spill")
+
+    def spill(self, username: str, messages):
+        with open(self.path(username), "ab") as f:
+            f.write(b''.join(pack_string(sender) + pack_string(body) for sender, body in messages))
+
+    def take(self, username: str, count: int = None) -> list:
+        messages = []
+
+        try:
+            with open(self.path(username), "rb") as f:
+                f.seek(self.read_offsets.get(username, 0))
+
+                while count is None or len(messages) < count:
+                    sender = self.read_string(f)
+                    if sender is None:
+                        break
+                    messages.append((sender, self.read_string(f)))
+
+                at_end = f.read(1) == b''
+                self.read_offsets[username] = f.tell() - (0 if at_end else 1)
+        except FileNotFoundError:
+            return []
+
+        if at_end:
+            self.discard(username)
+        return messages
+
+    # Read one length-prefixed string, or None at the end of the file.
+    def read_string(self, f):
+        header = f.read(4)
+        if not header:
+            return None
+
+        length = INT_STRUCT.unpack(header)[0]
+        return unpack_string_at(header + f.read(length), 0)[0]
+
+    def discard(self, username: str):
+        self.read_offsets.pop(username, None)
+        try:
+            os.remove(self.path(username))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import time
+
+# Each level of the wheel has 2**SLOT_BITS slots.
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+
+class Timer:
+    '''A callback scheduled on a TimingWheel.
+
+       @attribute expires: int
+           the tick at which the callback is due.
+
+       @method fire: () -> None
+           call the callback.
+    '''
+
+    __slots__ = ("expires", "callback", "args", "slot")
+
+    def __init__(self, expires: int, callback, args):
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self.slot = None
+
+    def fire(self):
+        self.callback(*self.args)
+
+class TimingWheel:
+    '''Many timers at once, for a cost per tick that does not grow with the
+       number of timers.
+
+       Time is counted in ticks of <tick> seconds. Level 0 has a slot for each of
+       the next 64 ticks, level 1 a slot for each of the next 64 spans of 64 ticks,
+       and so on up through <levels> levels. A timer goes into the slot of the
+       lowest level that reaches its tick. Each tick empties one level 0 slot, and
+       every 64 ticks one slot of the level above is emptied into the levels
+       below, so a timer is moved at most once per level before it fires.
+       Scheduling and cancelling are O(1), and so is a tick, apart from the
+       timers that fire or move down. Timers beyond the reach of the top level
+       wait in it, and are placed again each time their slot comes round.
+
+       @method schedule: delay: float, callback, *args -> Timer
+           call callback(*args) once about <delay> seconds from now, rounded up to
+           a whole tick.
+
+       @method cancel: timer: Timer -> None
+           stop a timer from firing. Cancelling a timer that has fired, or was
+           cancelled already, does nothing.
+
+       @method advance: now: float -> list[Timer]
+           move the wheel on to <now> (time.monotonic()), and return the timers
+           that are due, in the order they came due, for the caller to fire.
+
+       @notes
+           The wheel takes no locks. advance does not fire the timers itself, so
+           that a caller that guards the wheel with a lock can fire them after
+           releasing it, and callbacks may schedule timers again.
+    '''
+
+    def __init__(self, tick: float = 0.25, levels: int = 4, start: float = None):
+        if levels < 1:
+            raise ValueError("A timing wheel needs at least one level.")
+
+        self.tick = tick
+        self.start = time.monotonic() if start is None else start
+        self.current = 0
+        self.count = 0
+        self.wheels = [[set() for _ in range(SLOTS)] for _ in range(levels)]
+
+        # the ticks each level reaches
+        self.spans = [SLOTS ** (level + 1) for level in range(levels)]
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, delay: float, callback, *args) -> Timer:
+        # round up, so a timer never fires early, and never in the tick under way
+        expires = self.current + max(int(-(-delay // self.tick)), 1)
+        timer = Timer(expires, callback, args)
+        self.place(timer)
+        self.count += 1
+        return timer
+
+    # Put a timer into the slot for its tick, in the lowest level that reaches
+    # that far. Timers beyond the top level wait in the slot it empties last,
+    # and are placed again when it is emptied.
+    def place(self, timer: Timer):
+        delta = timer.expires - self.current
+        spans = self.spans
+        level = 0
+        while delta >= spans[level] and level < len(spans) - 1:
+            level += 1
+
+        if delta >= spans[level]:
+            index = self.current >> (SLOT_BITS * level)
+        else:
+            index = timer.expires >> (SLOT_BITS * level)
+
+        timer.slot = self.wheels[level][index & SLOT_MASK]
+        timer.slot.add(timer)
+
+    def cancel(self, timer: Timer):
+        if timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+            self.count -= 1
+
+    def advance(self, now: float) -> list:
+        target = int((now - self.start) / self.tick)
+        due = []
+
+        while self.current < target:
+            self.current += 1
+
+            # empty the slots of the levels above that this tick reaches, highest
+            # first, so their timers can cascade all the way down
+            level = 1
+            while level < len(self.wheels) and self.current & ((1 << (SLOT_BITS * level)) - 1) == 0:
+                level += 1
+            for upper in range(level - 1, 0, -1):
+                slot = self.wheels[upper][(self.current >> (SLOT_BITS * upper)) & SLOT_MASK]
+                timers = list(slot)
+                slot.clear()
+                for timer in timers:
+                    self.place(timer)
+
+            # timers in level 0 are due, apart from any beyond the reach of a
+            # wheel with one level, which go round again
+            slot = self.wheels[0][self.current & SLOT_MASK]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                if timer.expires > self.current:
+                    self.place(timer)
+                else:
+                    timer.slot = None
+                    due.append(timer)
+                    self.count -= 1
+
+        return due
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+import bisect
+import itertools
+import os
+import queue
+import sqlite3
+import threading
+
+# Operations queued for the writer thread
+CREATE = 1
+DELETE = 2
+JOIN   = 3
+LEAVE  = 4
+
+class UserRegistry:
+    '''The permanent list of accounts, and of the channels they belong to, kept in an
+       indexed SQLite database.
+
+       Account names are the primary key of the accounts table, so creating, deleting
+       and looking up an account touch only the index, however many accounts there
+       are. Channel memberships are (channel, username) pairs in a second table.
+
+       Writes never block the caller. create() and delete() put the operation on a
+       queue and return; a writer thread applies everything that has queued up in a
+       single transaction. Because the server keeps every account in its users dict,
+       the registry is only read at startup.
+
+       @method load: () -> generator of str
+           stream every account name, for rebuilding the users dict at startup.
+
+       @method load_memberships: () -> generator of (str, str)
+           stream every (channel, username) membership, for rebuilding channels at
+           startup.
+
+       @method create: username -> None
+       @method delete: username -> None
+       @method join: username, channel -> None
+       @method leave: username, channel -> None
+           queue a write. Writes are applied in the order they were queued.
+
+       @method flush: () -> None
+           block until every queued write is committed.
+
+       @method close: () -> None
+           commit every queued write and stop the writer thread.
+
+       @notes
+           A registry that is created next to a legacy users.txt imports the names
+           in it once. The text file is left where it is.
+    '''
+
+    def __init__(self, path: str, legacy_path: str = None):
+        self.path = path
+        is_new = not os.path.exists(path)
+
+        self.connection = self.connect()
+        self.connection.execute("CREATE TABLE IF NOT EXISTS accounts (username TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS memberships (channel TEXT, username TEXT, "
+                                "PRIMARY KEY (channel, username)) WITHOUT ROWID")
+        self.connection.commit()
+
+        if is_new and legacy_path and os.path.exists(legacy_path):
+            self.import_legacy(legacy_path)
+
+        self.writes = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def import_legacy(self, legacy_path):
+        with open(legacy_path, "r") as f:
+            names = (line.strip() for line in f)
+            self.connection.executemany("INSERT OR IGNORE INTO accounts VALUES (?)",
+                                        ((name,) for name in names if name))
+        self.connection.commit()
+
+    def load(self):
+        for (username,) in self.connection.execute("SELECT username FROM accounts"):
+            yield username
+
+    def load_memberships(self):
+        for channel, username in self.connection.execute("SELECT channel, username FROM memberships"):
+            yield channel, username
+
+    def create(self, username: str):
+        self.queue_write(CREATE, username)
+
+    def delete(self, username: str):
+        self.queue_write(DELETE, username)
+
+    def join(self, username: str, channel: str):
+        self.queue_write(JOIN, username, channel)
+
+    def leave(self, username: str, channel: str):
+        self.queue_write(LEAVE, username, channel)
+
+    def queue_write(self, operation, username, channel=None):
+        self.writes.put((operation, username, channel))
+
+    def flush(self):
+        self.writes.join()
+
+    def close(self):
+        self.flush()
+        self.writes.put(None)
+        self.writer.join()
+        self.connection.close()
+
+    def write_loop(self):
+        connection = self.connect()
+
+        while True:
+            # take everything that has queued up, and commit it as one transaction
+            write = self.writes.get()
+            if write is None:
+                connection.close()
+                return
+
+            batch = [write]
+            while True:
+                try:
+                    batch.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+
+            for operation, username, channel in batch:
+                if operation == CREATE:
+                    connection.execute("INSERT OR IGNORE INTO accounts VALUES (?)", (username,))
+                elif operation == DELETE:
+                    connection.execute("DELETE FROM accounts WHERE username = ?", (username,))
+                elif operation == JOIN:
+                    connection.execute("INSERT OR IGNORE INTO memberships VALUES (?, ?)", (channel, username))
+                else:
+                    connection.execute("DELETE FROM memberships WHERE channel = ? AND username = ?", (channel, username))
+            connection.commit()
+
+            for _ in batch:
+                self.writes.task_done()
+
+class SortedIndex:
+    '''Every account name in sorted order, for paging through the user directory and
+       searching it by prefix.
+
+       Names are kept in a list of sorted buckets of around bucket_size names each,
+       with the last name of every bucket in a separate list. Adding or removing a
+       name bisects to its bucket and inserts into that bucket alone, so keeping the
+       index up to date as accounts come and go costs O(log n + bucket_size), not
+       O(n) like insort into one long list.
+
+       @method add: username -> None
+       @method discard: username -> None
+           keep the index in step with account creation and deletion.
+
+       @method search: prefix, limit, after -> (list[str], str)
+           return up to <limit> names that start with <prefix> and sort after
+           <after> (use "" to start from the beginning), and a continuation token
+           to pass as <after> for the next page. The token is "" when there are no
+           more matches.
+
+       @notes
+           Not thread safe: a bucket split or removal racing another change or a
+           search breaks the sorted order. Callers on several threads hold one
+           lock around every use (see directory_lock in server.py).
+    '''
+
+    def __init__(self, usernames=(), bucket_size: int = 1000):
+        self.bucket_size = bucket_size
+        names = sorted(set(usernames))
+        self.buckets = [names[i:i + bucket_size] for i in range(0, len(names), bucket_size)]
+        self.maxes = [bucket[-1] for bucket in self.buckets]
+        self.count = len(names)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, username):
+        i = bisect.bisect_left(self.maxes, username)
+        if i == len(self.maxes):
+            return False
+        bucket = self.buckets[i]
+        j = bisect.bisect_left(bucket, username)
+        return j < len(bucket) and bucket[j] == username
+
+    def add(self, username: str):
+        if not self.buckets:
+            self.buckets.append([username])
+            self.maxes.append(username)
+            self.count = 1
+            return
+
+        # the first bucket whose last name is not smaller, or the last bucket
+        i = min(bisect.bisect_left(self.maxes, username), len(self.maxes) - 1)
+        bucket = self.buckets[i]
+        j = bisect.bisect_left(bucket, username)
+        if j < len(bucket) and bucket[j] == username:
+            return
+
+        bucket.insert(j, username)
+        self.maxes[i] = bucket[-1]
+        self.count += 1
+
+        # split buckets that have grown too big in half
+        if len(bucket) > 2 * self.bucket_size:
+            half = len(bucket) // 2
+            self.buckets[i:i + 1] = [bucket[:half], bucket[half:]]
+            self.maxes[i:i + 1] = [bucket[half - 1], bucket[-1]]
+
+    def discard(self, username: str):
+        i = bisect.bisect_left(self.maxes, username)
+        if i == len(self.maxes):
+            return
+        bucket = self.buckets[i]
+        j = bisect.bisect_left(bucket, username)
+        if j == len(bucket) or bucket[j] != username:
+            return
+
+        del bucket[j]
+        self.count -= 1
+        if bucket:
+            self.maxes[i] = bucket[-1]
+        else:
+            del self.buckets[i]
+            del self.maxes[i]
+
+    def search(self, prefix: str, limit: int, after: str = "") -> (list, str):
+        # find the first name that is both after <after> and at least <prefix>
+        if after >= prefix:
+            i = bisect.bisect_right(self.maxes, after)
+            j = bisect.bisect_right(self.buckets[i], after) if i < len(self.buckets) else 0
+        else:
+            i = bisect.bisect_left(self.maxes, prefix)
+            j = bisect.bisect_left(self.buckets[i], prefix) if i < len(self.buckets) else 0
+
+        # take one match more than asked for, to know whether there is a next page
+        result = []
+        while i < len(self.buckets) and len(result) <= limit:
+            for username in itertools.islice(self.buckets[i], j, j + limit + 1 - len(result)):
+                if not username.startswith(prefix):
+                    return result, ""
+                result.append(username)
+            i += 1
+            j = 0
+
+        if len(result) > limit:
+            return result[:limit], result[limit - 1]
+        return result, ""
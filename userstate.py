@@ -1,6 +1,33 @@
 #!/usr/bin/env python3
 
-import queue
+import sys
+import threading
+import time
+from collections import deque
+from messages import DeliverMessage
+
+# What add_message does with a message for a user whose queue is full
+REJECT      = "reject"       # refuse it, so the server can tell the sender
+DROP_OLDEST = "drop_oldest"  # make room by discarding the user's oldest message
+SPILL       = "spill"        # move the queue to the spill store and keep going
+
+class SharedMessage(tuple):
+    '''A (sender, body) message that is being sent to many users at once, such as a
+       message to a channel.
+
+       It is a tuple, so it can be queued, logged, spilled and delivered anywhere a
+       plain message can. The one SharedMessage is queued for every recipient, so
+       however many recipients are away, the message and its body are held once.
+
+       @attribute frame: bytes
+           the DeliverMessage frame carrying just this message, serialized once and
+           written as is to every recipient that is connected.
+    '''
+
+    def __new__(cls, sender: str, body: str):
+        message = super().__new__(cls, (sys.intern(sender), body))
+        message.frame = bytes(DeliverMessage([message]).serialize())
+        return message
 
 class UserState:
     '''This class encapsulates all server-side information about a particular user.
@@ -12,46 +39,188 @@ class UserState:
        @attribute self.username: string
            Unique identifier for this user
 
-       @attribute deliver_now: Queue
+       @attribute deliver_now: deque or None
            queue of messages to be delivered immediately. These are messages that
            were received while the user was "here", and so should be delivered
            immediately according to the problem set specifications.
 
-       @attribute deliver_later: Queue
+       @attribute deliver_later: deque or None
            queue of messages to be delivered on-demand when the user is "here." These
-           are messages that were received when the user was "away."
+           are messages that were received when the user was "away." When a spill
+           store is configured, only the newest messages are kept here, and older ones
+           wait on disk.
+
+       @attribute spilled: int
+           number of this user's deliver_later messages that are on disk.
 
-       @method add_message: message: (str, str) -> None
+       @method add_message: message: (str, str) -> bool
            add a message to the appropriate queue depending on whether or not the
            user is "here" Will be used by other threads to send messages to
-           this user.
+           this user. Returns False if the message was rejected because the user's
+           queue is full.
            @param: (sender, body) a tuple consisting of the sender's username and the
-                   message body
+                   message body, or a SharedMessage, which is queued as is
+
+       @attribute wakeup: callable or None
+           set while the user is "here" on a connection. add_message calls it after
+           queueing onto deliver_now, so the connection delivers right away instead of
+           polling the queue.
+
+       @attribute queued_at: int
+           perf_counter_ns() when the oldest message now on deliver_now was
+           queued, so the server can tell how long deliveries wait. Messages left
+           behind by a take limited by the unacked window count from the take, so
+           the stall is not counted again for every later one.
+
+       @method attach: wakeup: () -> None
+           register the wakeup callable for the connection the user is "here" on.
+
+       @method take_deliver_now: limit: int or None -> list[(str, str)]
+           take at most <limit> messages (all of them if None) off deliver_now, for
+           the connection to send.
+
+       @attribute next_sequence: int
+           the number the next chat sent to this user will be delivered with.
+           Numbers start at 1 and count every chat sent from deliver_now.
+
+       @attribute unacked: deque or None
+           the chats numbered next_sequence - len(unacked) up to next_sequence - 1,
+           sent but not yet acknowledged, kept to be sent again if the connection
+           drops with them in flight. Only kept while acking.
+
+       @attribute acking: bool
+           True once the session logged in as this user has sent an AckMessage.
+           Sessions that never acknowledge are sent chats without keeping them, as
+           before acknowledgments existed.
+
+       @method window_room: () -> int or None
+           how many more chats may be sent before the client acknowledges some, or
+           None if there is no limit.
+
+       @method number_sent: messages: list[(str, str)] -> int
+           number messages taken off deliver_now that are about to be sent, and
+           keep them in unacked if acking. Returns the first number.
+
+       @method acknowledge: sequence: int, resume: bool -> (int, list[(str, str)])
+           drop the chats numbered up to <sequence> from unacked. The first
+           acknowledgment since logging in, or one that resumes a detached
+           session, returns the chats still unacked and the number of the first,
+           to be sent again.
+
+       @attribute resume_token: str or None
+           the token the session logged in as this user was issued, with which a
+           client can resume it after its connection drops. None once logged out.
+
+       @method detach: () -> None
+           the session's connection has dropped. The user stays "here", so chats
+           keep going to deliver_now, for the client to resume the session.
+
+       @method take_undelivered: () -> list[(str, str)]
+           empty both queues for a ShowUndeliveredMessage, deliver_later first,
+           after any page sent and not yet confirmed.
+
+       @method take_undelivered_page: limit: int -> (list[(str, str)], bool)
+           take at most <limit> messages off the front of the queues, in the same
+           order as take_undelivered, and say whether both queues are now empty.
+
+       @method take_page: cursor: int, limit: int -> (int, list[(str, str)], bool)
+           answer a RequestUndeliveredPageMessage: the page's next cursor, its
+           messages, and whether both queues are now empty. The page is kept until
+           a request confirms it with the cursor that follows it, and until then
+           any other request is sent the same page again, so a page lost with a
+           dropped connection is not lost for good.
+
+       @method restore: messages: list[(str, str)] -> None
+           put messages recovered from the message log back onto deliver_later.
+
+       @method delete: () -> None
+           called when the account is deleted, to drop its logged messages.
+
+       @attribute message_log: MessageLog or None (class attribute)
+           when the server runs with a message log, every change to a deliver_later
+           queue is recorded in it, so messages for "away" users survive a restart.
+
+       @attribute queue_limit: int (class attribute)
+       @attribute overflow_policy: REJECT, DROP_OLDEST or SPILL (class attribute)
+           bound the memory one user's queues can take, so that a stalled recipient
+           or a spammer cannot grow the server without limit. When deliver_now holds
+           queue_limit messages the connection is not keeping up, and further
+           messages go to deliver_later instead. When deliver_later holds
+           queue_limit messages, overflow_policy decides what happens next.
+
+       @attribute spill_store: SpillStore or None (class attribute)
+           where the SPILL policy moves full deliver_later queues. Without a spill
+           store, SPILL lets deliver_later grow in memory.
+
+       @attribute ack_window: int (class attribute)
+           the most chats an acknowledging session may have unacked. Once it is
+           reached, new chats wait on deliver_now until an acknowledgment arrives,
+           and past queue_limit go to deliver_later, as for any slow connection.
 
        @notes
            Note that UserState has no memory of past messages. Both message queue
-           contain only undelivered messages. Also note that the server has no
-           persistent storage. This design decision was made to reduce developer time,
-           but it comes at the cost of robustness. If we were extending this server,
-           a historical record of messages and persistent storage would be high-
-           priority features.
+           contain only undelivered messages. Only deliver_later is made durable by
+           the message log. Messages on deliver_now are on their way to a connected
+           client, and any that are left over when the user logs out are moved to
+           deliver_later. Chats in unacked are kept across a logout, so that the
+           next session can resume, but only in memory. If that session logged out
+           without ever acknowledging, or was sent more chats before it did, they
+           are moved to deliver_later instead. The last page taken by take_page is
+           likewise only kept in memory until it is confirmed.
+
+           The server holds one UserState for every account, and most accounts are
+           idle, so UserState is kept small: it has __slots__, its queues are only
+           created when a message arrives, deliver_later is released again once it
+           is drained, and sender names are interned so that every queued message
+           from the same sender shares one string.
     '''
 
+    __slots__ = ("here", "username", "deliver_now", "deliver_later", "spilled", "wakeup", "queued_at",
+                 "next_sequence", "unacked", "acking", "resume_token", "held_page")
+
+    message_log = None
+    spill_store = None
+    queue_limit = 1000
+    overflow_policy = SPILL
+    ack_window = 256
+
+    # Changes to a user's deliver_later queue (and the log records and spill
+    # files that go with them) are made under the user's later_lock, so that the
+    # log replays them in the order they happened. It also guards the lazy
+    # creation of their queues. Only each user's own order matters, so users
+    # share a fixed set of locks, picked by username, rather than one lock for
+    # everyone or one each: a user's spill I/O only holds up the few users that
+    # share its lock, and idle users cost nothing extra.
+    later_locks = [threading.Lock() for _ in range(256)]
+
+    @property
+    def later_lock(self) -> threading.Lock:
+        return UserState.later_locks[hash(self.username) % len(UserState.later_locks)]
+
     def __init__(self, username: str):
         '''This method does not perform uniqueness checks on username. Uniqueness is
            the caller's responsibility.
 
-           deliver_now and deliver_later are Queues and not lists because they need to
-           support concurrent access by multiple threads. This user's thread may pop
-           messages off the queues to deliver them, and other user threads may add
-           messages to the queues.
+           deliver_now and deliver_later are deques because they need to support
+           concurrent access by multiple threads. This user's thread may pop messages
+           off the queues to deliver them, and other user threads may add messages to
+           the queues. deque's append and popleft are atomic, and much smaller than a
+           Queue, which carries its own lock and condition variables.
 
            self.here and self.username are thread-safe because they are Python primitives
         '''
         self.here = False
         self.username = username
-        self.deliver_now = queue.Queue()
-        self.deliver_later = queue.Queue()
+        self.deliver_now = None
+        self.deliver_later = None
+        self.spilled = 0
+        self.wakeup = None
+        self.queued_at = 0
+        self.next_sequence = 1
+        self.unacked = None
+        self.acking = False
+        self.resume_token = None
+        self.held_page = None
 
     def add_message(self, message: (str,str)):
         '''Other user threads call this method to add a message to this user's queue.
@@ -60,20 +229,212 @@ class UserState:
            deem this race condition minor because the message will be still be delivered,
            it just may be delivered later than the sender will expect.
         '''
-        if self.here:
-            self.deliver_now.put(message)
+        if type(message) is not SharedMessage:
+            sender, body = message
+            message = (sys.intern(sender), body)
+
+        if self.here and len(self.now_queue()) < UserState.queue_limit:
+            if not self.deliver_now:
+                self.queued_at = time.perf_counter_ns()
+            self.deliver_now.append(message)
+
+            # read once, since the connection may detach concurrently
+            wakeup = self.wakeup
+            if wakeup:
+                wakeup()
+            return True
+
+        return self.queue_for_later(message)
+
+    # deliver_now is created the first time it is needed, and then kept, since
+    # senders may hold a reference to it without taking a lock.
+    def now_queue(self) -> deque:
+        if self.deliver_now is None:
+            with self.later_lock:
+                if self.deliver_now is None:
+                    self.deliver_now = deque()
+        return self.deliver_now
+
+    def take_deliver_now(self, limit: int = None) -> list:
+        messages = []
+        queue = self.deliver_now
+
+        while queue and (limit is None or len(messages) < limit):
+            messages.append(queue.popleft())
+
+        if queue and messages:
+            self.queued_at = time.perf_counter_ns()
+
+        return messages
+
+    # Move the unacked window to deliver_later, for a session that will not
+    # resume it.
+    def release_unacked(self):
+        for message in self.unacked or ():
+            self.queue_for_later(message, enforce_limit=False)
+        self.unacked = None
+
+    # The connection and acknowledgments for a user are handled on one thread
+    # (or event loop), so the numbering and unacked window need no lock.
+    def window_room(self):
+        if not self.acking:
+            return None
+        return UserState.ack_window - len(self.unacked or ())
+
+    def number_sent(self, messages: list) -> int:
+        # a window left by an earlier session is numbered up to next_sequence, so
+        # it is given up once this session, which has not resumed, is sent more
+        if not self.acking and self.unacked:
+            self.release_unacked()
+
+        first = self.next_sequence
+        self.next_sequence += len(messages)
+
+        if self.acking:
+            if self.unacked is None:
+                self.unacked = deque()
+            self.unacked.extend(messages)
+
+        return first
+
+    def acknowledge(self, sequence: int, resume: bool = False) -> (int, list):
+        unacked = self.unacked or deque()
+        first = self.next_sequence - len(unacked)
+
+        # only chats in the window can be acknowledged; numbers from before a
+        # restart, or not sent yet, cover at most what it holds
+        for i in range(min(max(sequence - first + 1, 0), len(unacked))):
+            unacked.popleft()
+            first += 1
+        if not unacked:
+            self.unacked = None
+
+        resume = resume or not self.acking
+        self.acking = True
+        return first, list(unacked) if resume else []
+
+    # Number of messages waiting in deliver_later, in memory and on disk.
+    def later_count(self) -> int:
+        return self.spilled + len(self.deliver_later or ())
+
+    # Add a message to deliver_later, moving the queue to disk if it has grown
+    # too long. The caller holds later_lock.
+    def append_later(self, message: (str, str)):
+        if self.deliver_later is None:
+            self.deliver_later = deque()
+        self.deliver_later.append(message)
+
+        if UserState.overflow_policy == SPILL and UserState.spill_store and \
+           len(self.deliver_later) > UserState.queue_limit:
+            UserState.spill_store.spill(self.username, self.deliver_later)
+            self.spilled += len(self.deliver_later)
+            self.deliver_later = None
+
+    # Queue a message for later, applying the overflow policy unless the message
+    # was already accepted once (as when it is moved from deliver_now).
+    # Returns False if the message was rejected.
+    def queue_for_later(self, message: (str, str), enforce_limit: bool = True) -> bool:
+        log = UserState.message_log
+
+        with self.later_lock:
+            if enforce_limit and self.later_count() >= UserState.queue_limit:
+                if UserState.overflow_policy == REJECT:
+                    return False
+
+                # only SPILL ever spills, so the oldest message is in memory
+                if UserState.overflow_policy == DROP_OLDEST and self.deliver_later:
+                    self.deliver_later.popleft()
+                    if log:
+                        log.log_drain(self.username, 1)
+
+            self.append_later(message)
+            if log:
+                log.log_message(self.username, *message)
+
+        return True
+
+    def take_undelivered(self) -> list:
+        held = self.held_page[1] if self.held_page else []
+        self.held_page = None
+
+        messages, _ = self.take_undelivered_page(None)
+        return held + messages
+
+    # The page and its next cursor are kept in held_page until confirmed. Like
+    # the unacked window, it is only touched by the user's own session.
+    def take_page(self, cursor: int, limit: int) -> (int, list, bool):
+        if self.held_page and cursor == self.held_page[0]:
+            self.held_page = None
+
+        if self.held_page:
+            next_cursor, messages = self.held_page
         else:
-            self.deliver_later.put(message)
+            messages, _ = self.take_undelivered_page(limit)
+            next_cursor = (cursor + len(messages)) & 0xFFFFFFFF
+            if messages:
+                self.held_page = (next_cursor, messages)
+
+        return next_cursor, messages, self.later_count() == 0 and not self.deliver_now
+
+    def take_undelivered_page(self, limit: int = None) -> (list, bool):
+        with self.later_lock:
+            messages = []
+            if self.spilled:
+                messages = UserState.spill_store.take(self.username, limit)
+                self.spilled -= len(messages)
+
+            while self.deliver_later and (limit is None or len(messages) < limit):
+                messages.append(self.deliver_later.popleft())
+            if not self.deliver_later:
+                self.deliver_later = None
+
+            if UserState.message_log and messages:
+                UserState.message_log.log_drain(self.username, len(messages))
+
+        queue = self.deliver_now
+        while queue and (limit is None or len(messages) < limit):
+            messages.append(queue.popleft())
+
+        return messages, self.later_count() == 0 and not queue
+
+    def restore(self, messages: list):
+        with self.later_lock:
+            for sender, body in messages:
+                self.append_later((sys.intern(sender), body))
+
+    def delete(self):
+        with self.later_lock:
+            if UserState.message_log:
+                UserState.message_log.log_delete(self.username)
+            if self.spilled:
+                UserState.spill_store.discard(self.username)
+                self.spilled = 0
+            self.deliver_later = None
+            self.unacked = None
+            self.held_page = None
+
+    def attach(self, wakeup):
+        self.wakeup = wakeup
 
     def login(self):
         self.here = True
 
+    def detach(self):
+        self.wakeup = None
+
     def logout(self):
         self.here = False
+        self.wakeup = None
+        self.resume_token = None
 
-    def is_here(self):
-        return self.here
-
-
+        # a session that never acknowledged will not resume either
+        if not self.acking:
+            self.release_unacked()
+        self.acking = False
 
+        # anything the connection did not get to is now waiting for later
+        for message in self.take_deliver_now():
+            self.queue_for_later(message, enforce_limit=False)
 
+    def is_here(self):
+        return self.here
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+import socket
+
+class Waker:
+    '''A wakeup primitive that a thread can wait on with select, alongside its sockets.
+
+       Any thread may call wake(). The waiting thread sees the waker become readable,
+       calls clear(), and then checks whatever state it was woken for. Repeated wakes
+       before a clear() are coalesced into a single pending byte, so a burst of
+       messages costs one wakeup rather than one per message.
+
+       @method wake: () -> None
+           make the waker readable. Safe to call from any thread.
+
+       @method clear: () -> None
+           consume pending wakeups. Call this before checking for new work, so that
+           work added after the check still produces a wakeup.
+
+       @method fileno: () -> int
+           lets a Waker be passed directly to select.select
+    '''
+
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+        self.writer.setblocking(False)
+        self.pending = False
+
+    def wake(self):
+        if self.pending:
+            return
+
+        self.pending = True
+        try:
+            self.writer.send(b'\0')
+        except OSError:
+            # the buffer is full, so the waiter is already going to wake up,
+            # or the waker was closed along with its connection.
+            pass
+
+    def clear(self):
+        self.pending = False
+        try:
+            while self.reader.recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()